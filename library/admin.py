@@ -1,6 +1,12 @@
 from django.contrib import admin
-from .models import Room, Bookshelf, Book
+from .models import Room, Bookshelf, Book, IngestionJob, IngestionImage, ShelfImageFingerprint, DeletedBookshelf, CoverImage, CoverSearch
 
 admin.site.register(Room)
 admin.site.register(Bookshelf)
-admin.site.register(Book)
\ No newline at end of file
+admin.site.register(Book)
+admin.site.register(IngestionJob)
+admin.site.register(IngestionImage)
+admin.site.register(ShelfImageFingerprint)
+admin.site.register(DeletedBookshelf)
+admin.site.register(CoverImage)
+admin.site.register(CoverSearch)
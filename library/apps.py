@@ -1,6 +1,22 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_migrate, post_save
 
 
 class LibraryConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'library'
+
+    def ready(self):
+        from .covers import enqueue_saved_book
+        from .instrumentation import install_db_instrumentation
+        from .models import Book
+        from .search import ensure_sqlite_triggers
+
+        # Su SQLite i trigger della ricerca full-text vanno ricreati se una
+        # migrazione ha ricostruito la tabella dei libri
+        post_migrate.connect(ensure_sqlite_triggers, sender=self)
+        # Tempi delle scritture sul database (solo con METRICS_ENABLED)
+        connection_created.connect(install_db_instrumentation)
+        # Copertine di libri salvati uno alla volta (view, admin...): in coda per la cache locale
+        post_save.connect(enqueue_saved_book, sender=Book)
@@ -1,106 +1,258 @@
 # In library/book_detector.py
-import requests
-import google.generativeai as genai
-import json
+import asyncio
+import logging
+import time
+from asgiref.sync import sync_to_async
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
-from . import book_scraper
-genai.configure(api_key=settings.GOOGLE_API_KEY)
-
-# --- LA FUNZIONE DI RICERCA CON LOGICA DI FALLBACK ---
-def find_book_details(title, author):
-    """
-    Cerca un libro. Prima tenta con titolo+autore, se fallisce, riprova solo con il titolo.
-    """
-    books_api_url = "https://www.googleapis.com/books/v1/volumes"
-    
-    # --- Tentativo 1: Ricerca ad alta precisione (Titolo + Autore) ---
-    query1 = f"intitle:{title}+inauthor:{author}"
-    params1 = {'q': query1, 'key': settings.GOOGLE_API_KEY, 'langRestrict': 'it,en', 'maxResults': 1}
-    response = requests.get(books_api_url, params=params1)
-    
-    # Se la ricerca precisa fallisce, proviamo una più generica
-    if response.status_code != 200 or response.json().get('totalItems', 0) == 0:
-        print(f"DEBUG: Ricerca precisa fallita per '{title}' di '{author}'. Tento con il solo titolo...")
-        # --- Tentativo 2: Fallback con il solo titolo ---
-        query2 = f"intitle:{title}"
-        params2 = {'q': query2, 'key': settings.GOOGLE_API_KEY, 'langRestrict': 'it,en', 'maxResults': 1}
-        response = requests.get(books_api_url, params=params2)
-
-    # Ora processiamo la risposta (che sia del primo o del secondo tentativo)
-    if response.status_code == 200 and response.json().get('totalItems', 0) > 0:
-        item = response.json()['items'][0]
-        book_data = item['volumeInfo']
-        
-        authors_list = book_data.get('authors', [author])
-        
-        return {
-            'title': book_data.get('title', title),
-            'author': ", ".join(authors_list),
-            'summary': book_data.get('description', ''),
-            'published_date': book_data.get('publishedDate', ''),
-            'google_books_id': item.get('id', ''),
-            'cover_url': book_data.get('imageLinks', {}).get('thumbnail', '')
-        }
-    return None
-
-# Il resto del file rimane identico
-def process_shelf_image(image_path):
-    print("DEBUG: Avvio analisi immagine con Gemini (Prompt Professionale)...")
-    
-    model = genai.GenerativeModel('gemini-2.5-flash-lite')
-    
-    try:
-        with open(image_path, 'rb') as f:
-            image_file = {'mime_type': 'image/jpeg', 'data': f.read()}
-    except IOError as e:
-        print(f"Errore nell'apertura del file immagine: {e}")
-        return []
+from . import book_matcher, book_scraper, image_fingerprints, image_utils, vision_backends
+from .metadata_cache import normalize_text
+
+logger = logging.getLogger(__name__)
+
+
+def process_shelf_image_data(image_data, mime_type='image/jpeg'):
+    """
+    Libri trovati (già arricchiti con Google Books) in una foto, a partire dai
+    suoi byte (es. quelli della coda di acquisizione, ridotti con
+    image_utils.prepare_image_for_model). Gli errori del backend di
+    riconoscimento (es. Gemini) vengono propagati, così chi chiama può decidere se ritentare.
+    """
+    return process_shelf_images_data([(image_data, mime_type)])[0]
+
+
+async def aprocess_shelf_image_data(image_data, mime_type='image/jpeg'):
+    """Versione async di process_shelf_image_data."""
+    return (await aprocess_shelf_images_data([(image_data, mime_type)]))[0]
+
+
+def process_shelf_images_data(images):
+    """
+    Libri trovati (già arricchiti con Google Books) in ciascuna foto
+    [(byte, mime_type), ...], nello stesso ordine. Vedi detect_shelf_images.
+    """
+    return [enrich_detected_books(books) for books in detect_shelf_images(images)]
+
+
+async def aprocess_shelf_images_data(images):
+    """Versione async di process_shelf_images_data."""
+    return [await aenrich_detected_books(books) for books in await adetect_shelf_images(images)]
+
+
+def _prepare_image(image_data, mime_type, backend_name, use_cache=True):
+    """
+    (impronta, libri già noti, tasselli da analizzare) di una foto.
+    Se la stessa foto (o una quasi identica) è già stata analizzata dallo
+    stesso backend, i titoli/autori vengono presi dalla cache delle impronte
+    e non ci sono tasselli da analizzare.
+    """
+    image = image_utils.decode_image(image_data)
+    fingerprint = image_fingerprints.fingerprint_image(image) if image is not None and use_cache else None
 
-    prompt = """
-    Sei un assistente bibliotecario virtuale, specializzato nel digitalizzare collezioni di libri da immagini. Il tuo compito è analizzare l'immagine fornita con la massima precisione.
-
-    Le tue istruzioni sono:
-    1.  **IDENTIFICA SOLO LIBRI:** Analizza l'immagine e identifica solo le coste dei libri. Ignora completamente loghi di case editrici (es. "Feltrinelli", "Mondadori"), numeri di collana (es. "1062", "444"), e qualsiasi altro testo che non sia chiaramente un titolo o un autore.
-    2.  **ESTRAI TITOLO E AUTORE:** Per ogni libro identificato, estrai il suo titolo completo e il nome completo dell'autore.
-    3.  **GESTISCI CASI INCERTI:**
-        - Se riesci a leggere chiaramente solo il nome di un autore (es. "YOURCENAR") ma non il titolo, formatta l'output con il titolo "Unknown" e l'autore che hai letto.
-        - Se riesci a leggere chiaramente solo un titolo ma non l'autore, formatta l'output con il titolo che hai letto e l'autore "Unknown".
-        - Se un libro è illeggibile o non sei sicuro, **non includerlo nell'output**. È meglio omettere un libro che inventarne uno.
-    4.  **FORMATO DI OUTPUT RIGIDO:** Restituisci il risultato **esclusivamente** come un array JSON valido. Ogni elemento dell'array deve essere un oggetto con due chiavi obbligatorie: "title" e "author". Non aggiungere nessun commento o testo prima o dopo l'array JSON.
-
-    Esempio di output perfetto:
-    [
-        { "title": "Memorie di Adriano", "author": "Marguerite Yourcenar" },
-        { "title": "Il Piccolo Principe", "author": "Antoine de Saint-Exupéry" },
-        { "title": "Unknown", "author": "Colette" }
+    cached = image_fingerprints.find_cached_detections(fingerprint, backend_name) if fingerprint else None
+    if cached is not None:
+        return fingerprint, cached, []
+    return fingerprint, None, image_utils.split_image_data_into_tiles(image_data, mime_type, image=image)
+
+
+def _collect_detections(prepared, tile_results, backend_name):
+    """Libri di una foto: quelli in cache, oppure l'unione dei suoi tasselli (salvata per le prossime volte)."""
+    fingerprint, cached, tiles = prepared
+    if cached is not None:
+        return cached
+    detections = merge_tile_detections([next(tile_results) for _ in tiles])
+    if fingerprint:
+        image_fingerprints.store_detections(fingerprint, detections, backend_name)
+    return detections
+
+
+def detect_shelf_images(images, backend=None, use_cache=True):
+    """
+    Titoli e autori letti in ciascuna foto [(byte, mime_type), ...].
+
+    Le foto molto larghe vengono divise in tasselli (tagliati tra una costa e
+    l'altra). I tasselli di tutte le foto non in cache vengono passati
+    insieme al backend (con Gemini: più immagini per richiesta) e i
+    risultati vengono poi riassegnati alle foto eliminando i libri visti in
+    due tasselli vicini. Con use_cache=False la cache delle impronte viene
+    ignorata (es. per confrontare i backend).
+    """
+    backend = backend or vision_backends.get_backend()
+    prepared = [_prepare_image(image_data, mime_type, backend.name, use_cache) for image_data, mime_type in images]
+    tiles = [tile for _, _, image_tiles in prepared for tile in image_tiles]
+    if tiles:
+        logger.debug("%d foto, %d immagini da analizzare (%s)", len(images), len(tiles), backend.name)
+    tile_results = iter(detect_books_in_images(tiles, backend) if tiles else [])
+    return [_collect_detections(p, tile_results, backend.name) for p in prepared]
+
+
+async def adetect_shelf_images(images, backend=None, use_cache=True):
+    """
+    Versione async di detect_shelf_images: le richieste a Gemini sono
+    coroutine. Decodifica, impronta e tasselli (CPU) e la cache delle impronte
+    (database) girano in un thread con sync_to_async.
+    """
+    backend = backend or vision_backends.get_backend()
+    prepared = [
+        await sync_to_async(_prepare_image)(image_data, mime_type, backend.name, use_cache)
+        for image_data, mime_type in images
     ]
+    tiles = [tile for _, _, image_tiles in prepared for tile in image_tiles]
+    tile_results = iter(await adetect_books_in_images(tiles, backend) if tiles else [])
+    return [await sync_to_async(_collect_detections)(p, tile_results, backend.name) for p in prepared]
+
+
+def merge_tile_detections(tile_results):
+    """
+    Unisce le liste di libri dei vari tasselli, nell'ordine da sinistra a destra.
+    Un libro che cade nella zona di sovrapposizione compare in due tasselli:
+    lo teniamo una sola volta (confronto su titolo e autore normalizzati).
+    """
+    merged = []
+    seen = set()
+    for books in tile_results:
+        for book in books:
+            key = (normalize_text(book.get('title')), normalize_text(book.get('author')))
+            if key not in seen:
+                seen.add(key)
+                merged.append(book)
+    return merged
+
+
+def detect_books_in_images(images, backend=None):
+    """
+    Libri visibili in ciascuna immagine [(byte, mime_type), ...]: una lista
+    per immagine, stesso ordine. Li legge il backend di settings.VISION_BACKEND
+    (library/vision_backends.py), se non ne viene indicato un altro.
+    """
+    return (backend or vision_backends.get_backend()).detect(images)
+
+
+async def adetect_books_in_images(images, backend=None):
+    """Versione async di detect_books_in_images."""
+    return await (backend or vision_backends.get_backend()).adetect(images)
+
+
+def _lookup_query(book):
+    """Query di Google Books per un libro rilevato da Gemini (None se titolo o autore mancano)."""
+    title = book.get("title")
+    author = book.get("author")
+
+    if not (title and author and title != "Unknown"):
+        return None
+
+    logger.debug("Cerco dettagli per '%s' di '%s'...", title, author)
+    return f"intitle:{title}+inauthor:{author}"
+
+
+def _lookup_detected_book(book):
     """
-    
+    Arricchisce un singolo libro rilevato da Gemini con i dati di Google Books.
+    Pensata per girare in un thread: gli errori vengono registrati e non propagati.
+    """
+    query = _lookup_query(book)
+    if query is None:
+        return None
+
+    start = time.monotonic()
     try:
-        response = model.generate_content([prompt, image_file])
-        cleaned_response_text = response.text.strip().replace("```json", "").replace("```", "").strip()
-        print(f"DEBUG: Risposta testuale pulita da Gemini ->\n{cleaned_response_text}")
-        identified_books = json.loads(cleaned_response_text)
+        # Chiamiamo la funzione potenziata dal nostro scraper!
+        details = book_scraper.get_book_details_from_google_api(
+            query=query,
+            timeout=settings.BOOK_LOOKUP_TIMEOUT,
+        )
     except Exception as e:
-        print(f"ERRORE: Impossibile chiamare Gemini o analizzare la sua risposta JSON. Errore: {e}")
-        return []
+        logger.warning("Ricerca fallita per '%s' di '%s'. Errore: %s", book.get('title'), book.get('author'), e)
+        return None
+    book_matcher.record_lookup(time.monotonic() - start, details)
+    return details
+
+
+async def _alookup_detected_book(book):
+    """Versione async di _lookup_detected_book."""
+    query = _lookup_query(book)
+    if query is None:
+        return None
 
+    start = time.monotonic()
+    try:
+        details = await book_scraper.aget_book_details_from_google_api(
+            query=query,
+            timeout=settings.BOOK_LOOKUP_TIMEOUT,
+        )
+    except Exception as e:
+        logger.warning("Ricerca fallita per '%s' di '%s'. Errore: %s", book.get('title'), book.get('author'), e)
+        return None
+    book_matcher.record_lookup(time.monotonic() - start, details)
+    return details
+
+
+def _unique_details(all_details):
+    """Tiene i risultati trovati, nell'ordine originale, senza ripetere lo stesso google_books_id."""
     final_book_list = []
     processed_ids = set()
-    
-    for book in identified_books:
-        title = book.get("title")
-        author = book.get("author")
-        
-        if title and author and title != "Unknown":
-            print(f"DEBUG: Cerco dettagli per '{title}' di '{author}'...")
-            # --- ECCO LA MODIFICA ---
-            # Chiamiamo la funzione potenziata dal nostro scraper!
-            details = book_scraper.get_book_details_from_google_api(query=f"intitle:{title}+inauthor:{author}")
-            
-            if details and details['google_books_id'] not in processed_ids:
-                final_book_list.append(details)
-                processed_ids.add(details['google_books_id'])
-                print(f"DEBUG: Dettagli trovati e aggiunti per '{details['title']}'")
-
-    return final_book_list
\ No newline at end of file
+
+    for details in all_details:
+        if details and details['google_books_id'] not in processed_ids:
+            final_book_list.append(details)
+            processed_ids.add(details['google_books_id'])
+            logger.debug("Dettagli trovati e aggiunti per '%s'", details['title'])
+
+    return final_book_list
+
+
+def _to_look_up(all_details):
+    """Posizioni dei libri che il riconoscimento locale non ha risolto."""
+    return [i for i, details in enumerate(all_details) if details is None]
+
+
+def enrich_detected_books(identified_books, max_workers=None):
+    """
+    Cerca su Google Books tutti i libri rilevati, in parallelo.
+    Prima prova a riconoscerli tra i volumi già noti (library/book_matcher.py):
+    in rete vanno solo gli altri.
+    Il numero di richieste contemporanee è limitato da BOOK_LOOKUP_WORKERS;
+    l'ordine dei risultati e la deduplica per google_books_id restano
+    quelli della versione sequenziale.
+    """
+    if not identified_books:
+        return []
+
+    all_details = book_matcher.match_detections(identified_books)
+    pending = _to_look_up(all_details)
+
+    if pending:
+        max_workers = max_workers or settings.BOOK_LOOKUP_WORKERS
+        max_workers = max(1, min(max_workers, len(pending)))
+
+        # executor.map restituisce i risultati nello stesso ordine dell'input
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            found = executor.map(_lookup_detected_book, [identified_books[i] for i in pending])
+            for i, details in zip(pending, found):
+                all_details[i] = details
+
+    return _unique_details(all_details)
+
+
+async def aenrich_detected_books(identified_books, max_concurrency=None):
+    """
+    Versione async di enrich_detected_books: le ricerche sono coroutine in un
+    solo thread invece di un thread ciascuna, sempre al massimo
+    BOOK_LOOKUP_WORKERS alla volta.
+    """
+    if not identified_books:
+        return []
+
+    all_details = await sync_to_async(book_matcher.match_detections)(identified_books)
+    pending = _to_look_up(all_details)
+    semaphore = asyncio.Semaphore(max_concurrency or settings.BOOK_LOOKUP_WORKERS)
+
+    async def lookup(book):
+        async with semaphore:
+            return await _alookup_detected_book(book)
+
+    # gather restituisce i risultati nello stesso ordine dell'input
+    found = await asyncio.gather(*(lookup(identified_books[i]) for i in pending))
+    for i, details in zip(pending, found):
+        all_details[i] = details
+    return _unique_details(all_details)
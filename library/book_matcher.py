@@ -0,0 +1,270 @@
+# In library/book_matcher.py
+"""
+Riconoscimento "locale" dei libri letti da Gemini, prima di Google Books.
+
+Gemini legge le coste con qualche errore (lettere scambiate, accenti persi,
+solo il cognome dell'autore): la ricerca esatta sulla metadata_cache non
+trova niente e parte una chiamata a Google Books, anche per libri che
+abbiamo già in catalogo.
+
+Qui teniamo un indice di trigrammi (titoli normalizzati) dei volumi già
+noti: i libri del catalogo, i risultati nella cache in memoria dei metadati
+e quelli trovati dalle ricerche successive. Una rilevazione con titolo
+abbastanza simile (coefficiente di Dice sui trigrammi) e autore compatibile
+viene risolta senza rete; solo le altre vanno su Google Books.
+
+L'indice è per processo. I libri salvati da add_books_to_bookshelf e i
+volumi trovati in rete vi vengono aggiunti man mano (add_catalog_books,
+record_lookup); la ricostruzione completa avviene solo dopo
+BOOK_MATCH_INDEX_TTL secondi, e raccoglie anche le modifiche fatte altrove
+(admin, importazioni, libri cancellati). Mentre un thread la esegue, gli
+altri continuano a usare l'indice precedente.
+"""
+import logging
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+
+from .metadata_cache import metadata_cache, normalize_text
+from .models import Book
+
+logger = logging.getLogger(__name__)
+
+# Campi restituiti per un libro del catalogo (come quelli di Google Books)
+_DETAIL_FIELDS = ('title', 'author', 'summary', 'published_date', 'google_books_id', 'cover_url')
+
+# Peso del titolo nel punteggio finale (il resto è l'autore)
+TITLE_WEIGHT = 0.7
+
+
+def trigrams(text):
+    """Trigrammi del testo normalizzato (con spazi ai bordi, così contano anche inizio e fine)."""
+    text = normalize_text(text)
+    if not text:
+        return frozenset()
+    padded = f"  {text} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def dice(a, b):
+    if not a or not b:
+        return 0.0
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+def author_similarity(detected, candidate):
+    """
+    Somiglianza tra l'autore letto e quello del volume. Gemini legge spesso
+    solo il cognome ("YOURCENAR"): vale anche la quota di parole lette che
+    compaiono nel nome completo.
+    """
+    detected_words = set(normalize_text(detected).split())
+    candidate_words = set(normalize_text(candidate).split())
+    containment = len(detected_words & candidate_words) / len(detected_words) if detected_words else 0.0
+    return max(containment, dice(trigrams(detected), trigrams(candidate)))
+
+
+class TrigramIndex:
+    """Indice invertito trigramma -> volumi, con un volume per google_books_id."""
+
+    def __init__(self):
+        # (dettagli, trigrammi del titolo, dal catalogo?) per posizione
+        self.entries = []
+        self.positions = {}
+        self.postings = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, details, from_catalog=False):
+        google_id = details.get('google_books_id')
+        if not google_id or google_id in self.positions or not details.get('title'):
+            return
+        grams = trigrams(details['title'])
+        position = len(self.entries)
+        self.entries.append((details, grams, from_catalog))
+        self.positions[google_id] = position
+        for gram in grams:
+            self.postings.setdefault(gram, []).append(position)
+
+    def best_match(self, title, author):
+        """(dettagli, dal catalogo?, punteggio) del volume più simile sopra le soglie, oppure (None, False, 0)."""
+        grams = trigrams(title)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.postings.get(gram, ()))
+
+        best = (None, False, 0.0)
+        # Solo i candidati con più trigrammi in comune: gli altri non possono superare la soglia
+        for position, common in shared.most_common(settings.BOOK_MATCH_CANDIDATES):
+            details, entry_grams, from_catalog = self.entries[position]
+            title_score = 2 * common / (len(grams) + len(entry_grams))
+            if title_score < settings.BOOK_MATCH_MIN_TITLE_SCORE:
+                continue
+            author_score = author_similarity(author, details.get('author'))
+            if author_score < settings.BOOK_MATCH_MIN_AUTHOR_SCORE:
+                continue
+            score = TITLE_WEIGHT * title_score + (1 - TITLE_WEIGHT) * author_score
+            if score > best[2]:
+                best = (details, from_catalog, score)
+        return best
+
+
+_lock = threading.Lock()
+# Una sola ricostruzione alla volta (fuori da _lock, che protegge l'indice in uso)
+_build_lock = threading.Lock()
+_index = None
+_index_built_at = 0.0
+# Volumi aggiunti durante una ricostruzione: finiscono anche nel nuovo indice
+_added_while_building = None
+_stats = {'detections': 0, 'resolved_locally': 0, 'network_lookups': 0, 'network_seconds': 0.0, 'match_seconds': 0.0}
+
+
+def _build_index():
+    index = TrigramIndex()
+    # Del catalogo teniamo in memoria solo titolo e autore: il resto lo leggiamo quando serve
+    books = Book.objects.exclude(google_books_id__isnull=True).exclude(google_books_id='').order_by('id')
+    for details in books.values('google_books_id', 'title', 'author').iterator(chunk_size=2000):
+        index.add(details, from_catalog=True)
+    for details in metadata_cache.local_values():
+        index.add(details)
+    return index
+
+
+def _is_fresh():
+    return _index is not None and time.monotonic() - _index_built_at <= settings.BOOK_MATCH_INDEX_TTL
+
+
+def get_index():
+    """L'indice del processo; dopo BOOK_MATCH_INDEX_TTL secondi viene ricostruito da zero."""
+    global _index, _index_built_at, _added_while_building
+    with _lock:
+        if _is_fresh():
+            return _index
+        stale = _index
+    # Se c'è già un indice (scaduto) e un altro thread lo sta ricostruendo, usiamo quello
+    if not _build_lock.acquire(blocking=stale is None):
+        return stale
+    try:
+        with _lock:
+            if _is_fresh():
+                return _index
+            _added_while_building = []
+        start = time.monotonic()
+        index = _build_index()
+        with _lock:
+            for details, from_catalog in _added_while_building:
+                index.add(details, from_catalog)
+            _index, _index_built_at, _added_while_building = index, time.monotonic(), None
+        logger.debug("Indice dei titoli ricostruito (%d volumi, %.0f ms)", len(index), (_index_built_at - start) * 1000)
+        return index
+    finally:
+        # Anche se la ricostruzione fallisce (es. database non raggiungibile)
+        with _lock:
+            _added_while_building = None
+        _build_lock.release()
+
+
+def _add(details, from_catalog=False):
+    """Aggiunge un volume all'indice in uso (chiamare con _lock)."""
+    if _index is not None:
+        _index.add(details, from_catalog)
+    if _added_while_building is not None:
+        _added_while_building.append((details, from_catalog))
+
+
+def add_catalog_books(books):
+    """Aggiunge all'indice i libri appena salvati nel catalogo, senza ricostruirlo."""
+    with _lock:
+        for book in books:
+            _add({'google_books_id': book.google_books_id, 'title': book.title, 'author': book.author}, from_catalog=True)
+
+
+def _catalog_details(google_ids):
+    """Dati completi dei libri del catalogo (uno per google_books_id), con una query."""
+    details = {}
+    for book in Book.objects.filter(google_books_id__in=google_ids).order_by('id').values(*_DETAIL_FIELDS):
+        details.setdefault(book['google_books_id'], book)
+    return details
+
+
+def _can_match(book):
+    title, author = book.get('title'), book.get('author')
+    # Come per la ricerca su Google Books servono titolo e autore
+    return bool(title and author and title != 'Unknown' and author != 'Unknown')
+
+
+def match_detections(identified_books):
+    """
+    Per ogni libro rilevato restituisce i dati del volume già noto che gli
+    corrisponde con sufficiente sicurezza, oppure None (da cercare in rete).
+    Stesso ordine dell'input.
+    """
+    if not settings.BOOK_MATCH_ENABLED:
+        with _lock:
+            _stats['detections'] += len(identified_books)
+        return [None] * len(identified_books)
+
+    start = time.monotonic()
+    index = get_index()
+    with _lock:
+        matches = [index.best_match(book['title'], book['author']) if _can_match(book) else (None, False, 0.0)
+                   for book in identified_books]
+
+    catalog_ids = [details['google_books_id'] for details, from_catalog, _ in matches if from_catalog]
+    full_details = _catalog_details(catalog_ids) if catalog_ids else {}
+
+    results = []
+    for book, (details, from_catalog, score) in zip(identified_books, matches):
+        if details is not None and from_catalog:
+            details = full_details.get(details['google_books_id'])
+        if details is not None:
+            logger.debug("'%s' di '%s' riconosciuto senza rete: '%s' (punteggio %.2f)", book['title'], book['author'], details['title'], score)
+            details = dict(details)
+        results.append(details)
+
+    resolved = sum(details is not None for details in results)
+    with _lock:
+        _stats['detections'] += len(identified_books)
+        _stats['resolved_locally'] += resolved
+        _stats['match_seconds'] += time.monotonic() - start
+    return results
+
+
+def record_lookup(seconds, details):
+    """Registra una ricerca su Google Books (per le statistiche) e aggiunge all'indice il volume trovato."""
+    with _lock:
+        _stats['network_lookups'] += 1
+        _stats['network_seconds'] += seconds
+        if details:
+            _add(dict(details))
+
+
+def stats():
+    with _lock:
+        result = dict(_stats)
+        result['index_size'] = len(_index) if _index is not None else 0
+    detections = result['detections']
+    avg_lookup = result['network_seconds'] / result['network_lookups'] if result['network_lookups'] else 0.0
+    result['local_fraction'] = result['resolved_locally'] / detections if detections else 0.0
+    result['avg_lookup_ms'] = round(avg_lookup * 1000, 1)
+    result['avg_match_ms'] = round(result['match_seconds'] / detections * 1000, 3) if detections else 0.0
+    # Ogni libro risolto localmente avrebbe richiesto (in media) una ricerca come le altre
+    result['estimated_saved_seconds'] = round(result['resolved_locally'] * avg_lookup - result['match_seconds'], 3)
+    result['network_seconds'] = round(result['network_seconds'], 3)
+    result['match_seconds'] = round(result['match_seconds'], 3)
+    return result
+
+
+def reset_stats():
+    with _lock:
+        for name in _stats:
+            _stats[name] = 0.0 if isinstance(_stats[name], float) else 0
+
+
+def reset_index():
+    global _index
+    with _lock:
+        _index = None
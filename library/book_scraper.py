@@ -1,97 +1,135 @@
 # In library/book_scraper.py
-import requests
-from bs4 import BeautifulSoup
-from urllib.parse import urlparse, parse_qs, quote_plus
+from urllib.parse import urlparse, parse_qs
+import logging
+import html
 import re # Importiamo il modulo per le espressioni regolari
+from django.conf import settings
+from .http_client import async_http_client, http_client
+from .lazy_imports import lazy_import
+from .metadata_cache import cached_lookup, key_for_google_lookup
 
-# --- NUOVA FUNZIONE PER LO SCRAPING DI GOOGLE IMMAGINI ---
-def find_cover_on_google_images(book_title):
+logger = logging.getLogger(__name__)
+
+# Serve solo per le pagine Amazon: caricato al primo utilizzo
+bs4 = lazy_import('bs4')
+
+GOOGLE_IMAGES_URL = "https://www.google.com/search"
+BROWSER_HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
+
+
+def _google_images_params(book_title):
+    search_query = f"{book_title} libro copertina"
+    logger.debug("Google Immagini: cerco copertina per '%s'...", search_query)
+    return {'tbm': 'isch', 'q': search_query}
+
+
+# Tag <img> e attributo src (tra virgolette doppie, singole o senza), cercati direttamente
+# nei byte della pagina: niente albero HTML, ci fermiamo alla prima immagine valida
+_IMG_TAG = re.compile(rb'<img\b[^>]*>', re.IGNORECASE)
+_SRC_ATTR = re.compile(rb'''(?<![\w-])src\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''', re.IGNORECASE)
+
+
+def _first_cover_url(content):
+    """Estrae dalla pagina dei risultati di Google Immagini (byte) l'URL della prima immagine VALIDA."""
+    for tag in _IMG_TAG.finditer(content):
+        match = _SRC_ATTR.search(tag.group())
+        if not match:
+            continue
+        src = html.unescape(next(group for group in match.groups() if group is not None).decode('utf-8', 'replace'))
+
+        # --- NUOVE REGOLE DI FILTRAGGIO PIÙ SELETTIVE ---
+        if (src.startswith('https://') and
+            'gstatic.com' not in src and    # Ignora i loghi e le icone di Google
+            not src.endswith('.svg')):      # Ignora le immagini vettoriali (spesso loghi)
+
+            logger.debug("Google Immagini: trovato URL valido: %s", src)
+            return src
+
+    logger.debug("Google Immagini: nessun URL di copertina valido trovato.")
+    return None
+
+
+def search_cover_on_google_images(book_title, timeout=None):
     """
-    Esegue una ricerca su Google Immagini e tenta di estrarre l'URL della prima immagine VALIDA.
+    Cerca la copertina su Google Immagini e restituisce l'URL trovato o None.
+    Gli errori di rete non vengono nascosti: chi chiama deve poter distinguere
+    "nessuna copertina" da "riprova più tardi".
     """
-    try:
-        search_query = f"{book_title} libro copertina"
-        encoded_query = quote_plus(search_query)
-        search_url = f"https://www.google.com/search?tbm=isch&q={encoded_query}"
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
-        
-        print(f"DEBUG (Google Images): Cerco copertina per '{search_query}'...")
-        page = requests.get(search_url, headers=headers)
-        soup = BeautifulSoup(page.content, 'html.parser')
-        
-        images = soup.find_all('img')
-        
-        for img in images:
-            src = img.get('src')
-            
-            # --- NUOVE REGOLE DI FILTRAGGIO PIÙ SELETTIVE ---
-            if (src and 
-                src.startswith('https://') and 
-                'gstatic.com' not in src and    # Ignora i loghi e le icone di Google
-                not src.endswith('.svg')):      # Ignora le immagini vettoriali (spesso loghi)
-                
-                print(f"DEBUG (Google Images): Trovato URL VALIDO: {src}")
-                return src
-                
-    except Exception as e:
-        print(f"ERRORE durante lo scraping di Google Immagini: {e}")
+    timeout = timeout or settings.BOOK_LOOKUP_TIMEOUT
+    page = http_client.get(GOOGLE_IMAGES_URL, params=_google_images_params(book_title), headers=BROWSER_HEADERS, timeout=timeout)
+    page.raise_for_status()
+    return _first_cover_url(page.content)
+
+
+def _google_books_request(book_id=None, query=None):
+    """URL e parametri della chiamata a Google Books (per volume id oppure per ricerca)."""
+    if book_id:
+        return f"{settings.GOOGLE_BOOKS_API_URL}/{book_id}", None
+    return settings.GOOGLE_BOOKS_API_URL, {'q': query, 'langRestrict': 'it,en', 'maxResults': 1}
+
+
+def _parse_google_books_response(response, book_id=None):
+    """
+    Dati del libro dalla risposta di Google Books, oppure None se il libro non
+    esiste. Gli altri errori (quota, 429/5xx rimasti dopo i tentativi di
+    http_client) vengono sollevati: un guasto passeggero non deve finire in
+    cache come "libro non trovato".
+    """
+    if book_id and response.status_code == 404:
+        return None
+    response.raise_for_status()
+    data = response.json()
+    if not ('id' in data or data.get('totalItems', 0) > 0):
         return None
+
+    item = data if book_id else data.get('items', [{}])[0]
     
-    print("DEBUG (Google Images): Nessun URL di copertina valido trovato.")
-    return None
+    book_data = item.get('volumeInfo', {})
+    authors_list = book_data.get('authors', ['Unknown Author'])
+    
+    # Estrai i dati come prima
+    return {
+        'title': book_data.get('title', 'N/A'),
+        'author': ", ".join(authors_list),
+        'summary': book_data.get('description', ''),
+        'published_date': book_data.get('publishedDate', ''),
+        'google_books_id': item.get('id', ''),
+        'cover_url': book_data.get('imageLinks', {}).get('thumbnail', '')
+    }
 
 
-# --- FUNZIONE PRINCIPALE MODIFICATA CON LA LOGICA DI FALLBACK ---
-def get_book_details_from_google_api(book_id=None, query=None):
+@cached_lookup(key_for_google_lookup)
+def get_book_details_from_google_api(book_id=None, query=None, timeout=None):
     """
-    Funzione potenziata. Se l'API di Google Books non restituisce una copertina,
-    tenta di cercarne una su Google Immagini come piano B.
+    Cerca un libro su Google Books (per volume id o per ricerca).
+    Se manca la copertina il risultato esce così: il piano B su Google
+    Immagini lo fa in background library/cover_fallback.py, quando il libro
+    viene salvato.
+    I risultati (anche quelli negativi) passano dalla metadata_cache.
+    `timeout` (secondi) vale per ogni singola richiesta HTTP.
     """
     if not book_id and not query:
         return None
 
-    books_api_url = "https://www.googleapis.com/books/v1/volumes"
-    
-    if book_id:
-        response = requests.get(f"{books_api_url}/{book_id}")
-    else:
-        params = {'q': query, 'langRestrict': 'it,en', 'maxResults': 1}
-        response = requests.get(books_api_url, params=params)
-
-    if response.status_code == 200 and ('id' in response.json() or response.json().get('totalItems', 0) > 0):
-        data = response.json()
-        item = data if book_id else data.get('items', [{}])[0]
-        
-        book_data = item.get('volumeInfo', {})
-        authors_list = book_data.get('authors', ['Unknown Author'])
-        
-        # Estrai i dati come prima
-        result = {
-            'title': book_data.get('title', 'N/A'),
-            'author': ", ".join(authors_list),
-            'summary': book_data.get('description', ''),
-            'published_date': book_data.get('publishedDate', ''),
-            'google_books_id': item.get('id', ''),
-            'cover_url': book_data.get('imageLinks', {}).get('thumbnail', '')
-        }
-
-        # --- LOGICA DI FALLBACK ---
-        # Se, e solo se, l'URL della copertina è vuoto...
-        if not result['cover_url'] and result['title'] != 'N/A':
-            print(f"INFO: Copertina non trovata per '{result['title']}' su Google Books. Tento il fallback su Google Immagini.")
-            # ...chiama la nostra nuova funzione di scraping!
-            image_url = find_cover_on_google_images(result['title'])
-            if image_url:
-                result['cover_url'] = image_url # Aggiorna il risultato con la copertina trovata
-
-        return result
-        
-    return None
+    timeout = timeout or settings.BOOK_LOOKUP_TIMEOUT
+    url, params = _google_books_request(book_id, query)
+    return _parse_google_books_response(http_client.get(url, params=params, timeout=timeout), book_id)
+
 
-def scrape_book_data_from_url(url):
+@cached_lookup(key_for_google_lookup)
+async def aget_book_details_from_google_api(book_id=None, query=None, timeout=None):
+    """Versione async di get_book_details_from_google_api (stessa cache, stessi risultati)."""
+    if not book_id and not query:
+        return None
+
+    timeout = timeout or settings.BOOK_LOOKUP_TIMEOUT
+    url, params = _google_books_request(book_id, query)
+    return _parse_google_books_response(await async_http_client.get(url, params=params, timeout=timeout), book_id)
+
+def _parse_book_url(url):
     """
-    Analizza un URL, estrae i dati e li usa per chiamare l'API di Google Books.
-    Versione migliorata per Amazon.
+    Capisce che tipo di URL è stato incollato. Restituisce una tupla:
+    ('volume', id Google Books), ('isbn', isbn), ('amazon_page', url) oppure (None, None).
     """
     
     # --- Caso 1: Google Books (invariato) ---
@@ -99,37 +137,79 @@ def scrape_book_data_from_url(url):
         try:
             parsed_url = urlparse(url)
             book_id = parse_qs(parsed_url.query)['id'][0]
-            print(f"DEBUG: Trovato Google Books ID: {book_id}")
-            return get_book_details_from_google_api(book_id=book_id)
+            logger.debug("Trovato Google Books ID: %s", book_id)
+            return 'volume', book_id
         except Exception as e:
-            print(f"Errore nell'analisi dell'URL di Google Books: {e}")
-            return None
+            logger.warning("Errore nell'analisi dell'URL di Google Books: %s", e)
+            return None, None
 
     # --- Caso 2: Amazon (Logica Robusta) ---
     elif 'amazon' in url:
-        try:
-            # L'ISBN è spesso nell'URL (es. /dp/881802731X/)
-            # Usiamo un'espressione regolare per trovarlo. È un codice di 10 o 13 cifre.
-            isbn_match = re.search(r'/(dp|gp/product)/(\w{10}|\d{13})', url)
-            if isbn_match:
-                isbn = isbn_match.group(2)
-                print(f"DEBUG: Trovato ISBN dall'URL di Amazon: {isbn}")
-                # La ricerca per ISBN è la più precisa possibile!
-                return get_book_details_from_google_api(query=f"isbn:{isbn}")
-
-            # Se non c'è l'ISBN, proviamo a leggere il titolo dalla pagina
-            headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
-            page = requests.get(url, headers=headers)
-            soup = BeautifulSoup(page.content, 'html.parser')
-            
-            title = soup.find('span', {'id': 'productTitle'})
-            if title:
-                title_text = title.text.strip()
-                print(f"DEBUG: Trovato Titolo dalla pagina Amazon: '{title_text}'")
+        # L'ISBN è spesso nell'URL (es. /dp/881802731X/)
+        # Usiamo un'espressione regolare per trovarlo. È un codice di 10 o 13 cifre.
+        isbn_match = re.search(r'/(dp|gp/product)/(\w{10}|\d{13})', url)
+        if isbn_match:
+            isbn = isbn_match.group(2)
+            logger.debug("Trovato ISBN dall'URL di Amazon: %s", isbn)
+            # La ricerca per ISBN è la più precisa possibile!
+            return 'isbn', isbn
+        # Se non c'è l'ISBN, proviamo a leggere il titolo dalla pagina
+        return 'amazon_page', url
+
+    return None, None
+
+
+def _amazon_title(content):
+    soup = bs4.BeautifulSoup(content, 'html.parser')
+    title = soup.find('span', {'id': 'productTitle'})
+    if title:
+        title_text = title.text.strip()
+        logger.debug("Trovato titolo dalla pagina Amazon: '%s'", title_text)
+        return title_text
+    return None
+
+
+def scrape_book_data_from_url(url, raise_errors=False):
+    """
+    Analizza un URL, estrae i dati e li usa per chiamare l'API di Google Books.
+    Versione migliorata per Amazon.
+    Gli errori (rete, Google Books, pagina Amazon) vengono registrati e il
+    risultato è None, come per un libro non trovato; con raise_errors=True
+    vengono propagati, così chi chiama può distinguerli (es. bulk_import).
+    """
+    kind, value = _parse_book_url(url)
+    try:
+        if kind == 'volume':
+            return get_book_details_from_google_api(book_id=value)
+        if kind == 'isbn':
+            return get_book_details_from_google_api(query=f"isbn:{value}")
+        if kind == 'amazon_page':
+            page = http_client.get(value, headers=BROWSER_HEADERS, timeout=settings.BOOK_LOOKUP_TIMEOUT)
+            page.raise_for_status()
+            title_text = _amazon_title(page.content)
+            if title_text:
                 return get_book_details_from_google_api(query=title_text)
+    except Exception as e:
+        if raise_errors:
+            raise
+        logger.warning("Errore nella ricerca del libro da %s: %s", url, e)
+    return None
 
-        except Exception as e:
-            print(f"Errore nello scraping di Amazon: {e}")
-            return None
-    
-    return None
\ No newline at end of file
+
+async def ascrape_book_data_from_url(url):
+    """Versione async di scrape_book_data_from_url."""
+    kind, value = _parse_book_url(url)
+    try:
+        if kind == 'volume':
+            return await aget_book_details_from_google_api(book_id=value)
+        if kind == 'isbn':
+            return await aget_book_details_from_google_api(query=f"isbn:{value}")
+        if kind == 'amazon_page':
+            page = await async_http_client.get(value, headers=BROWSER_HEADERS, timeout=settings.BOOK_LOOKUP_TIMEOUT)
+            page.raise_for_status()
+            title_text = _amazon_title(page.content)
+            if title_text:
+                return await aget_book_details_from_google_api(query=title_text)
+    except Exception as e:
+        logger.warning("Errore nella ricerca del libro da %s: %s", url, e)
+    return None
@@ -0,0 +1,79 @@
+# In library/book_store.py
+"""
+Salvataggio dei libri trovati (da foto o da URL) in una libreria.
+
+Un'unica query per sapere quali google_books_id sono già presenti,
+un solo bulk_create per quelli nuovi, tutto dentro una transazione.
+Il vincolo UNIQUE (bookshelf, google_books_id) sul database garantisce
+che due upload contemporanei non creino doppioni; il lock sulla riga della
+libreria li mette in fila, così ognuno sa quali libri ha aggiunto davvero.
+Le copertine dei libri aggiunti vengono messe in coda per la cache locale.
+"""
+from django.db import transaction
+
+from . import book_matcher, cover_fallback, covers
+from .models import Book, Bookshelf
+
+
+_SAVED_FIELDS = ('title', 'author', 'shelf_number')
+
+
+def _saved_fields(book):
+    """I campi del libro come li rilegge il database (es. shelf_number '2' diventa 2)."""
+    return tuple(Book._meta.get_field(name).to_python(getattr(book, name)) for name in _SAVED_FIELDS)
+
+
+def add_books_to_bookshelf(bookshelf, shelf_number, books_data):
+    """
+    Aggiunge alla libreria i libri non ancora presenti (confronto per google_books_id).
+    I libri senza google_books_id vengono ignorati. Restituisce i libri
+    aggiunti, riletti dal database (con la loro chiave primaria).
+    """
+    new_books = {}
+    for book_data in books_data:
+        google_id = book_data.get('google_books_id')
+        if not google_id or google_id in new_books:
+            continue
+        new_books[google_id] = Book(
+            title=book_data.get('title') or 'No Title Provided',
+            author=book_data.get('author') or 'Unknown Author',
+            bookshelf=bookshelf,
+            shelf_number=shelf_number,
+            summary=book_data.get('summary', ''),
+            google_books_id=google_id,
+            cover_url=book_data.get('cover_url', ''),
+            published_date=book_data.get('published_date', ''),
+        )
+
+    if not new_books:
+        return []
+
+    with transaction.atomic():
+        # Due salvataggi sulla stessa libreria uno alla volta (su SQLite le scritture sono già in fila)
+        Bookshelf.objects.select_for_update().filter(pk=bookshelf.pk).exists()
+        existing_ids = set(
+            Book.objects.filter(bookshelf=bookshelf, google_books_id__in=new_books)
+            .values_list('google_books_id', flat=True)
+        )
+        to_create = [book for google_id, book in new_books.items() if google_id not in existing_ids]
+        # Libri senza copertina: quella già trovata su Google Immagini, oppure ricerca in coda
+        cover_fallback.apply_known_covers(to_create)
+        # ignore_conflicts: se un altro upload ha inserito lo stesso libro nel frattempo,
+        # il vincolo UNIQUE scarta la riga invece di far fallire tutto il blocco
+        Book.objects.bulk_create(to_create, ignore_conflicts=True)
+        # Gli oggetti di bulk_create(ignore_conflicts=True) non hanno pk e includono
+        # anche le righe scartate: restituiamo quelle davvero salvate da noi (se un
+        # salvataggio fuori da questa funzione, es. l'admin, ha vinto la gara, la sua
+        # riga ha dati diversi dai nostri)
+        created = [
+            book for book in Book.objects.filter(
+                bookshelf=bookshelf, google_books_id__in=[book.google_books_id for book in to_create],
+            ).order_by('id')
+            if _saved_fields(book) == _saved_fields(new_books[book.google_books_id])
+        ] if to_create else []
+
+    # Le copertine verranno scaricate in background (python manage.py fetch_covers)
+    covers.enqueue(book.cover_url for book in created)
+    # Riconoscibili subito dalle prossime foto, senza ricostruire l'indice dei titoli
+    book_matcher.add_catalog_books(created)
+    return created
@@ -0,0 +1,191 @@
+# In library/bulk_import.py
+"""
+Importazione in blocco di libri da una lista di ISBN e/o URL
+(Amazon, Google Books), ad esempio esportata da un foglio di calcolo.
+
+- Formati accettati: JSON (lista di stringhe o di oggetti con "isbn"/"url")
+  oppure CSV (colonna "isbn" o "url", altrimenti la prima colonna).
+- Le voci ripetute vengono cercate una sola volta.
+- Le ricerche partono in parallelo (BOOK_LOOKUP_WORKERS) e passano dalla
+  metadata_cache, come quelle delle foto.
+- I libri trovati vengono salvati a blocchi con add_books_to_bookshelf.
+- import_entries è un generatore: restituisce l'esito di ogni riga appena
+  è pronto, così la view e il comando possono mostrare l'avanzamento.
+"""
+import csv
+import io
+import json
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.conf import settings
+from django.db import connections
+
+from . import book_scraper
+from .book_store import add_books_to_bookshelf
+
+logger = logging.getLogger(__name__)
+
+_COLUMNS = ('isbn', 'url')
+
+
+class ImportFormatError(ValueError):
+    """Il file da importare non è leggibile (formato sbagliato o troppe righe)."""
+
+
+def _from_item(item):
+    if isinstance(item, dict):
+        for column in _COLUMNS:
+            if item.get(column):
+                return str(item[column])
+        return ''
+    return str(item)
+
+
+def parse_entries(data, format=None):
+    """
+    Legge la lista da importare (bytes o str) e restituisce le voci come stringhe.
+    `format` è 'json' o 'csv'; se manca viene dedotto dal contenuto.
+    """
+    if isinstance(data, bytes):
+        data = data.decode('utf-8-sig')
+    text = data.strip()
+    if format is None:
+        format = 'json' if text[:1] in ('[', '{') else 'csv'
+
+    if format == 'json':
+        try:
+            items = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise ImportFormatError(f"JSON non valido: {e}")
+        if isinstance(items, dict):
+            items = items.get('items', [])
+        if not isinstance(items, list):
+            raise ImportFormatError("Il JSON deve essere una lista di ISBN/URL")
+        entries = [_from_item(item).strip() for item in items]
+    elif format == 'csv':
+        rows = list(csv.reader(io.StringIO(text)))
+        column = 0
+        if rows:
+            header = [cell.strip().lower() for cell in rows[0]]
+            for name in _COLUMNS:
+                if name in header:
+                    column = header.index(name)
+                    rows = rows[1:]
+                    break
+        entries = [row[column].strip() if len(row) > column else '' for row in rows]
+    else:
+        raise ImportFormatError(f"Formato non supportato: {format}")
+
+    if len(entries) > settings.BULK_IMPORT_MAX_ROWS:
+        raise ImportFormatError(f"Troppe righe: al massimo {settings.BULK_IMPORT_MAX_ROWS} per importazione")
+    return entries
+
+
+def normalize_entry(value):
+    """
+    ('isbn', isbn) per un ISBN-10/13 (trattini e spazi ignorati), ('url', url)
+    per un indirizzo web, oppure (None, None) se la voce non è riconoscibile.
+    """
+    value = value.strip()
+    if re.match(r'https?://', value, re.IGNORECASE):
+        return 'url', value
+    isbn = re.sub(r'[\s-]', '', value).upper()
+    if re.fullmatch(r'\d{9}[\dX]|\d{13}', isbn):
+        return 'isbn', isbn
+    return None, None
+
+
+def resolve_entry(kind, value):
+    """
+    Cerca un libro (i risultati passano dalla metadata_cache). Gli errori di
+    rete vengono propagati: import_entries li riporta come 'error', non come 'not_found'.
+    """
+    try:
+        if kind == 'isbn':
+            return book_scraper.get_book_details_from_google_api(query=f"isbn:{value}")
+        return book_scraper.scrape_book_data_from_url(value, raise_errors=True)
+    finally:
+        # La cache condivisa usa il DB da questo thread: chiudiamo la sua connessione
+        connections.close_all()
+
+
+def import_entries(bookshelf, shelf_number, entries, max_workers=None, batch_size=None):
+    """
+    Importa le voci nella libreria. Restituisce (generatore) un dizionario per
+    ogni riga, con 'row' (da 1), 'input' e 'status' (più 'book_id' se added):
+    added | exists (già in libreria o già importato da un'altra riga) |
+    duplicate (voce ripetuta) | not_found | invalid | error.
+    L'ultimo elemento è il riepilogo: {'done': True, 'counts': {...}}.
+    """
+    max_workers = max_workers or settings.BOOK_LOOKUP_WORKERS
+    batch_size = batch_size or settings.BULK_IMPORT_BATCH_SIZE
+    counts = {}
+    pending = []        # righe trovate, in attesa di essere salvate
+    imported_ids = set()
+
+    def emit(result):
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+        return result
+
+    def flush():
+        # Solo le righe davvero inserite (con la loro pk): quelle già presenti o
+        # scartate dal vincolo UNIQUE nel frattempo non contano come aggiunte
+        created = {book.google_books_id: book for book in add_books_to_bookshelf(bookshelf, shelf_number, [book for _, book in pending])}
+        for result, book in pending:
+            google_id = book['google_books_id']
+            if google_id in created and google_id not in imported_ids:
+                result.update(status='added', book_id=created[google_id].pk)
+            else:
+                result['status'] = 'exists'
+            imported_ids.add(google_id)
+            yield emit(result)
+        pending.clear()
+
+    # Ogni voce distinta viene cercata una volta sola
+    first_row = {}
+    to_resolve = []
+    for row, value in enumerate(entries, start=1):
+        kind, normalized = normalize_entry(value)
+        if kind is None:
+            yield emit({'row': row, 'input': value, 'status': 'invalid', 'error': "Né un ISBN né un URL"})
+        elif (kind, normalized) in first_row:
+            yield emit({'row': row, 'input': value, 'status': 'duplicate', 'duplicate_of': first_row[(kind, normalized)]})
+        else:
+            first_row[(kind, normalized)] = row
+            to_resolve.append((row, value, kind, normalized))
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {
+            executor.submit(resolve_entry, kind, normalized): (row, value)
+            for row, value, kind, normalized in to_resolve
+        }
+        # Se chi legge smette (es. il client chiude la connessione), le ricerche non ancora partite vengono annullate
+        try:
+            # Gli esiti arrivano nell'ordine in cui le ricerche finiscono
+            for future in as_completed(futures):
+                row, value = futures[future]
+                result = {'row': row, 'input': value}
+                try:
+                    book = future.result()
+                except Exception as e:
+                    logger.warning("Importazione fallita per '%s'. Causa: %s", value, e)
+                    yield emit({**result, 'status': 'error', 'error': str(e)})
+                    continue
+                if not book or not book.get('google_books_id'):
+                    yield emit({**result, 'status': 'not_found'})
+                    continue
+
+                result.update(title=book['title'], author=book['author'], google_books_id=book['google_books_id'])
+                pending.append((result, book))
+                if len(pending) >= batch_size:
+                    yield from flush()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    if pending:
+        yield from flush()
+
+    yield {'done': True, 'total': len(entries), 'counts': counts}
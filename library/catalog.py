@@ -0,0 +1,211 @@
+# In library/catalog.py
+"""
+Esportazione e importazione dell'intero catalogo (stanze, librerie con il
+loro layout, libri) in JSONL o CSV, in streaming.
+
+Ogni record ha un campo "type" (room, bookshelf, book) e l'id che aveva nel
+database di origine. L'ordine è sempre: stanze, librerie, libri, così chi
+importa conosce già la libreria di ogni libro.
+
+- L'esportazione legge il database a blocchi (values().iterator(chunk_size))
+  e produce una riga alla volta: la memoria usata non dipende dal numero di
+  libri.
+- L'importazione legge una riga alla volta e salva i libri con bulk_create,
+  a blocchi, tutto in una sola transazione: un file con una riga sbagliata
+  non lascia un catalogo a metà (e ricaricarlo corretto non crea doppioni).
+  Stanze e librerie vengono sempre create nuove: in memoria teniamo solo la
+  corrispondenza tra i loro vecchi e nuovi id.
+"""
+import csv
+import io
+import json
+
+from django.conf import settings
+from django.db import DataError, IntegrityError, reset_queries, transaction
+
+from . import covers
+from .models import Book, Bookshelf, Room
+
+ROOM_FIELDS = ['id', 'name']
+BOOKSHELF_FIELDS = ['id', 'room_id', 'name', 'shelf_count', 'pos_x', 'pos_y', 'width', 'height', 'shape_type', 'rotation']
+BOOK_FIELDS = [
+    'id', 'bookshelf_id', 'shelf_number', 'title', 'author', 'summary', 'google_books_id',
+    'cover_url', 'published_date', 'average_rating', 'user_rating',
+]
+
+# Colonne del CSV: l'unione dei campi, con "type" in testa (le celle che non servono restano vuote)
+CSV_COLUMNS = ['type'] + list(dict.fromkeys(ROOM_FIELDS + BOOKSHELF_FIELDS + BOOK_FIELDS))
+
+_INT_FIELDS = {'id', 'room_id', 'bookshelf_id', 'shelf_count', 'pos_x', 'pos_y', 'width', 'height', 'rotation',
+               'shelf_number', 'user_rating'}
+_FLOAT_FIELDS = {'average_rating'}
+# Campi che nel modello ammettono NULL: nel CSV la cella vuota vale None
+_NULLABLE_FIELDS = {'google_books_id', 'cover_url', 'published_date', 'average_rating', 'user_rating'}
+# Campi dei libri senza default: con bulk_create(ignore_conflicts=True) un NULL
+# non darebbe errore, la riga verrebbe scartata in silenzio
+_REQUIRED_BOOK_FIELDS = {'title', 'shelf_number'}
+
+
+class CatalogFormatError(ValueError):
+    """Una riga del file da importare non è leggibile."""
+
+
+def export_records(chunk_size=None):
+    """Tutti i record del catalogo, come dizionari, letti dal database a blocchi."""
+    chunk_size = chunk_size or settings.CATALOG_CHUNK_SIZE
+    for record_type, model, fields in (
+        ('room', Room, ROOM_FIELDS),
+        ('bookshelf', Bookshelf, BOOKSHELF_FIELDS),
+        ('book', Book, BOOK_FIELDS),
+    ):
+        for values in model.objects.order_by('id').values(*fields).iterator(chunk_size=chunk_size):
+            yield {'type': record_type, **values}
+
+
+def export_jsonl(chunk_size=None):
+    """Il catalogo in JSONL: una riga (str) per record."""
+    for record in export_records(chunk_size):
+        yield json.dumps(record, ensure_ascii=False) + "\n"
+
+
+def export_csv(chunk_size=None):
+    """Il catalogo in CSV: intestazione e poi una riga (str) per record."""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CSV_COLUMNS)
+
+    def flush():
+        line = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return line
+
+    writer.writeheader()
+    yield flush()
+    for record in export_records(chunk_size):
+        writer.writerow(record)
+        yield flush()
+
+
+def read_jsonl(lines):
+    for number, line in enumerate(lines, start=1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError as e:
+            raise CatalogFormatError(f"Riga {number}: JSON non valido ({e})")
+
+
+def _from_csv(row):
+    record = {'type': row.get('type')}
+    for field, value in row.items():
+        if field == 'type' or field is None:
+            continue
+        if value == '':
+            if field in _NULLABLE_FIELDS:
+                record[field] = None
+            continue
+        if field in _INT_FIELDS:
+            value = int(value)
+        elif field in _FLOAT_FIELDS:
+            value = float(value)
+        record[field] = value
+    return record
+
+
+def read_csv(lines):
+    # csv.reader vuole righe di testo: decodifichiamo al volo, senza leggere tutto il file
+    lines = (line.decode('utf-8-sig') if isinstance(line, bytes) else line for line in lines)
+    for number, row in enumerate(csv.DictReader(lines), start=2):
+        try:
+            yield _from_csv(row)
+        except ValueError as e:
+            raise CatalogFormatError(f"Riga {number}: {e}")
+
+
+def _fields(record, fields):
+    return {field: record[field] for field in fields if field in record and field not in ('id', 'room_id', 'bookshelf_id')}
+
+
+def _check_book(record):
+    for field in BOOK_FIELDS:
+        if field in ('id', 'bookshelf_id') or field in _NULLABLE_FIELDS:
+            continue
+        if record.get(field) is None and (field in record or field in _REQUIRED_BOOK_FIELDS):
+            raise ValueError(f"il libro non ha il campo '{field}'")
+
+
+def import_records(records, batch_size=None):
+    """
+    Importa i record (vedi export_records) creando nuove stanze, librerie e libri,
+    in una sola transazione: se un record non è valido viene sollevato
+    CatalogFormatError e non resta salvato niente. I libri vengono scritti a
+    blocchi di `batch_size`. Restituisce i conteggi {'rooms', 'bookshelves',
+    'books', 'skipped'}: 'books' sono i libri davvero inseriti, quelli scartati
+    (google_books_id ripetuto nella stessa libreria) finiscono in 'skipped'.
+    """
+    batch_size = batch_size or settings.CATALOG_CHUNK_SIZE
+    room_ids = {}
+    bookshelf_ids = {}
+    counts = {'rooms': 0, 'bookshelves': 0, 'books': 0, 'skipped': 0}
+    books = []
+
+    def flush():
+        # Le librerie sono nuove e solo nostre: quanti libri contengono prima e
+        # dopo è quanti ne abbiamo inseriti davvero
+        shelves = Book.objects.filter(bookshelf_id__in={book.bookshelf_id for book in books})
+        before = shelves.count()
+        try:
+            # ignore_conflicts: un google_books_id ripetuto nella stessa libreria viene scartato
+            Book.objects.bulk_create(books, ignore_conflicts=True)
+        except (IntegrityError, DataError, TypeError, ValueError) as e:
+            raise CatalogFormatError(f"Libri non validi: {e}")
+        inserted = shelves.count() - before
+        covers.enqueue(book.cover_url for book in books)
+        counts['books'] += inserted
+        counts['skipped'] += len(books) - inserted
+        books.clear()
+        # Con DEBUG=True Django conserva il testo delle ultime 9000 query: con INSERT
+        # da centinaia di righe sono centinaia di MB, quindi lo svuotiamo ad ogni blocco
+        reset_queries()
+
+    def import_record(record):
+        record_type = record.get('type')
+        if record_type == 'room':
+            room_ids[record['id']] = Room.objects.create(**_fields(record, ROOM_FIELDS)).id
+            counts['rooms'] += 1
+        elif record_type == 'bookshelf':
+            room_id = room_ids.get(record.get('room_id'))
+            if room_id is None:
+                counts['skipped'] += 1
+                return
+            bookshelf = Bookshelf.objects.create(room_id=room_id, **_fields(record, BOOKSHELF_FIELDS))
+            bookshelf_ids[record['id']] = bookshelf.id
+            counts['bookshelves'] += 1
+        elif record_type == 'book':
+            bookshelf_id = bookshelf_ids.get(record.get('bookshelf_id'))
+            if bookshelf_id is None:
+                counts['skipped'] += 1
+                return
+            _check_book(record)
+            books.append(Book(bookshelf_id=bookshelf_id, **_fields(record, BOOK_FIELDS)))
+            if len(books) >= batch_size:
+                flush()
+        else:
+            counts['skipped'] += 1
+
+    with transaction.atomic():
+        for number, record in enumerate(records, start=1):
+            try:
+                import_record(record)
+            except CatalogFormatError:
+                raise
+            except (AttributeError, KeyError, TypeError, ValueError, IntegrityError, DataError) as e:
+                # Campo mancante o di tipo sbagliato, record che non è un oggetto...
+                raise CatalogFormatError(f"Record {number}: {e}")
+        if books:
+            flush()
+    return counts
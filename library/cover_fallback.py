@@ -0,0 +1,129 @@
+# In library/cover_fallback.py
+"""
+Piano B per le copertine: ricerca su Google Immagini, in background.
+
+Prima la ricerca partiva dentro ogni lookup su Google Books senza copertina:
+una pagina di Google Immagini scaricata e analizzata per ogni libro, anche
+per quelli già cercati, mentre l'utente aspettava.
+
+Ora:
+- Quando un libro senza copertina viene salvato, si guarda prima se la sua
+  copertina è già stata trovata (CoverSearch 'found') e la si usa subito;
+  altrimenti il libro viene messo in coda (una riga per google_books_id).
+- Il worker `python manage.py fetch_covers` esegue le ricerche in coda,
+  aggiorna i libri con la copertina trovata e la passa alla cache locale
+  (library/covers.py).
+- L'esito "nessuna copertina" resta salvato: quel libro non viene più cercato.
+  Gli errori di rete invece vengono ritentati con backoff, come i download.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from . import book_scraper, covers
+from .models import Book, CoverSearch
+
+logger = logging.getLogger(__name__)
+
+
+def apply_known_covers(books):
+    """
+    Completa i libri (non ancora salvati) senza copertina: usa quelle già
+    trovate e mette in coda la ricerca per gli altri. Al massimo due query.
+    """
+    missing = {book.google_books_id: book for book in books if book.google_books_id and not book.cover_url}
+    if not missing:
+        return
+
+    known = dict(
+        CoverSearch.objects.filter(google_books_id__in=missing, status='found')
+        .values_list('google_books_id', 'cover_url')
+    )
+    for google_id, cover_url in known.items():
+        missing.pop(google_id).cover_url = cover_url
+
+    # ignore_conflicts: i libri già cercati (anche senza successo) non tornano in coda
+    CoverSearch.objects.bulk_create(
+        [CoverSearch(google_books_id=google_id, title=book.title[:200]) for google_id, book in missing.items()],
+        ignore_conflicts=True,
+    )
+
+
+def enqueue_missing(batch_size=1000):
+    """Mette in coda la ricerca per tutti i libri già salvati senza copertina."""
+    books = (
+        Book.objects.filter(Q(cover_url__isnull=True) | Q(cover_url=''))
+        .exclude(google_books_id__isnull=True).exclude(google_books_id='')
+        .values_list('google_books_id', 'title')
+    )
+    batch = []
+    for google_id, title in books.iterator(chunk_size=batch_size):
+        batch.append(CoverSearch(google_books_id=google_id, title=title[:200]))
+        if len(batch) >= batch_size:
+            CoverSearch.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    CoverSearch.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+def _search(search):
+    """Ricerca su Google Immagini, senza accessi al DB. Restituisce (url o None, errore)."""
+    try:
+        return book_scraper.search_cover_on_google_images(search.title), None
+    except Exception as e:
+        logger.warning("Errore durante lo scraping di Google Immagini per '%s': %s", search.title, e)
+        return None, e
+
+
+def _finish(search, cover_url, error):
+    now = timezone.now()
+    search.attempts += 1
+    # Book.cover_url è un URLField da 200 caratteri: un URL più lungo non è utilizzabile
+    if cover_url and len(cover_url) <= Book._meta.get_field('cover_url').max_length:
+        search.status = 'found'
+        search.cover_url = cover_url
+        Book.objects.filter(Q(cover_url__isnull=True) | Q(cover_url=''), google_books_id=search.google_books_id).update(
+            cover_url=cover_url,
+        )
+        covers.enqueue([cover_url])
+    elif error is None or search.attempts >= settings.COVER_MAX_ATTEMPTS:
+        search.status = 'not_found'
+    else:
+        search.next_attempt_at = now + timedelta(seconds=covers.retry_delay(search.attempts))
+    search.error = str(error) if error else ''
+    search.searched_at = now
+    search.save()
+    return search
+
+
+def run_searches(searches, max_workers=None):
+    """Esegue le ricerche già prenotate (il limite per host di http_client le mette in fila)."""
+    if not searches:
+        return []
+    max_workers = max(1, min(max_workers or settings.COVER_FETCH_WORKERS, len(searches)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(_search, searches))
+    return [_finish(search, *result) for search, result in zip(searches, results)]
+
+
+def run_pending_searches(limit=None):
+    """Esegue le ricerche in coda finché ce ne sono (o fino a `limit`). Restituisce quante ne ha fatte."""
+    processed = 0
+    batch_size = settings.COVER_FETCH_WORKERS * 4
+    while limit is None or processed < limit:
+        if limit is not None:
+            batch_size = min(batch_size, limit - processed)
+        searches = covers.claim_due(CoverSearch, batch_size)
+        if not searches:
+            break
+        run_searches(searches)
+        processed += len(searches)
+    return processed
+
+
+def stats():
+    counts = dict(CoverSearch.objects.values_list('status').annotate(total=Count('id')).order_by())
+    return {status: counts.get(status, 0) for status, _ in CoverSearch.STATUS_CHOICES}
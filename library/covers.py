@@ -0,0 +1,289 @@
+# In library/covers.py
+"""
+Cache locale delle copertine dei libri.
+
+Le pagine non puntano più direttamente a Google Books (o all'immagine
+trovata su Google Immagini): ogni cover_url diventa /covers/<sha256 dell'URL>/.
+
+- Quando un libro viene salvato, la sua copertina viene messa in coda
+  (enqueue): una riga CoverImage per URL.
+- Il comando `python manage.py fetch_covers` la scarica una volta sola, la
+  salva in COVER_CACHE_DIR con il nome dato dallo SHA-256 del contenuto e
+  ne ricava con OpenCV una miniatura JPEG di dimensione fissa.
+- La view la serve con Cache-Control di lunga durata ed ETag; finché non è
+  pronta reindirizza all'URL originale, quindi le pagine non cambiano aspetto.
+- Un download fallito viene ritentato con attesa crescente (COVER_RETRY_BASE,
+  raddoppiata ad ogni errore) e abbandonato dopo COVER_MAX_ATTEMPTS tentativi,
+  invece di riprovarlo ad ogni visualizzazione.
+- Gli URL arrivano da fuori (Google, admin, file importati): il download
+  legge il corpo a pezzi e si ferma oltre COVER_MAX_BYTES, e rifiuta gli host
+  che risolvono a indirizzi interni (rete privata, loopback...), anche dopo
+  un redirect.
+"""
+import hashlib
+import ipaddress
+import logging
+import os
+import socket
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from pathlib import Path
+from urllib.parse import urljoin, urlparse
+
+from django.conf import settings
+from django.db.models import Count
+from django.urls import reverse
+from django.utils import timezone
+
+from . import image_utils
+from .http_client import http_client
+from .models import Book, CoverImage
+
+logger = logging.getLogger(__name__)
+
+# Formati salvati così come arrivano (la miniatura è sempre JPEG)
+_EXTENSIONS = {'image/jpeg': '.jpg', 'image/png': '.png', 'image/gif': '.gif', 'image/webp': '.webp'}
+# Redirect seguiti al massimo per un download (ognuno controllato come il primo URL)
+_MAX_REDIRECTS = 5
+_CHUNK_SIZE = 64 * 1024
+
+
+def url_hash(url):
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+
+def thumbnail_url(url):
+    """Indirizzo locale della miniatura di una cover_url."""
+    return reverse('cover-thumbnail', args=[url_hash(url)])
+
+
+def image_url(url):
+    """Indirizzo locale della copertina a grandezza originale."""
+    return reverse('cover-image', args=[url_hash(url)])
+
+
+def _path(content_hash, suffix):
+    # Sottocartelle per i primi due caratteri: niente cartelle con centinaia di migliaia di file
+    return Path(settings.COVER_CACHE_DIR) / content_hash[:2] / f"{content_hash}{suffix}"
+
+
+def image_path(content_hash, mime_type):
+    return _path(content_hash, _EXTENSIONS.get(mime_type, '.img'))
+
+
+def thumbnail_path(content_hash):
+    return _path(content_hash, '-thumb.jpg')
+
+
+def _write_atomic(path, data):
+    """Scrive il file con un rename finale: chi lo legge non vede mai un file a metà."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            tmp.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def make_thumbnail(image):
+    """Miniatura JPEG (byte) che sta in COVER_THUMBNAIL_WIDTH x COVER_THUMBNAIL_HEIGHT."""
+    resized = image_utils.resize_to_fit(image, settings.COVER_THUMBNAIL_WIDTH, settings.COVER_THUMBNAIL_HEIGHT)
+    return image_utils.encode_jpeg(resized, settings.COVER_THUMBNAIL_JPEG_QUALITY)
+
+
+def store_image(data):
+    """
+    Salva l'immagine e la sua miniatura (se non ci sono già) e restituisce
+    (content_hash, mime_type). ValueError se i byte non sono un'immagine.
+    """
+    mime_type = image_utils.detect_mime_type(data)
+    if mime_type not in _EXTENSIONS:
+        raise ValueError(f"Formato non supportato ({mime_type})")
+    content_hash = hashlib.sha256(data).hexdigest()
+
+    original = image_path(content_hash, mime_type)
+    thumbnail = thumbnail_path(content_hash)
+    if not (original.exists() and thumbnail.exists()):
+        image = image_utils.decode_image(data)
+        if image is None:
+            raise ValueError("Immagine non leggibile")
+        _write_atomic(original, data)
+        _write_atomic(thumbnail, make_thumbnail(image))
+    return content_hash, mime_type
+
+
+def enqueue(urls):
+    """Mette in coda le copertine non ancora note (una query, qualunque sia il numero di URL)."""
+    urls = {url for url in urls if url and url.startswith(('http://', 'https://'))}
+    if urls:
+        CoverImage.objects.bulk_create(
+            [CoverImage(url_hash=url_hash(url), source_url=url) for url in urls],
+            ignore_conflicts=True,
+        )
+
+
+def enqueue_saved_book(sender, instance, update_fields=None, **kwargs):
+    """
+    Ricevitore di post_save dei libri: anche una cover_url cambiata fuori
+    dalle view (admin, shell) finisce in coda.
+    """
+    if update_fields is None or 'cover_url' in update_fields:
+        enqueue([instance.cover_url])
+
+
+def enqueue_missing(batch_size=1000):
+    """Mette in coda le copertine di tutti i libri (es. dopo modifiche dall'admin)."""
+    urls = Book.objects.exclude(cover_url__isnull=True).exclude(cover_url='').values_list('cover_url', flat=True).distinct()
+    batch = []
+    for url in urls.iterator(chunk_size=batch_size):
+        batch.append(url)
+        if len(batch) >= batch_size:
+            enqueue(batch)
+            batch = []
+    enqueue(batch)
+
+
+def claim_due(model, limit):
+    """
+    Prenota fino a `limit` righe 'pending' di `model` (CoverImage o
+    CoverSearch) il cui next_attempt_at è passato. La prenotazione sposta
+    next_attempt_at di COVER_FETCH_LEASE secondi (UPDATE condizionato, come in
+    ingestion.claim_images): se il worker si ferma, la riga torna da sola
+    disponibile allo scadere del tempo.
+    """
+    now = timezone.now()
+    lease_until = now + timedelta(seconds=settings.COVER_FETCH_LEASE)
+    due = model.objects.filter(status='pending', next_attempt_at__lte=now).order_by('next_attempt_at', 'id')
+    claimed_ids = []
+    for row_id, next_attempt_at in due.values_list('id', 'next_attempt_at')[:limit * 2]:
+        claimed = model.objects.filter(pk=row_id, status='pending', next_attempt_at=next_attempt_at).update(
+            next_attempt_at=lease_until,
+        )
+        if claimed:
+            claimed_ids.append(row_id)
+            if len(claimed_ids) >= limit:
+                break
+    return list(model.objects.filter(pk__in=claimed_ids).order_by('id'))
+
+
+def check_public_url(url):
+    """ValueError se l'URL non è http(s) o se il suo host risolve a un indirizzo non pubblico."""
+    parsed = urlparse(url)
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        raise ValueError(f"URL non valido: {url}")
+    for *_, sockaddr in socket.getaddrinfo(parsed.hostname, parsed.port, type=socket.SOCK_STREAM):
+        address = ipaddress.ip_address(sockaddr[0].split('%')[0])
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        if not address.is_global or address.is_multicast:
+            raise ValueError(f"Indirizzo non pubblico ({address}) per {parsed.hostname}")
+
+
+def _read_limited(response, limit):
+    """Il corpo della risposta, letto a pezzi: ValueError appena supera `limit` byte."""
+    declared = response.headers.get('Content-Length', '')
+    if declared.isdigit() and int(declared) > limit:
+        raise ValueError(f"Immagine troppo grande ({declared} byte)")
+    data = bytearray()
+    for chunk in response.iter_content(_CHUNK_SIZE):
+        data += chunk
+        if len(data) > limit:
+            raise ValueError(f"Immagine troppo grande (oltre {limit} byte)")
+    return bytes(data)
+
+
+def download_image(url):
+    """
+    Byte dell'immagine all'URL. I redirect sono seguiti qui, uno alla volta,
+    così ogni indirizzo passa da check_public_url prima di essere contattato.
+    """
+    for _ in range(_MAX_REDIRECTS + 1):
+        check_public_url(url)
+        response = http_client.get(url, timeout=settings.BOOK_LOOKUP_TIMEOUT, stream=True, allow_redirects=False)
+        try:
+            if response.is_redirect:
+                url = urljoin(url, response.headers['Location'])
+                continue
+            response.raise_for_status()
+            return _read_limited(response, settings.COVER_MAX_BYTES)
+        finally:
+            response.close()
+    raise ValueError(f"Troppi redirect (più di {_MAX_REDIRECTS})")
+
+
+def _download(cover):
+    """Scarica e salva una copertina, senza accessi al DB. Restituisce (content_hash, mime_type, errore)."""
+    try:
+        return (*store_image(download_image(cover.source_url)), None)
+    except Exception as e:
+        logger.warning("Copertina non scaricata (%s). Causa: %s", cover.source_url, e)
+        return None, None, e
+
+
+def retry_delay(attempts):
+    """Attesa prima del prossimo tentativo dopo `attempts` errori."""
+    return min(settings.COVER_RETRY_MAX, settings.COVER_RETRY_BASE * 2 ** (attempts - 1))
+
+
+def _finish(cover, content_hash, mime_type, error):
+    now = timezone.now()
+    cover.attempts += 1
+    if error is None:
+        cover.status = 'done'
+        cover.content_hash = content_hash
+        cover.mime_type = mime_type
+        cover.fetched_at = now
+        cover.error = ''
+    else:
+        cover.error = str(error)
+        if cover.attempts >= settings.COVER_MAX_ATTEMPTS:
+            cover.status = 'failed'
+        cover.next_attempt_at = now + timedelta(seconds=retry_delay(cover.attempts))
+    cover.save()
+    return cover
+
+
+def fetch_covers(covers, max_workers=None):
+    """Scarica in parallelo le copertine già prenotate; le scritture sul DB avvengono alla fine, qui."""
+    if not covers:
+        return []
+    max_workers = max(1, min(max_workers or settings.COVER_FETCH_WORKERS, len(covers)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(_download, covers))
+    return [_finish(cover, *result) for cover, result in zip(covers, results)]
+
+
+def fetch_pending_covers(limit=None):
+    """Scarica le copertine in coda finché ce ne sono (o fino a `limit`). Restituisce quante ne ha provate."""
+    processed = 0
+    batch_size = settings.COVER_FETCH_WORKERS * 4
+    while limit is None or processed < limit:
+        if limit is not None:
+            batch_size = min(batch_size, limit - processed)
+        covers = claim_due(CoverImage, batch_size)
+        if not covers:
+            break
+        fetch_covers(covers)
+        processed += len(covers)
+    return processed
+
+
+def cached_file(cover, full=False):
+    """
+    Percorso del file da servire per una copertina scaricata, oppure None.
+    Se i file sono spariti (es. cartella svuotata), la copertina torna in coda.
+    """
+    path = image_path(cover.content_hash, cover.mime_type) if full else thumbnail_path(cover.content_hash)
+    if path.exists():
+        return path
+    CoverImage.objects.filter(pk=cover.pk).update(status='pending', attempts=0, next_attempt_at=timezone.now())
+    return None
+
+
+def stats():
+    counts = dict(CoverImage.objects.values_list('status').annotate(total=Count('id')).order_by())
+    return {status: counts.get(status, 0) for status, _ in CoverImage.STATUS_CHOICES}
@@ -0,0 +1,402 @@
+# In library/http_client.py
+"""
+Client HTTP condiviso per tutte le chiamate verso l'esterno
+(Google Books, Google Immagini, Amazon).
+
+- Una sola requests.Session con pool di connessioni keep-alive: niente
+  nuovo handshake TLS ad ogni ricerca.
+- Timeout sempre presente (HTTP_TIMEOUT se il chiamante non ne indica uno).
+- Limite di richieste al secondo per ogni host (token bucket).
+- Nuovi tentativi con attesa esponenziale "jitterata" sugli errori di rete,
+  sulle risposte 429 e sugli errori 5xx (solo per GET/HEAD).
+- Circuit breaker per host: dopo HTTP_CIRCUIT_FAILURES fallimenti di fila
+  l'host viene saltato per HTTP_CIRCUIT_RESET secondi (CircuitOpenError),
+  così un servizio giù non blocca i worker.
+- Statistiche di latenza per host, visibili in /api/cache-stats/.
+
+async_http_client è la versione asyncio (httpx) per le view async: stesse
+regole, e limiti, circuit breaker e statistiche condivisi con http_client.
+"""
+import asyncio
+import contextlib
+import logging
+import random
+import threading
+import time
+import weakref
+from collections import deque
+from urllib.parse import urlparse
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from . import instrumentation
+from .lazy_imports import lazy_import
+
+logger = logging.getLogger(__name__)
+
+# Serve solo alle view async: caricato al primo utilizzo
+httpx = lazy_import('httpx')
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RETRY_METHODS = {'GET', 'HEAD'}
+
+
+class CircuitOpenError(requests.RequestException):
+    """L'host ha fallito troppe volte di fila: la richiesta non è stata nemmeno inviata."""
+
+
+class TokenBucket:
+    """`rate` richieste al secondo, con raffiche fino a `capacity`. rate <= 0 = nessun limite."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Prenota un gettone e restituisce quanti secondi bisogna aspettare prima di usarlo."""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # Il gettone viene prenotato subito (anche in negativo), così i thread
+            # in attesa si mettono in fila invece di svegliarsi tutti insieme
+            self._tokens -= 1
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+    def acquire(self):
+        """Prende un gettone, aspettando se necessario. Restituisce i secondi di attesa."""
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class CircuitBreaker:
+    """Interruttore chiuso -> aperto (dopo troppi errori) -> mezzo aperto (una richiesta di prova)."""
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.failure_threshold > 0 and (self.failures >= self.failure_threshold or self.opened_at is not None):
+                self.opened_at = time.monotonic()
+
+    def release(self):
+        """Chiude la richiesta di prova senza contarla: né successo né errore dell'host (es. annullata)."""
+        with self._lock:
+            self._trial_running = False
+
+
+class HostStats:
+    """Contatori e latenze (ultime `window` richieste) di un host."""
+
+    def __init__(self, window=500):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.rejected = 0
+        self.throttled_seconds = 0.0
+        self.latencies = deque(maxlen=window)
+
+    def as_dict(self):
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 1)
+
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'retries': self.retries,
+            'rejected': self.rejected,
+            'throttled_seconds': round(self.throttled_seconds, 3),
+            'avg_ms': round(sum(latencies) / len(latencies) * 1000, 1) if latencies else None,
+            'p50_ms': percentile(0.50),
+            'p95_ms': percentile(0.95),
+            'max_ms': round(latencies[-1] * 1000, 1) if latencies else None,
+        }
+
+
+class HttpClient:
+
+    def __init__(self, pool_size=16, timeout=10.0, max_retries=3, backoff_base=0.5, backoff_max=8.0,
+                 rate_limits=None, default_rate_limit=0, rate_burst=5,
+                 circuit_failures=5, circuit_reset=30.0):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rate_limits = rate_limits or {}
+        self.default_rate_limit = default_rate_limit
+        self.rate_burst = rate_burst
+        self.circuit_failures = circuit_failures
+        self.circuit_reset = circuit_reset
+
+        # I nuovi tentativi li gestiamo noi (con backoff e statistiche), non urllib3
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._breakers = {}
+        self._stats = {}
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            pool_size=settings.HTTP_POOL_SIZE,
+            timeout=settings.HTTP_TIMEOUT,
+            max_retries=settings.HTTP_MAX_RETRIES,
+            backoff_base=settings.HTTP_BACKOFF_BASE,
+            backoff_max=settings.HTTP_BACKOFF_MAX,
+            rate_limits=settings.HTTP_RATE_LIMITS,
+            default_rate_limit=settings.HTTP_DEFAULT_RATE_LIMIT,
+            rate_burst=settings.HTTP_RATE_BURST,
+            circuit_failures=settings.HTTP_CIRCUIT_FAILURES,
+            circuit_reset=settings.HTTP_CIRCUIT_RESET,
+        )
+
+    def _for_host(self, host):
+        """(bucket, breaker, stats) dell'host, creati al primo utilizzo."""
+        with self._lock:
+            if host not in self._stats:
+                rate = self.rate_limits.get(host, self.default_rate_limit)
+                self._buckets[host] = TokenBucket(rate, self.rate_burst)
+                self._breakers[host] = CircuitBreaker(self.circuit_failures, self.circuit_reset)
+                self._stats[host] = HostStats()
+            return self._buckets[host], self._breakers[host], self._stats[host]
+
+    def _backoff(self, attempt, response=None):
+        """Attesa prima del tentativo successivo: Retry-After se presente, altrimenti "full jitter"."""
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _open_circuit(self, url, method):
+        """(host, bucket, breaker, stats, tentativi massimi), o CircuitOpenError se l'host è sospeso."""
+        host = urlparse(url).hostname or ''
+        bucket, breaker, stats = self._for_host(host)
+        if not breaker.allow():
+            with self._lock:
+                stats.rejected += 1
+            raise CircuitOpenError(f"Troppi errori da {host}: richieste sospese per {self.circuit_reset:.0f}s")
+        return host, bucket, breaker, stats, self.max_retries if method in RETRY_METHODS else 0
+
+    def _record(self, host, stats, waited, elapsed=None, failed=False):
+        with self._lock:
+            stats.requests += 1
+            stats.errors += failed
+            stats.throttled_seconds += waited
+            if elapsed is not None:
+                stats.latencies.append(elapsed)
+        instrumentation.increment('http_client_requests', host=host, outcome='error' if failed else 'ok')
+        if elapsed is not None:
+            instrumentation.observe('http_client_request', elapsed, host=host)
+
+    def _retry_delay(self, stats, attempt, method, host, response=None, error=None):
+        delay = self._backoff(attempt, response)
+        logger.debug("%s %s fallita (%s), nuovo tentativo tra %.1fs",
+                     method, host, response.status_code if response is not None else error, delay)
+        with self._lock:
+            stats.retries += 1
+        return delay
+
+    def request(self, method, url, timeout=None, **kwargs):
+        method = method.upper()
+        host, bucket, breaker, stats, max_retries = self._open_circuit(url, method)
+        kwargs['timeout'] = timeout or self.timeout
+        try:
+            return self._send(method, url, host, bucket, breaker, stats, max_retries, kwargs)
+        except requests.RequestException:
+            breaker.record_failure()
+            raise
+        except BaseException:
+            # Un errore che non viene dall'host (es. un nostro bug, un'interruzione) non
+            # conta come fallimento, ma chiude comunque l'eventuale richiesta di prova:
+            # col circuito mezzo aperto l'host non resta bloccato
+            breaker.release()
+            raise
+
+    def _send(self, method, url, host, bucket, breaker, stats, max_retries, kwargs):
+        attempt = 0
+        while True:
+            waited = bucket.acquire()
+            start = time.monotonic()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._record(host, stats, waited, failed=True)
+                if attempt >= max_retries:
+                    raise
+                response, error = None, e
+            else:
+                failed = response.status_code in RETRY_STATUSES
+                self._record(host, stats, waited, time.monotonic() - start, failed)
+                if not failed:
+                    breaker.record_success()
+                    return response
+                if attempt >= max_retries:
+                    breaker.record_failure()
+                    return response
+                error = None
+
+            time.sleep(self._retry_delay(stats, attempt, method, host, response, error))
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            hosts = {host: stats.as_dict() for host, stats in self._stats.items()}
+            for host, stats in hosts.items():
+                stats['circuit'] = self._breakers[host].state
+        return hosts
+
+    def reset_stats(self):
+        with self._lock:
+            for host in self._stats:
+                self._stats[host] = HostStats()
+
+
+class AsyncHttpClient:
+    """
+    Versione asyncio di HttpClient, basata su httpx.AsyncClient. Limiti per
+    host, circuit breaker e statistiche sono quelli del client sincrono: le
+    view async e il resto del codice si dividono lo stesso budget di richieste.
+
+    Un AsyncClient è legato al suo event loop, e sotto WSGI ogni richiesta
+    async ha un loop tutto suo: di norma ogni chiamata apre un client e lo
+    chiude alla fine. Solo nei loop di lunga durata registrati con
+    keep_alive() (il worker di ingestion.aprocess_images) il client, con le
+    sue connessioni, resta aperto e viene riusato.
+    """
+
+    def __init__(self, sync_client):
+        self.sync_client = sync_client
+        self._long_lived = weakref.WeakSet()
+        self._clients = weakref.WeakKeyDictionary()
+
+    def keep_alive(self, loop):
+        """Le richieste fatte in `loop` riusano un solo client finché il loop esiste."""
+        self._long_lived.add(loop)
+
+    def _new_client(self):
+        pool_size = self.sync_client.pool_size
+        return httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=pool_size * 4, max_keepalive_connections=pool_size),
+            timeout=self.sync_client.timeout,
+            # requests segue i redirect, httpx no: stesso comportamento per entrambi
+            follow_redirects=True,
+        )
+
+    @contextlib.asynccontextmanager
+    async def _client(self):
+        """Il client del loop corrente (vedi keep_alive), oppure uno nuovo chiuso all'uscita."""
+        loop = asyncio.get_running_loop()
+        if loop not in self._long_lived:
+            async with self._new_client() as client:
+                yield client
+            return
+        client = self._clients.get(loop)
+        if client is None:
+            client = self._clients[loop] = self._new_client()
+        yield client
+
+    async def request(self, method, url, timeout=None, **kwargs):
+        sync = self.sync_client
+        method = method.upper()
+        host, bucket, breaker, stats, max_retries = sync._open_circuit(url, method)
+        kwargs['timeout'] = timeout or sync.timeout
+        try:
+            async with self._client() as client:
+                return await self._send(client, method, url, host, bucket, breaker, stats, max_retries, kwargs)
+        except httpx.HTTPError:
+            breaker.record_failure()
+            raise
+        except BaseException:
+            # Come HttpClient.request: un annullamento (CancelledError) non è colpa
+            # dell'host, ma la richiesta di prova va comunque chiusa
+            breaker.release()
+            raise
+
+    async def _send(self, client, method, url, host, bucket, breaker, stats, max_retries, kwargs):
+        sync = self.sync_client
+        attempt = 0
+        while True:
+            waited = bucket.reserve()
+            if waited:
+                await asyncio.sleep(waited)
+            start = time.monotonic()
+            try:
+                response = await client.request(method, url, **kwargs)
+            except httpx.TransportError as e:
+                sync._record(host, stats, waited, failed=True)
+                if attempt >= max_retries:
+                    raise
+                response, error = None, e
+            else:
+                failed = response.status_code in RETRY_STATUSES
+                sync._record(host, stats, waited, time.monotonic() - start, failed)
+                if not failed:
+                    breaker.record_success()
+                    return response
+                if attempt >= max_retries:
+                    breaker.record_failure()
+                    return response
+                error = None
+
+            await asyncio.sleep(sync._retry_delay(stats, attempt, method, host, response, error))
+            attempt += 1
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+
+http_client = HttpClient.from_settings()
+async_http_client = AsyncHttpClient(http_client)
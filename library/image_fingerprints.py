@@ -0,0 +1,104 @@
+# In library/image_fingerprints.py
+"""
+Cache dei risultati del riconoscimento (Gemini o un altro backend di
+library/vision_backends.py) indicizzata per impronta percettiva (dHash).
+
+Capita spesso di ricaricare la stessa foto (o una quasi identica) di uno
+scaffale: invece di pagare un'altra chiamata al modello riusiamo l'elenco di
+titoli/autori già riconosciuto, se la distanza di Hamming tra le impronte è
+entro IMAGE_FINGERPRINT_MAX_DISTANCE bit.
+
+Il confronto avviene in Python, quindi limitiamo i candidati: solo le
+impronte usate più di recente (IMAGE_FINGERPRINT_SCAN_LIMIT), e solo quelle
+più giovani di IMAGE_FINGERPRINT_TTL, così anche un risultato sbagliato
+prima o poi viene rifatto. Le liste vuote non vengono salvate.
+"""
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import image_utils
+from .models import ShelfImageFingerprint
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0}
+
+
+def _count(name):
+    with _lock:
+        _stats[name] += 1
+
+
+def fingerprint_image(image):
+    """Impronta dHash dell'immagine (array NumPy) come stringa esadecimale."""
+    return format(image_utils.dhash(image), '064x')
+
+
+def find_cached_detections(fingerprint, backend='gemini'):
+    """
+    Cerca un'impronta già vista entro la soglia di distanza e ne restituisce
+    i libri riconosciuti da `backend` (o None). A parità di soglia vince la più vicina.
+    """
+    max_distance = settings.IMAGE_FINGERPRINT_MAX_DISTANCE
+    if max_distance < 0:
+        return None
+
+    target = int(fingerprint, 16)
+    best_id, best_distance = None, max_distance + 1
+    candidates = (
+        ShelfImageFingerprint.objects.filter(backend=backend, created_at__gte=_expires_before())
+        .order_by('-last_used_at').values_list('id', 'dhash')[:settings.IMAGE_FINGERPRINT_SCAN_LIMIT]
+    )
+    for fingerprint_id, dhash in candidates:
+        distance = image_utils.hamming_distance(target, int(dhash, 16))
+        if distance < best_distance:
+            best_id, best_distance = fingerprint_id, distance
+            if distance == 0:
+                break
+
+    if best_id is None:
+        _count('misses')
+        return None
+
+    _count('hits')
+    cached = ShelfImageFingerprint.objects.get(pk=best_id)
+    cached.hits += 1
+    cached.save(update_fields=['hits', 'last_used_at'])
+    logger.debug("Foto già vista (distanza %d bit): riuso %d libri senza analizzarla di nuovo", best_distance, len(cached.detections))
+    return cached.detections
+
+
+def _expires_before():
+    return timezone.now() - timedelta(seconds=settings.IMAGE_FINGERPRINT_TTL)
+
+
+def store_detections(fingerprint, detections, backend='gemini'):
+    """
+    Salva i libri riconosciuti in una foto, per le prossime foto quasi identiche.
+    Una lista vuota non viene salvata (foto sfocata, risposta sbagliata...):
+    la prossima foto simile verrà analizzata di nuovo.
+    """
+    if settings.IMAGE_FINGERPRINT_MAX_DISTANCE < 0 or not detections:
+        return None
+    ShelfImageFingerprint.objects.filter(created_at__lt=_expires_before()).delete()
+    return ShelfImageFingerprint.objects.create(dhash=fingerprint, detections=detections, backend=backend)
+
+
+def stats():
+    with _lock:
+        result = dict(_stats)
+    lookups = result['hits'] + result['misses']
+    result['hit_rate'] = result['hits'] / lookups if lookups else 0.0
+    result['max_distance'] = settings.IMAGE_FINGERPRINT_MAX_DISTANCE
+    return result
+
+
+def reset_stats():
+    with _lock:
+        for name in _stats:
+            _stats[name] = 0
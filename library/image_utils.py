@@ -0,0 +1,238 @@
+# In library/image_utils.py
+"""
+Preparazione delle foto prima dell'invio a Gemini, tutta in memoria.
+
+Le foto del telefono arrivano a piena risoluzione (10+ megapixel): per leggere
+le coste dei libri ne basta molta meno. Riducendo e ricomprimendo l'immagine
+con OpenCV mandiamo al modello molti meno byte e otteniamo risposte più rapide.
+"""
+from django.conf import settings
+
+from .lazy_imports import lazy_import
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+
+# Firme ("magic bytes") dei formati che Gemini accetta
+_SIGNATURES = [
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+]
+
+
+def detect_mime_type(data, default='application/octet-stream'):
+    """Riconosce il formato dell'immagine dai primi byte, senza fidarsi del nome del file."""
+    for signature, mime_type in _SIGNATURES:
+        if data.startswith(signature):
+            return mime_type
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    if data[4:8] == b'ftyp' and data[8:12] in (b'heic', b'heix', b'mif1', b'msf1'):
+        return 'image/heic'
+    return default
+
+
+def decode_image(data):
+    """Decodifica i byte di un'immagine in un array NumPy BGR (None se non è un'immagine valida)."""
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    if buffer.size == 0:
+        return None
+    return cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+
+
+def encode_jpeg(image, quality=None):
+    """Codifica un array NumPy BGR in JPEG."""
+    quality = quality or settings.GEMINI_IMAGE_JPEG_QUALITY
+    ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError("Impossibile codificare l'immagine in JPEG")
+    return encoded.tobytes()
+
+
+def resize_to_max_dimension(image, max_dimension):
+    """Riduce l'immagine in modo che il lato più lungo non superi max_dimension."""
+    height, width = image.shape[:2]
+    longest = max(height, width)
+    if longest <= max_dimension:
+        return image
+    scale = max_dimension / longest
+    new_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    # INTER_AREA è l'interpolazione migliore per rimpicciolire (niente aliasing sul testo)
+    return cv2.resize(image, new_size, interpolation=cv2.INTER_AREA)
+
+
+def resize_to_fit(image, max_width, max_height):
+    """Riduce l'immagine (mantenendo le proporzioni) perché stia in un riquadro max_width x max_height."""
+    height, width = image.shape[:2]
+    scale = min(max_width / width, max_height / height)
+    if scale >= 1:
+        return image
+    new_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv2.resize(image, new_size, interpolation=cv2.INTER_AREA)
+
+
+def _longest_piece(image, max_aspect=None):
+    """Lato più lungo di ciò che arriverà al modello: l'intera foto o, se verrà divisa, un tassello."""
+    max_aspect = max_aspect or settings.SHELF_TILE_MAX_ASPECT
+    height, width = image.shape[:2]
+    return max(height, min(width, int(height * max_aspect)))
+
+
+def prepare_image_for_model(data, max_dimension=None, quality=None):
+    """
+    Riduce e ricomprime l'immagine per l'invio al modello.
+    Restituisce (byte, mime_type). Se OpenCV non riesce a decodificarla
+    (es. HEIC), l'immagine viene inviata così com'è con il suo vero mime type.
+
+    Le foto che verranno divise in tasselli (vedi split_into_tiles) vengono
+    ridotte solo quanto basta perché ogni tassello stia in max_dimension, e
+    ricompresse con SHELF_TILE_SOURCE_JPEG_QUALITY: ridurle come una foto
+    normale butterebbe via proprio la risoluzione che i tasselli devono dare.
+    """
+    max_dimension = max_dimension or settings.GEMINI_IMAGE_MAX_DIMENSION
+    original_mime = detect_mime_type(data)
+
+    image = decode_image(data)
+    if image is None:
+        return data, original_mime
+
+    longest, piece = max(image.shape[:2]), _longest_piece(image)
+    if piece < longest:
+        max_dimension = max_dimension * longest // piece
+        quality = quality or settings.SHELF_TILE_SOURCE_JPEG_QUALITY
+    resized = resize_to_max_dimension(image, max_dimension)
+    encoded = encode_jpeg(resized, quality)
+
+    # Un JPEG piccolo già compresso potrebbe "ingrassare" se ricompresso: teniamo l'originale
+    if resized is image and original_mime == 'image/jpeg' and len(encoded) >= len(data):
+        return data, original_mime
+    return encoded, 'image/jpeg'
+
+
+# --- SUDDIVISIONE DELLE FOTO LARGHE IN TASSELLI ---
+def vertical_edge_profile(image):
+    """
+    Intensità dei bordi verticali per ogni colonna dell'immagine.
+    I picchi corrispondono (quasi sempre) allo stacco tra due coste di libri.
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    edges = np.abs(cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3))
+    profile = edges.sum(axis=0)
+    # Leggera media mobile per non inseguire il rumore di un singolo pixel
+    kernel = np.ones(5, dtype=np.float32) / 5
+    return np.convolve(profile, kernel, mode='same')
+
+
+def find_spine_cuts(image, tile_width, search_window=None):
+    """
+    Colonne in cui tagliare l'immagine: vicino a ogni multiplo di tile_width
+    scegliamo la colonna con il bordo verticale più forte, così il taglio
+    cade tra due libri invece che a metà di una costa.
+    """
+    width = image.shape[1]
+    if width <= tile_width:
+        return []
+
+    profile = vertical_edge_profile(image)
+    search_window = search_window or max(1, tile_width // 5)
+    cuts = []
+    position = tile_width
+    while position < width - search_window:
+        start = max(1, position - search_window)
+        end = min(width - 1, position + search_window)
+        cut = start + int(np.argmax(profile[start:end]))
+        cuts.append(cut)
+        position = cut + tile_width
+    return cuts
+
+
+def find_spine_boundaries(image, min_spine_width=None):
+    """
+    Colonne di stacco tra una costa e l'altra in tutta l'immagine (ordinate):
+    i picchi del profilo dei bordi verticali più forti della media, a
+    distanza di almeno min_spine_width (di default il 4% dell'altezza:
+    una costa non è mai più sottile di così).
+    """
+    height, width = image.shape[:2]
+    min_spine_width = min_spine_width or max(8, int(height * 0.04))
+    profile = vertical_edge_profile(image)
+    threshold = profile.mean() + profile.std()
+
+    boundaries = []
+    # Dal picco più forte: ogni colonna scelta "copre" quelle troppo vicine
+    for column in np.argsort(profile)[::-1]:
+        if profile[column] < threshold:
+            break
+        if min_spine_width <= column <= width - min_spine_width and all(
+            abs(column - chosen) >= min_spine_width for chosen in boundaries
+        ):
+            boundaries.append(int(column))
+    return sorted(boundaries)
+
+
+def split_into_tiles(image, max_aspect=None, overlap=None):
+    """
+    Divide una foto larga in tasselli verticali, ognuno largo al massimo
+    max_aspect volte la sua altezza, tagliando in corrispondenza delle coste.
+    I tasselli si sovrappongono di `overlap` (frazione della larghezza) per
+    non perdere i libri che cadono proprio sul taglio.
+    Restituisce una lista di array NumPy (un solo elemento se non serve tagliare).
+    """
+    max_aspect = max_aspect or settings.SHELF_TILE_MAX_ASPECT
+    overlap = settings.SHELF_TILE_OVERLAP if overlap is None else overlap
+
+    height, width = image.shape[:2]
+    tile_width = int(height * max_aspect)
+    if width <= tile_width:
+        return [image]
+
+    margin = int(tile_width * overlap / 2)
+    bounds = [0] + find_spine_cuts(image, tile_width) + [width]
+    return [
+        image[:, max(0, left - margin):min(width, right + margin)]
+        for left, right in zip(bounds, bounds[1:])
+    ]
+
+
+def split_image_data_into_tiles(data, mime_type='image/jpeg', image=None):
+    """
+    Come split_into_tiles, ma lavora sui byte: restituisce una lista di (byte, mime_type).
+    Se l'immagine non va tagliata (o non è decodificabile) restituisce l'originale.
+    `image` evita di decodificare di nuovo i byte se l'array è già disponibile.
+    Ogni tassello viene ridotto a GEMINI_IMAGE_MAX_DIMENSION (la foto intera,
+    preparata con prepare_image_for_model, può essere più grande).
+    """
+    if image is None:
+        image = decode_image(data)
+    if image is None:
+        return [(data, mime_type)]
+
+    tiles = split_into_tiles(image)
+    if len(tiles) == 1:
+        return [(data, mime_type)]
+    return [
+        (encode_jpeg(resize_to_max_dimension(tile, settings.GEMINI_IMAGE_MAX_DIMENSION)), 'image/jpeg')
+        for tile in tiles
+    ]
+
+
+# --- IMPRONTA PERCETTIVA (dHash) ---
+def dhash(image, hash_size=16):
+    """
+    Difference hash dell'immagine: la riduciamo a (hash_size+1) x hash_size in
+    scala di grigi e confrontiamo ogni pixel con il vicino di destra.
+    Due foto quasi identiche (stesso scaffale, piccola differenza di luce o di
+    inquadratura) hanno impronte che differiscono di pochi bit.
+    Restituisce un intero di hash_size*hash_size bit.
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(''.join('1' if bit else '0' for bit in bits), 2)
+
+
+def hamming_distance(hash_a, hash_b):
+    """Numero di bit diversi tra due impronte."""
+    return bin(hash_a ^ hash_b).count('1')
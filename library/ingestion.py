@@ -0,0 +1,365 @@
+# In library/ingestion.py
+"""
+Coda di acquisizione delle foto degli scaffali, salvata nel database.
+
+La view di upload si limita a creare un IngestionJob con le sue immagini;
+il lavoro pesante (Gemini + Google Books) lo fa il comando
+`python manage.py process_ingestion_jobs`, che può essere fermato e
+riavviato in qualsiasi momento senza perdere le immagini in coda.
+"""
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import book_detector, image_utils, instrumentation
+from .book_store import add_books_to_bookshelf
+from .http_client import async_http_client
+from .models import IngestionImage, IngestionJob
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_upload(bookshelf, shelf_number, image_files):
+    """
+    Crea un job con una IngestionImage per ogni file caricato, tutto in una
+    transazione: o entra in coda l'intero upload o niente.
+    Le foto vengono salvate così come sono arrivate; la riduzione per il
+    modello (image_utils.prepare_image_for_model) la fa il worker, fuori dalla
+    richiesta (vedi _model_image).
+    """
+    with transaction.atomic():
+        job = IngestionJob.objects.create(bookshelf=bookshelf, shelf_number=shelf_number)
+        for image_file in image_files:
+            image_data = image_file.read()
+            IngestionImage.objects.create(
+                job=job,
+                filename=image_file.name,
+                image_data=image_data,
+                mime_type=image_utils.detect_mime_type(image_data),
+            )
+    return job
+
+
+def _model_image(image):
+    """
+    (byte, mime_type) da inviare al modello per una immagine in coda: la foto
+    caricata, ridotta e ricompressa in memoria. Se non è decodificabile
+    l'errore (o l'originale, es. HEIC) resta confinato a questa immagine.
+    """
+    return image_utils.prepare_image_for_model(bytes(image.image_data))
+
+
+def _claimable_images():
+    """
+    Immagini in attesa, oppure "in elaborazione" da un worker che non risponde
+    più (interrotto, crash...), se hanno ancora tentativi a disposizione.
+    """
+    stale_before = timezone.now() - timedelta(seconds=settings.INGESTION_LOCK_TIMEOUT)
+    return IngestionImage.objects.filter(
+        Q(status='pending') |
+        Q(status='processing', locked_at__lt=stale_before, attempts__lt=settings.INGESTION_MAX_ATTEMPTS)
+    )
+
+
+def _fail_abandoned_images():
+    """
+    Un'immagine che fa cadere il worker (es. memoria esaurita in decodifica)
+    non arriva mai a _finish_image: dopo INGESTION_MAX_ATTEMPTS prenotazioni
+    la diamo per fallita invece di riprovarla all'infinito.
+    """
+    stale_before = timezone.now() - timedelta(seconds=settings.INGESTION_LOCK_TIMEOUT)
+    abandoned = IngestionImage.objects.filter(
+        status='processing', locked_at__lt=stale_before, attempts__gte=settings.INGESTION_MAX_ATTEMPTS,
+    )
+    job_ids = set(abandoned.values_list('job_id', flat=True))
+    if not job_ids:
+        return
+    abandoned.update(status='failed', locked_at=None, error="Elaborazione interrotta (il worker si è fermato)")
+    for job in IngestionJob.objects.filter(pk__in=job_ids):
+        job.refresh_status()
+
+
+def claim_images(limit=1):
+    """
+    Prenota fino a `limit` immagini da elaborare e le restituisce.
+    La prenotazione è un UPDATE condizionato: se un altro worker ci ha
+    preceduto, l'UPDATE non tocca nessuna riga e passiamo alla successiva.
+    Il tentativo viene contato già qui, non alla fine: così conta anche se
+    il worker muore durante l'elaborazione.
+    """
+    _fail_abandoned_images()
+    claimed_ids = []
+    for image_id in _claimable_images().order_by('id').values_list('id', flat=True)[:limit * 2]:
+        claimed = _claimable_images().filter(pk=image_id).update(
+            status='processing',
+            locked_at=timezone.now(),
+            attempts=F('attempts') + 1,
+        )
+        if claimed:
+            claimed_ids.append(image_id)
+            if len(claimed_ids) >= limit:
+                break
+    return list(IngestionImage.objects.select_related('job__bookshelf').filter(pk__in=claimed_ids).order_by('id'))
+
+
+def claim_next_image():
+    """Prenota la prossima immagine da elaborare e la restituisce (o None)."""
+    images = claim_images(limit=1)
+    return images[0] if images else None
+
+
+def _detect_books(image):
+    """
+    Parte "di rete" dell'elaborazione (Gemini + Google Books), senza accessi al DB:
+    gira in un thread separato per ogni immagine. Restituisce (libri, errore).
+    """
+    logger.info("Processo l'immagine: %s (job %d, tentativo %d)", image.filename, image.job_id, image.attempts)
+    try:
+        return book_detector.process_shelf_image_data(*_model_image(image)), None
+    except Exception as e:
+        # Se qualcosa va storto con questa immagine, lo registriamo e andiamo avanti
+        logger.exception("Impossibile processare il file %s", image.filename)
+        return None, e
+    finally:
+        # La cache delle impronte usa il DB da questo thread: chiudiamo la sua connessione
+        connections.close_all()
+
+
+async def _adetect_books(image):
+    """Versione async di _detect_books: gira nell'event loop, senza thread dedicati."""
+    logger.info("Processo l'immagine: %s (job %d, tentativo %d)", image.filename, image.job_id, image.attempts)
+    try:
+        model_image = await sync_to_async(_model_image, thread_sensitive=False)(image)
+        return await book_detector.aprocess_shelf_image_data(*model_image), None
+    except Exception as e:
+        logger.exception("Impossibile processare il file %s", image.filename)
+        return None, e
+
+
+def _detect_batch(images):
+    """
+    Titoli e autori letti da Gemini per tutte le immagini insieme (più foto per
+    richiesta, vedi book_detector.detect_shelf_images), oppure None se il
+    gruppo fallisce: in quel caso ogni immagine viene ritentata da sola, così
+    un errore resta confinato alla sua immagine.
+    """
+    if len(images) < 2:
+        return None
+    try:
+        return book_detector.detect_shelf_images([_model_image(image) for image in images])
+    except Exception as e:
+        logger.warning("Analisi di gruppo fallita (%d immagini), riprovo una alla volta. Causa: %s", len(images), e)
+        return None
+
+
+async def _adetect_batch(images):
+    """Versione async di _detect_batch."""
+    if len(images) < 2:
+        return None
+    try:
+        model_images = [await sync_to_async(_model_image, thread_sensitive=False)(image) for image in images]
+        return await book_detector.adetect_shelf_images(model_images)
+    except Exception as e:
+        logger.warning("Analisi di gruppo fallita (%d immagini), riprovo una alla volta. Causa: %s", len(images), e)
+        return None
+
+
+def _enrich_books(image, identified_books):
+    """Ricerca su Google Books dei libri già letti nell'immagine, senza accessi al DB. Restituisce (libri, errore)."""
+    try:
+        return book_detector.enrich_detected_books(identified_books), None
+    except Exception as e:
+        logger.exception("Impossibile processare il file %s", image.filename)
+        return None, e
+    finally:
+        connections.close_all()
+
+
+async def _aenrich_books(image, identified_books):
+    """Versione async di _enrich_books."""
+    try:
+        return await book_detector.aenrich_detected_books(identified_books), None
+    except Exception as e:
+        logger.exception("Impossibile processare il file %s", image.filename)
+        return None, e
+
+
+def _finish_image(image, found_books_data, error):
+    """Applica al database il risultato dell'elaborazione di una immagine."""
+    job = image.job
+
+    if error is None:
+        try:
+            image.books_found = len(found_books_data)
+            image.books_added = len(add_books_to_bookshelf(job.bookshelf, job.shelf_number, found_books_data))
+        except Exception as e:
+            logger.exception("Impossibile salvare i libri del file %s", image.filename)
+            error = e
+
+    if error is None:
+        image.error = ''
+        image.status = 'done'
+        # L'immagine non serve più: liberiamo spazio nel database
+        image.image_data = b''
+    else:
+        image.error = str(error)
+        image.status = 'failed' if image.attempts >= settings.INGESTION_MAX_ATTEMPTS else 'pending'
+
+    image.locked_at = None
+    image.save()
+    return image
+
+
+def process_images(images, max_workers=None):
+    """
+    Elabora un gruppo di immagini già prenotate. Le foto vengono inviate a
+    Gemini insieme (più immagini per richiesta); le ricerche su Google Books
+    partono poi in parallelo (al massimo INGESTION_IMAGE_WORKERS alla volta);
+    le scritture sul database avvengono tutte alla fine, nel thread
+    principale. Un errore su una immagine non blocca le altre: quella
+    immagine torna in coda, finché non supera INGESTION_MAX_ATTEMPTS tentativi.
+    """
+    if not images:
+        return []
+
+    max_workers = max_workers or settings.INGESTION_IMAGE_WORKERS
+    max_workers = max(1, min(max_workers, len(images)))
+
+    with instrumentation.span('ingestion_phase', phase='detect'):
+        detections = _detect_batch(images)
+    with instrumentation.span('ingestion_phase', phase='lookup'), ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if detections is None:
+            results = list(executor.map(_detect_books, images))
+        else:
+            results = list(executor.map(_enrich_books, images, detections))
+
+    with instrumentation.span('ingestion_phase', phase='save'):
+        for image, (found_books_data, error) in zip(images, results):
+            _finish_image(image, found_books_data, error)
+
+    for job in {image.job_id: image.job for image in images}.values():
+        job.refresh_status()
+    return images
+
+
+async def _adetect_all(images, max_concurrency):
+    semaphore = asyncio.Semaphore(max_concurrency)
+    with instrumentation.span('ingestion_phase', phase='detect'):
+        detections = await _adetect_batch(images)
+
+    async def detect(image, identified_books):
+        async with semaphore:
+            if identified_books is None:
+                return await _adetect_books(image)
+            return await _aenrich_books(image, identified_books)
+
+    with instrumentation.span('ingestion_phase', phase='lookup'):
+        return await asyncio.gather(*(detect(image, books) for image, books in zip(images, detections or [None] * len(images))))
+
+
+# Event loop del worker async, uno per thread e riusato da un gruppo di immagini
+# all'altro: il client async di Gemini (canale grpc.aio) e quello di httpx
+# restano legati al loop in cui sono stati creati
+_worker = threading.local()
+
+
+def _event_loop():
+    loop = getattr(_worker, 'loop', None)
+    if loop is None or loop.is_closed():
+        loop = _worker.loop = asyncio.new_event_loop()
+        # Il loop vive quanto il worker: le connessioni a Google Books restano aperte tra un gruppo e l'altro
+        async_http_client.keep_alive(loop)
+    return loop
+
+
+async def _adetect_all_and_close(images, max_concurrency):
+    try:
+        return await _adetect_all(images, max_concurrency)
+    finally:
+        # La cache delle impronte usa il DB dal thread di sync_to_async: chiudiamo la sua connessione
+        await sync_to_async(connections.close_all)()
+
+
+def aprocess_images(images, max_concurrency=None):
+    """
+    Come process_images, ma le immagini vengono analizzate come coroutine in
+    un solo event loop (client HTTP async) invece che in un pool di thread.
+    Il loop è sempre lo stesso per tutta la vita del worker (vedi _event_loop).
+    Le scritture sul database restano nel thread principale, alla fine.
+    """
+    if not images:
+        return []
+
+    max_concurrency = max(1, max_concurrency or settings.INGESTION_IMAGE_WORKERS)
+    results = _event_loop().run_until_complete(_adetect_all_and_close(images, max_concurrency))
+
+    with instrumentation.span('ingestion_phase', phase='save'):
+        for image, (found_books_data, error) in zip(images, results):
+            _finish_image(image, found_books_data, error)
+
+    for job in {image.job_id: image.job for image in images}.values():
+        job.refresh_status()
+    return images
+
+
+def process_image(image):
+    """Elabora una singola immagine già prenotata."""
+    return process_images([image])[0]
+
+
+def process_pending_images(limit=None, use_async=False):
+    """
+    Elabora le immagini in coda finché ce ne sono (o fino a `limit`). Restituisce quante ne ha elaborate.
+    Con `use_async` usa aprocess_images invece del pool di thread.
+    """
+    processed = 0
+    batch_size = settings.INGESTION_IMAGE_WORKERS
+    while limit is None or processed < limit:
+        if limit is not None:
+            batch_size = min(batch_size, limit - processed)
+        images = claim_images(limit=batch_size)
+        if not images:
+            break
+        (aprocess_images if use_async else process_images)(images)
+        processed += len(images)
+    return processed
+
+
+def retry_failed_images(job):
+    """Rimette in coda le immagini fallite di un job (con nuovi tentativi a disposizione)."""
+    retried = job.images.filter(status='failed').update(
+        status='pending',
+        attempts=0,
+        error='',
+        locked_at=None,
+    )
+    if retried:
+        job.refresh_status()
+    return retried
+
+
+def job_status(job):
+    """Riepilogo del job in formato JSON-serializzabile, usato dall'endpoint di polling."""
+    images = list(job.images.values('id', 'filename', 'status', 'attempts', 'books_found', 'books_added', 'error'))
+    counts = {status: 0 for status, _ in IngestionImage.STATUS_CHOICES}
+    for image in images:
+        counts[image['status']] += 1
+
+    return {
+        'id': job.pk,
+        'status': job.status,
+        'bookshelf_id': job.bookshelf_id,
+        'shelf_number': job.shelf_number,
+        'total': len(images),
+        'counts': counts,
+        'books_added': sum(image['books_added'] for image in images),
+        'images': images,
+    }
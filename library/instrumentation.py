@@ -0,0 +1,349 @@
+# In library/instrumentation.py
+"""
+Log strutturati, tempi e metriche in formato Prometheus.
+
+- I moduli scrivono con `logging` (logger "library.<modulo>") invece di
+  print: livello e formato (testo o una riga JSON per messaggio) si scelgono
+  con LOG_LEVEL e LOG_FORMAT.
+- span("nome", etichetta=valore) misura un blocco di codice: la durata
+  finisce nell'istogramma library_<nome>_seconds e, a livello DEBUG, nel log.
+  Sono misurati: le richieste ai backend di riconoscimento (Gemini / OCR),
+  ogni richiesta HTTP verso l'esterno (Google Books, Google Immagini...), le
+  scritture sul database, il rendering dei template, le fasi del worker di
+  acquisizione e ogni richiesta servita dalle view.
+- /metrics/ espone istogrammi e contatori, più le statistiche già raccolte
+  (cache dei metadati, abbinamento al catalogo, impronte delle foto, client
+  HTTP, copertine). I worker possono esporre le proprie con --metrics-port.
+
+Con METRICS_ENABLED=False (default) e log sotto DEBUG, span() restituisce un
+context manager vuoto già pronto: il costo è un controllo di due flag.
+Le metriche sono per processo.
+"""
+import bisect
+import json
+import logging
+import re
+import threading
+import time
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.template.backends.django import DjangoTemplates, Template
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Istruzioni SQL che contano come scritture
+_WRITE_STATEMENTS = {'insert', 'update', 'delete', 'replace'}
+
+_NOOP = nullcontext()
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+
+
+class Histogram:
+    """Istogramma cumulativo alla Prometheus (bucket "le", somma e conteggio)."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        # bisect_left: un valore uguale al limite cade in quel bucket (value <= le)
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _key(name, labels):
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def observe(name, seconds, **labels):
+    """Registra una durata nell'istogramma library_<name>_seconds."""
+    if not settings.METRICS_ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram(settings.METRICS_BUCKETS)
+        histogram.observe(seconds)
+
+
+def increment(name, amount=1, **labels):
+    """Incrementa il contatore library_<name>_total."""
+    if not settings.METRICS_ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+class Span:
+    __slots__ = ('name', 'labels', 'start')
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        observe(self.name, elapsed, **self.labels)
+        if exc_type is not None:
+            increment(f"{self.name}_errors", **self.labels)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s: %.1f ms", self.name, elapsed * 1000,
+                         extra={'span': self.name, 'duration_ms': round(elapsed * 1000, 3), 'labels': self.labels})
+        return False
+
+
+def span(name, **labels):
+    """
+    Misura il blocco `with span(...)`. Funziona anche nel codice async (il
+    context manager è sincrono: misura il tempo reale, attese comprese).
+    """
+    if not settings.METRICS_ENABLED and not logger.isEnabledFor(logging.DEBUG):
+        return _NOOP
+    return Span(name, labels)
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+# --- FORMATO DI ESPOSIZIONE DI PROMETHEUS ---
+def _metric_name(*parts):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', '_'.join(['library', *parts]))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+
+def _format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _render_metrics(lines):
+    with _lock:
+        histograms = {key: (list(h.counts), h.sum, h.count, h.buckets) for key, h in _histograms.items()}
+        counters = dict(_counters)
+
+    by_name = {}
+    for (name, labels), values in histograms.items():
+        by_name.setdefault(name, []).append((labels, values))
+    for name in sorted(by_name):
+        metric = _metric_name(name, 'seconds')
+        lines.append(f"# TYPE {metric} histogram")
+        for labels, (counts, total, count, buckets) in sorted(by_name[name]):
+            cumulative = 0
+            for bound, bucket_count in zip((*buckets, float('inf')), counts):
+                cumulative += bucket_count
+                lines.append(f"{metric}_bucket{_labels(labels + (('le', _format_number(bound)),))} {cumulative}")
+            lines.append(f"{metric}_sum{_labels(labels)} {_format_number(total)}")
+            lines.append(f"{metric}_count{_labels(labels)} {count}")
+
+    by_name = {}
+    for (name, labels), value in counters.items():
+        by_name.setdefault(name, []).append((labels, value))
+    for name in sorted(by_name):
+        metric = _metric_name(name, 'total')
+        lines.append(f"# TYPE {metric} counter")
+        for labels, value in sorted(by_name[name]):
+            lines.append(f"{metric}{_labels(labels)} {_format_number(value)}")
+
+
+# Sezioni delle statistiche con un livello per host/chiave: nome dell'etichetta
+_STATS_LABELS = {'http': 'host'}
+
+
+def _render_stats(lines, stats):
+    """Le statistiche già raccolte dai moduli (vedi collect_stats) come gauge."""
+    for section, values in stats.items():
+        series = {}
+        for key, value in values.items():
+            if isinstance(value, dict):
+                label = _STATS_LABELS.get(section, 'key')
+                for field, number in value.items():
+                    if field == 'circuit':
+                        # Stato del circuit breaker: 1 se le richieste all'host sono sospese
+                        field, number = 'circuit_open', int(number == 'open')
+                    if isinstance(number, (int, float)) and not isinstance(number, bool):
+                        series.setdefault(field, []).append((((label, key),), number))
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                series.setdefault(key, []).append(((), value))
+        for field in sorted(series):
+            metric = _metric_name(section, field)
+            lines.append(f"# TYPE {metric} gauge")
+            for labels, number in series[field]:
+                lines.append(f"{metric}{_labels(labels)} {_format_number(number)}")
+
+
+def collect_stats():
+    """Statistiche di cache e client HTTP (le stesse di /api/cache-stats/)."""
+    from . import book_matcher, cover_fallback, covers, image_fingerprints
+    from .http_client import http_client
+    from .metadata_cache import metadata_cache
+
+    return {
+        'book_metadata': metadata_cache.stats(),
+        'book_matcher': book_matcher.stats(),
+        'image_fingerprints': image_fingerprints.stats(),
+        'http': http_client.stats(),
+        'covers': covers.stats(),
+        'cover_search': cover_fallback.stats(),
+    }
+
+
+def render(stats=None):
+    """Tutte le metriche del processo nel formato testuale di Prometheus."""
+    lines = []
+    _render_metrics(lines)
+    if stats:
+        _render_stats(lines, stats)
+    return '\n'.join(lines) + '\n'
+
+
+# --- AGGANCI A DJANGO ---
+class MetricsMiddleware:
+    """Durata di ogni richiesta, per view (url_name), metodo e codice di risposta."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def _observe(self, request, response, start):
+        match = request.resolver_match
+        view = (match.url_name or match.view_name) if match else 'unmatched'
+        # Per le risposte in streaming è il tempo fino al primo byte
+        observe('http_server_request', time.perf_counter() - start,
+                view=view, method=request.method, status=response.status_code)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not settings.METRICS_ENABLED:
+            return self.get_response(request)
+        start = time.perf_counter()
+        response = self.get_response(request)
+        self._observe(request, response, start)
+        return response
+
+    async def __acall__(self, request):
+        if not settings.METRICS_ENABLED:
+            return await self.get_response(request)
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        self._observe(request, response, start)
+        return response
+
+
+class TimedTemplate(Template):
+    def render(self, context=None, request=None):
+        with span('template_render', template=self.origin.template_name):
+            return super().render(context, request)
+
+
+class InstrumentedDjangoTemplates(DjangoTemplates):
+    """Il backend standard dei template, con il tempo di rendering di ogni pagina."""
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name).template, self)
+
+
+def time_db_writes(execute, sql, params, many, context):
+    """execute_wrapper: misura INSERT/UPDATE/DELETE (le letture passano senza costi aggiuntivi)."""
+    statement = sql.lstrip()[:7].split(None, 1)[0].lower() if sql else ''
+    if statement not in _WRITE_STATEMENTS:
+        return execute(sql, params, many, context)
+    with span('db_write', statement=statement, table=_table_name(sql, statement)):
+        return execute(sql, params, many, context)
+
+
+_TABLE = re.compile(r'^\s*(?:insert\s+(?:or\s+\w+\s+)?into|update|delete\s+from|replace\s+into)\s+"?(\w+)"?', re.IGNORECASE)
+
+
+def _table_name(sql, statement):
+    match = _TABLE.match(sql)
+    return match.group(1) if match else statement
+
+
+def install_db_instrumentation(sender, connection, **kwargs):
+    """Ricevitore di connection_created: aggancia time_db_writes alle nuove connessioni."""
+    if settings.METRICS_ENABLED and time_db_writes not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_db_writes)
+
+
+# --- LOG STRUTTURATI ---
+class JsonFormatter(logging.Formatter):
+    """Una riga JSON per messaggio (per i raccoglitori di log); include durata ed etichette degli span."""
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in ('span', 'duration_ms', 'labels'):
+            if hasattr(record, field):
+                data[field] = getattr(record, field)
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+# --- METRICHE DEI WORKER ---
+def serve_metrics(port, address=''):
+    """
+    Espone render() su http://<address>:<port>/metrics in un thread (per i
+    comandi dei worker, che non hanno le view). Restituisce il server.
+    """
+    from django.db import connections
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip('/') != '/metrics':
+                self.send_error(404)
+                return
+            try:
+                body = render(collect_stats()).encode('utf-8')
+            finally:
+                # Le statistiche delle copertine leggono il DB da questo thread
+                connections.close_all()
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug("metrics: " + format, *args)
+
+    server = ThreadingHTTPServer((address, port), Handler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info("Metriche esposte su http://%s:%d/metrics", address or '0.0.0.0', server.server_port)
+    return server
@@ -0,0 +1,225 @@
+# In library/layout.py
+"""
+Salvataggio del layout delle librerie dall'editor della stanza.
+
+Tutte le librerie della richiesta vengono lette con una sola query,
+confrontate con i dati inviati e scritte con un solo bulk_update (solo i
+campi cambiati), dentro una transazione.
+
+Concorrenza ottimistica: ogni libreria ha un numero di `version`. Se il
+client lo invia e non coincide con quello nel database, qualcun altro ha
+salvato nel frattempo: quella libreria non viene toccata e il client riceve
+i dati aggiornati (esito "conflict").
+
+Protocollo a revisioni (salvataggio automatico dell'editor): ogni stanza ha
+un numero di `revision` che cresce di 1 ad ogni salvataggio. Il client invia
+solo i campi cambiati insieme alla revisione su cui si basa (apply_patch) e
+riceve la nuova revisione; con changes_since chiede cosa è cambiato dopo una
+certa revisione (librerie modificate, create o cancellate da altre schede).
+"""
+from django.db import transaction
+from django.db.models import F
+
+from .models import Bookshelf, DeletedBookshelf, Room
+
+# Nome usato dal JavaScript -> campo del modello
+LAYOUT_FIELDS = {
+    'name': 'name',
+    'x': 'pos_x',
+    'y': 'pos_y',
+    'width': 'width',
+    'height': 'height',
+    'shape_type': 'shape_type',
+    'rotation': 'rotation',
+}
+
+_SHAPE_TYPES = {shape for shape, _ in Bookshelf.SHAPE_CHOICES}
+
+
+def shelf_layout(shelf):
+    """Dati di una libreria nel formato usato dall'editor."""
+    data = {key: getattr(shelf, field) for key, field in LAYOUT_FIELDS.items()}
+    data['id'] = shelf.id
+    data['version'] = shelf.version
+    return data
+
+
+def bump_revision(room_id):
+    """Incrementa la revisione della stanza e restituisce quella nuova (da chiamare in una transazione)."""
+    # UPDATE con F(): il database serializza gli incrementi, nessuna revisione viene saltata o ripetuta
+    Room.objects.filter(pk=room_id).update(revision=F('revision') + 1)
+    return Room.objects.filter(pk=room_id).values_list('revision', flat=True).get()
+
+
+def _clean_value(key, value):
+    if key == 'name':
+        value = str(value).strip()
+        if not value:
+            raise ValueError("Il nome non può essere vuoto")
+        return value[:100]
+    if key == 'shape_type':
+        if value not in _SHAPE_TYPES:
+            raise ValueError(f"Forma non valida: {value}")
+        return value
+    # Coordinate, dimensioni e rotazione: numeri interi
+    return int(round(float(value)))
+
+
+def _changed_fields(shelf, shelf_data):
+    """Restituisce {campo: nuovo valore} per i soli campi che cambiano davvero."""
+    changes = {}
+    for key, field in LAYOUT_FIELDS.items():
+        if key not in shelf_data:
+            continue
+        value = _clean_value(key, shelf_data[key])
+        if getattr(shelf, field) != value:
+            changes[field] = value
+    return changes
+
+
+def _diff(shelf, shelf_data):
+    """Esito per una libreria già letta e non in conflitto: (risultato, modifiche)."""
+    try:
+        changes = _changed_fields(shelf, shelf_data)
+    except (TypeError, ValueError) as e:
+        return {'id': shelf.id, 'result': 'invalid', 'error': str(e)}, None
+    if not changes:
+        return {'id': shelf.id, 'result': 'unchanged', 'version': shelf.version}, None
+    return {'id': shelf.id, 'result': 'updated'}, changes
+
+
+def _save_changes(shelves, fields):
+    """
+    Scrive le librerie modificate con un solo bulk_update, dopo aver dato a
+    ciascuna una nuova version e la nuova revisione della sua stanza.
+    Restituisce {room_id: nuova revisione}.
+    """
+    revisions = {room_id: bump_revision(room_id) for room_id in sorted({shelf.room_id for shelf in shelves})}
+    for shelf in shelves:
+        shelf.version += 1
+        shelf.revision = revisions[shelf.room_id]
+    # Un solo UPDATE ... CASE per tutte le librerie, solo sulle colonne toccate
+    Bookshelf.objects.bulk_update(shelves, sorted(fields) + ['version', 'revision'])
+    return revisions
+
+
+def update_layout(shelves_data):
+    """
+    Applica una lista di modifiche [{id, version?, x?, y?, ...}, ...].
+    Restituisce un esito per ogni libreria, nello stesso ordine:
+    {'id', 'result': 'updated' | 'unchanged' | 'conflict' | 'not_found' | 'invalid', ...}.
+    """
+    ids = [shelf_data.get('id') for shelf_data in shelves_data]
+    results = []
+    to_update = []
+    updated_fields = set()
+
+    with transaction.atomic():
+        # select_for_update: su PostgreSQL due salvataggi contemporanei si mettono in fila,
+        # così il secondo vede la nuova version e ottiene un conflitto invece di sovrascrivere
+        shelves = Bookshelf.objects.select_for_update().in_bulk([i for i in ids if i is not None])
+
+        for shelf_data in shelves_data:
+            shelf_id = shelf_data.get('id')
+            shelf = shelves.get(shelf_id)
+            if shelf is None:
+                results.append({'id': shelf_id, 'result': 'not_found'})
+                continue
+
+            expected_version = shelf_data.get('version')
+            if expected_version is not None and expected_version != shelf.version:
+                results.append({'id': shelf_id, 'result': 'conflict', 'shelf': shelf_layout(shelf)})
+                continue
+
+            result, changes = _diff(shelf, shelf_data)
+            results.append(result)
+            if changes:
+                for field, value in changes.items():
+                    setattr(shelf, field, value)
+                if shelf not in to_update:
+                    to_update.append(shelf)
+                updated_fields.update(changes)
+
+        if to_update:
+            _save_changes(to_update, updated_fields)
+            for result in results:
+                if result['result'] == 'updated':
+                    result['version'] = shelves[result['id']].version
+
+    return results
+
+
+def apply_patch(room, base_revision, changes):
+    """
+    Applica le modifiche parziali [{id, campo: valore, ...}, ...] inviate
+    dall'editor, basate sulla revisione `base_revision` della stanza.
+    Una libreria modificata da altri dopo quella revisione è in conflitto:
+    non viene toccata e l'esito contiene i suoi dati attuali.
+    Tutto avviene in una transazione; restituisce {'revision', 'results'}.
+    """
+    ids = [change.get('id') for change in changes]
+    results = []
+    to_update = []
+    updated_fields = set()
+
+    with transaction.atomic():
+        shelves = room.bookshelves.select_for_update().in_bulk([i for i in ids if i is not None])
+
+        for change in changes:
+            shelf = shelves.get(change.get('id'))
+            if shelf is None:
+                results.append({'id': change.get('id'), 'result': 'not_found'})
+            elif shelf.revision > base_revision:
+                results.append({'id': shelf.id, 'result': 'conflict', 'shelf': shelf_layout(shelf)})
+            else:
+                result, shelf_changes = _diff(shelf, change)
+                results.append(result)
+                if shelf_changes:
+                    for field, value in shelf_changes.items():
+                        setattr(shelf, field, value)
+                    if shelf not in to_update:
+                        to_update.append(shelf)
+                    updated_fields.update(shelf_changes)
+
+        if to_update:
+            revision = _save_changes(to_update, updated_fields)[room.id]
+            for result in results:
+                if result['result'] == 'updated':
+                    result['version'] = shelves[result['id']].version
+        else:
+            revision = Room.objects.filter(pk=room.id).values_list('revision', flat=True).get()
+
+    room.revision = revision
+    return {'revision': revision, 'results': results}
+
+
+def changes_since(room, revision):
+    """
+    Cosa è cambiato nella stanza dopo `revision`: le librerie modificate o
+    create (dati completi) e gli id di quelle cancellate. `room` deve essere
+    stato letto prima di chiamare questa funzione, così la revisione
+    restituita non è mai più nuova dei dati.
+    """
+    shelves = room.bookshelves.filter(revision__gt=revision).order_by('id')
+    deleted = room.deleted_bookshelves.filter(revision__gt=revision).values_list('bookshelf_id', flat=True)
+    return {
+        'revision': room.revision,
+        'shelves': [shelf_layout(shelf) for shelf in shelves],
+        'deleted': list(deleted),
+    }
+
+
+def create_shelf(room, name, shape_type):
+    """Crea una libreria nella stanza (con una nuova revisione)."""
+    with transaction.atomic():
+        revision = bump_revision(room.id)
+        return Bookshelf.objects.create(name=name, shape_type=shape_type, room=room, revision=revision)
+
+
+def delete_shelf(shelf):
+    """Cancella una libreria lasciando una traccia per gli altri editor aperti."""
+    with transaction.atomic():
+        revision = bump_revision(shelf.room_id)
+        DeletedBookshelf.objects.create(room_id=shelf.room_id, bookshelf_id=shelf.id, revision=revision)
+        shelf.delete()
+    return revision
@@ -0,0 +1,60 @@
+# In library/lazy_imports.py
+"""
+Import "pigri" delle dipendenze pesanti.
+
+google.generativeai (grpc, protobuf, tutto il client Google), OpenCV/NumPy,
+httpx e BeautifulSoup costano centinaia di millisecondi all'import: senza
+questo li pagava ogni comando di manage.py, ogni esecuzione dei test e ogni
+avvio di un worker, anche quando non serviva nessun riconoscimento.
+
+    cv2 = lazy_import('cv2')
+
+restituisce subito un segnaposto; il vero import avviene al primo accesso
+a un suo attributo, sotto un lock: più thread che lo usano insieme per la
+prima volta aspettano lo stesso import (importlib.util.LazyLoader non lo
+garantisce, e un thread poteva vedere il modulo a metà). ImportBudgetTests
+(library/tests.py) verifica che dopo l'avvio nessuna di queste dipendenze
+sia caricata e che l'import delle URL resti sotto un tetto di tempo.
+"""
+import importlib
+import importlib.util
+import sys
+import threading
+import types
+
+
+class _LazyModule(types.ModuleType):
+    """Segnaposto per un modulo: lo importa al primo attributo richiesto."""
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__['_lazy_lock'] = threading.Lock()
+        self.__dict__['_lazy_module'] = None
+
+    def __getattr__(self, attr):
+        # Chiamato solo per gli attributi che il segnaposto non ha ancora
+        module = self._lazy_module
+        if module is None:
+            with self._lazy_lock:
+                module = self._lazy_module
+                if module is None:
+                    module = importlib.import_module(self.__name__)
+                    # Da qui in poi gli attributi si leggono direttamente, senza passare di qui
+                    self.__dict__.update(module.__dict__)
+                    self.__dict__['_lazy_module'] = module
+        return getattr(module, attr)
+
+
+def lazy_import(name):
+    """Il modulo `name`, caricato davvero solo quando viene usato."""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    if importlib.util.find_spec(name) is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    return _LazyModule(name)
+
+
+def is_loaded(name):
+    """True se il modulo è stato davvero importato (non solo promesso da lazy_import)."""
+    return name in sys.modules
@@ -0,0 +1,95 @@
+import os
+import tempfile
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.management.base import BaseCommand
+
+from library import image_utils
+
+
+def synthetic_shelf_photo(seed, width=4032, height=3024):
+    """Foto finta di uno scaffale da 12 megapixel: coste a tinta unita di larghezza variabile, con un po' di grana."""
+    rng = np.random.default_rng(seed)
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    left = 0
+    while left < width:
+        right = left + int(rng.integers(width // 60, width // 20))
+        image[:, left:right] = rng.integers(30, 225, 3)
+        left = right
+    noise = rng.normal(0, 6, image.shape)
+    return image_utils.encode_jpeg(np.clip(image + noise, 0, 255).astype(np.uint8), 95)
+
+
+def upload_seconds(size, mbps):
+    """Tempo stimato per inviare `size` byte con una banda di `mbps` Mbit/s."""
+    return size * 8 / (mbps * 1_000_000)
+
+
+class Command(BaseCommand):
+    help = ("Byte inviati al modello e tempo per foto: la foto originale salvata su disco e riletta "
+            "(come prima) contro la riduzione in memoria di image_utils.prepare_image_for_model.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('photos', nargs='*', help="Foto degli scaffali (default: foto finte da 12 megapixel).")
+        parser.add_argument('--synthetic', type=int, default=5, help="Quante foto finte usare se non ne vengono indicate.")
+        parser.add_argument('--repeat', type=int, default=3, help="Ripetizioni (vale il tempo migliore).")
+        parser.add_argument('--upload-mbps', type=float, default=10.0,
+                            help="Banda in uscita verso il modello (Mbit/s) per stimare il tempo di invio.")
+
+    def handle(self, *args, **options):
+        if options['photos']:
+            photos = []
+            for path in options['photos']:
+                with open(path, 'rb') as photo:
+                    photos.append((os.path.basename(path), photo.read()))
+        else:
+            photos = [(f"finta-{i}.jpg", synthetic_shelf_photo(i)) for i in range(options['synthetic'])]
+
+        repeat = max(1, options['repeat'])
+        mbps = options['upload_mbps']
+        totals = {'before': [0, 0.0], 'after': [0, 0.0]}
+        with tempfile.TemporaryDirectory() as directory:
+            storage = FileSystemStorage(location=directory)
+            for name, data in photos:
+                before = after = None
+                for _ in range(repeat):
+                    # Prima: FileSystemStorage.save, rilettura completa, cancellazione; si inviava l'originale
+                    start = time.perf_counter()
+                    saved = storage.save(name, ContentFile(data))
+                    with storage.open(saved, 'rb') as f:
+                        sent_before = f.read()
+                    storage.delete(saved)
+                    elapsed = time.perf_counter() - start
+                    before = elapsed if before is None else min(before, elapsed)
+
+                    # Dopo: tutto in memoria, ridotta e ricompressa
+                    start = time.perf_counter()
+                    sent_after, mime_type = image_utils.prepare_image_for_model(data)
+                    elapsed = time.perf_counter() - start
+                    after = elapsed if after is None else min(after, elapsed)
+
+                totals['before'][0] += len(sent_before)
+                totals['before'][1] += before
+                totals['after'][0] += len(sent_after)
+                totals['after'][1] += after
+                self.stdout.write(
+                    f"{name}: prima {len(sent_before) / 1024:.0f} KB, {before * 1000:.0f} ms + "
+                    f"{upload_seconds(len(sent_before), mbps) * 1000:.0f} ms di invio; "
+                    f"dopo {len(sent_after) / 1024:.0f} KB ({mime_type}), {after * 1000:.0f} ms + "
+                    f"{upload_seconds(len(sent_after), mbps) * 1000:.0f} ms di invio"
+                )
+
+        count = len(photos)
+        (bytes_before, time_before), (bytes_after, time_after) = totals['before'], totals['after']
+        per_photo_before = (time_before + upload_seconds(bytes_before, mbps)) / count
+        per_photo_after = (time_after + upload_seconds(bytes_after, mbps)) / count
+        self.stdout.write(
+            f"Media su {count} foto (lato massimo {settings.GEMINI_IMAGE_MAX_DIMENSION} px, "
+            f"{mbps:g} Mbit/s): prima {bytes_before / count / 1024:.0f} KB e "
+            f"{per_photo_before * 1000:.0f} ms, dopo {bytes_after / count / 1024:.0f} KB e "
+            f"{per_photo_after * 1000:.0f} ms -> {bytes_before / bytes_after:.1f}x meno byte inviati al modello"
+        )
@@ -0,0 +1,78 @@
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from library import book_detector
+from library.http_client import http_client
+from library.metadata_cache import metadata_cache
+
+
+def start_stub_server(latency):
+    """Finto Google Books su 127.0.0.1 che risponde dopo `latency` secondi con un volume per query."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            query = parse_qs(urlparse(self.path).query).get('q', [''])[0]
+            time.sleep(latency)
+            body = json.dumps({'totalItems': 1, 'items': [{
+                'id': hashlib.sha1(query.encode('utf-8')).hexdigest()[:12],
+                'volumeInfo': {'title': query, 'authors': ["Autore di prova"],
+                               'imageLinks': {'thumbnail': 'https://books.example/cover.jpg'}},
+            }]}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class Command(BaseCommand):
+    help = ("Tempo per foto dell'arricchimento con Google Books (enrich_detected_books) contro un "
+            "finto server locale: ricerche una alla volta (come prima) e in parallelo (BOOK_LOOKUP_WORKERS).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--spines', type=int, nargs='+', default=[10, 40, 100], help="Libri per foto da provare.")
+        parser.add_argument('--latency', type=float, default=0.1, help="Secondi di risposta del finto server.")
+        parser.add_argument('--workers', type=int, help="Ricerche in parallelo (default BOOK_LOOKUP_WORKERS).")
+
+    def handle(self, *args, **options):
+        server = start_stub_server(options['latency'])
+        url = f"http://127.0.0.1:{server.server_port}/volumes"
+        # Nessun limite di richieste al secondo verso il finto server
+        http_client.rate_limits['127.0.0.1'] = 0
+        # Cache in memoria: i risultati del benchmark non finiscono nel database
+        caches = {
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'book_metadata': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'benchmark'},
+        }
+        run = 0
+        try:
+            with override_settings(GOOGLE_BOOKS_API_URL=url, BOOK_MATCH_ENABLED=False, CACHES=caches):
+                for spines in options['spines']:
+                    timings = []
+                    for label, workers in (('sequenziale', 1), ('parallelo', options['workers'])):
+                        # Titoli nuovi ad ogni giro: nessun risultato dalla cache dei metadati
+                        run += 1
+                        books = [{'title': f"Libro {run}-{i}", 'author': "Autore"} for i in range(spines)]
+                        start = time.perf_counter()
+                        found = book_detector.enrich_detected_books(books, max_workers=workers)
+                        timings.append((label, time.perf_counter() - start, len(found)))
+                    self.stdout.write(f"{spines} libri: " + ", ".join(
+                        f"{label} {seconds * 1000:.0f} ms ({found} trovati)" for label, seconds, found in timings
+                    ) + f" -> {timings[0][1] / timings[1][1]:.1f}x")
+        finally:
+            metadata_cache.clear_local()
+            server.shutdown()
@@ -0,0 +1,96 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from library.models import Book, Bookshelf, Room
+from library.pagination import paginate
+from library.search import search_after, search_books, search_ordering
+
+WORDS = (
+    "amore guerra pace notte giorno mare montagna città perché storia viaggio ombra luce tempo "
+    "memorie isola giardino fiume vento silenzio ritorno segreto casa strada lettere cuore sogno "
+    "ragazzo donna uomo padre madre figlio inverno estate primavera autunno deserto cielo terra fuoco"
+).split()
+SURNAMES = "Rossi Bianchi Eco Calvino Morante Pavese Levi Sciascia Ginzburg Manzoni Verga Buzzati Moravia".split()
+
+# (etichetta, testo cercato): parola rara, parola comune, prefisso, parola con accento scritta senza
+QUERIES = [
+    ("rara", "zanzibar"),
+    ("comune", "amore"),
+    ("prefisso", "memor"),
+    ("due parole", "notte mare"),
+    ("senza accento", "citta"),
+]
+
+
+def fake_books(bookshelf, start, count, rng):
+    """Libri finti con titolo, autore e riassunto presi da un piccolo vocabolario (ogni 5000 uno è 'Zanzibar')."""
+    for i in range(start, start + count):
+        title = " ".join(rng.choices(WORDS, k=rng.randint(2, 5)))
+        if i % 5000 == 0:
+            title += " zanzibar"
+        yield Book(
+            title=title.capitalize(),
+            author=f"{rng.choice(WORDS).capitalize()} {rng.choice(SURNAMES)}",
+            summary=" ".join(rng.choices(WORDS, k=25)),
+            bookshelf=bookshelf,
+            shelf_number=i % 10 + 1,
+            google_books_id=f"bench{i}",
+        )
+
+
+class Command(BaseCommand):
+    help = ("Tempi della prima pagina di ricerca su cataloghi di varie dimensioni: "
+            "indice full-text (search_books) contro icontains su titolo e autore (come prima). "
+            "I libri finti vengono inseriti in una transazione annullata alla fine.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000],
+                            help="Numero di libri del catalogo (crescente).")
+        parser.add_argument('--repeat', type=int, default=3, help="Ripetizioni (vale il tempo migliore).")
+
+    def timed(self, run, repeat):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = run()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best, result
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        repeat = max(1, options['repeat'])
+        with transaction.atomic():
+            room = Room.objects.create(name="Benchmark")
+            bookshelf = Bookshelf.objects.create(name="Benchmark", room=room, shelf_count=10)
+            books = Book.objects.all()
+            inserted = 0
+            for size in sorted(options['sizes']):
+                start = time.perf_counter()
+                while inserted < size:
+                    batch = min(5000, size - inserted)
+                    Book.objects.bulk_create(fake_books(bookshelf, inserted, batch, rng), batch_size=batch)
+                    inserted += batch
+                self.stdout.write(f"{size} libri (inseriti in {time.perf_counter() - start:.1f} s):")
+
+                for label, query in QUERIES:
+                    def full_text():
+                        found = search_books(books, query)
+                        return paginate(found, search_ordering(found), None, after=search_after).items
+
+                    def icontains():
+                        found = books.filter(Q(title__icontains=query) | Q(author__icontains=query))
+                        return paginate(found, ('title', 'id'), None).items
+
+                    fts_time, fts_page = self.timed(full_text, repeat)
+                    like_time, like_page = self.timed(icontains, repeat)
+                    self.stdout.write(
+                        f"  {label} ({query!r}): full-text {fts_time * 1000:.1f} ms ({len(fts_page)} risultati), "
+                        f"icontains {like_time * 1000:.1f} ms ({len(like_page)} risultati)"
+                    )
+            # Il database resta com'era
+            transaction.set_rollback(True)
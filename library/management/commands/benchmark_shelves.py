@@ -0,0 +1,76 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import RequestFactory
+
+from library import views
+from library.models import Book, Bookshelf, Room
+from library.shelving import bucket_books, shelf_counts
+
+
+def group_per_shelf_scan(bookshelf):
+    """Il raggruppamento di prima: tutti i libri caricati, poi una scansione completa per ogni ripiano."""
+    all_books_on_shelf = bookshelf.books.all().order_by('title')
+    return {
+        i: [book for book in all_books_on_shelf if book.shelf_number == i]
+        for i in range(1, bookshelf.shelf_count + 1)
+    }
+
+
+class Command(BaseCommand):
+    help = ("Tempi del raggruppamento dei libri per ripiano (book_list) su una libreria grande: "
+            "scansione per ripiano (come prima) contro shelving.bucket_books, più shelf_counts e "
+            "la pagina intera. I dati finti vengono inseriti in una transazione annullata alla fine.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shelves', type=int, default=20, help="Ripiani della libreria.")
+        parser.add_argument('--books-per-shelf', type=int, default=500, help="Libri per ripiano.")
+        parser.add_argument('--overflow', type=int, default=50,
+                            help="Libri con un ripiano oltre shelf_count (es. dopo aver tolto dei ripiani).")
+        parser.add_argument('--repeat', type=int, default=3, help="Ripetizioni (vale il tempo migliore).")
+
+    def timed(self, run, repeat):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = run()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best, result
+
+    def handle(self, *args, **options):
+        shelves, per_shelf, repeat = options['shelves'], options['books_per_shelf'], max(1, options['repeat'])
+        with transaction.atomic():
+            room = Room.objects.create(name="Benchmark")
+            bookshelf = Bookshelf.objects.create(name="Benchmark", room=room, shelf_count=shelves)
+            Book.objects.bulk_create(
+                [
+                    Book(title=f"Libro {shelf}-{i}", author="Autore", bookshelf=bookshelf,
+                         shelf_number=shelf, google_books_id=f"bench{shelf}-{i}")
+                    for shelf in range(1, shelves + 1) for i in range(per_shelf)
+                ] + [
+                    Book(title=f"Fuori posto {i}", author="Autore", bookshelf=bookshelf,
+                         shelf_number=shelves + 1 + i % 3, google_books_id=f"bench-overflow{i}")
+                    for i in range(options['overflow'])
+                ],
+                batch_size=5000,
+            )
+            total = shelves * per_shelf + options['overflow']
+            self.stdout.write(f"{shelves} ripiani x {per_shelf} libri (+{options['overflow']} fuori dai ripiani):")
+
+            before, old = self.timed(lambda: group_per_shelf_scan(bookshelf), repeat)
+            after, new = self.timed(lambda: bucket_books(bookshelf), repeat)
+            shown_before = sum(len(books) for books in old.values())
+            shown_after = sum(len(books) for _, books in new.items()) + len(new.overflow)
+            self.stdout.write(f"  raggruppamento: prima {before * 1000:.0f} ms ({shown_before}/{total} libri mostrati), "
+                              f"dopo {after * 1000:.0f} ms ({shown_after}/{total}) -> {before / after:.1f}x")
+
+            counts_time, _ = self.timed(lambda: shelf_counts(bookshelf).counts(), repeat)
+            self.stdout.write(f"  shelf_counts (book_detail): {counts_time * 1000:.1f} ms")
+
+            request = RequestFactory().get(f"/bookshelf/{bookshelf.pk}/")
+            page_time, response = self.timed(lambda: views.book_list(request, bookshelf.pk), repeat)
+            self.stdout.write(f"  pagina book_list: {page_time * 1000:.0f} ms ({len(response.content) // 1024} KB di HTML)")
+            # Il database resta com'era
+            transaction.set_rollback(True)
@@ -0,0 +1,118 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from library import book_detector, image_utils
+from library.vision_backends import VisionBackend
+
+# Ogni costa della foto finta ha un colore diverso: livelli 0, 50, ..., 250 per canale.
+# Il colore è il "titolo" che il modello finto legge (0 = nero, lo stacco tra due libri).
+_LEVEL = 50
+_LEVELS = 6
+
+
+def spine_color(spine_id):
+    return [(spine_id // _LEVELS ** channel) % _LEVELS * _LEVEL for channel in range(3)]
+
+
+def fixture_shelf(seed, spines, height, min_width, max_width):
+    """(byte JPEG, titoli attesi da sinistra a destra) di uno scaffale finto: coste colorate separate da righe nere."""
+    rng = np.random.default_rng(seed)
+    ids = rng.choice(np.arange(1, _LEVELS ** 3), size=spines, replace=False)
+    widths = rng.integers(min_width, max_width + 1, spines)
+    image = np.zeros((height, int(widths.sum()) + 3 * spines, 3), dtype=np.uint8)
+    left = 0
+    for spine_id, width in zip(ids, widths):
+        image[:, left:left + width] = spine_color(int(spine_id))
+        left += width + 3
+    noise = rng.normal(0, 4, image.shape)
+    data = image_utils.encode_jpeg(np.clip(image + noise, 0, 255).astype(np.uint8), 95)
+    return data, [f"Libro {spine_id}" for spine_id in ids]
+
+
+class StubModelBackend(VisionBackend):
+    """
+    Modello finto: ogni richiesta (GEMINI_BATCH_SIZE immagini, SHELF_TILE_WORKERS
+    in parallelo, come GeminiBackend) costa `latency` secondi, e una costa viene
+    letta solo se nell'immagine ricevuta è larga almeno `min_readable` pixel.
+    """
+    name = 'stub'
+
+    def __init__(self, latency, min_readable):
+        self.latency = latency
+        self.min_readable = min_readable
+        self.requests = 0
+
+    def read_spines(self, data):
+        image = image_utils.decode_image(data)
+        height = image.shape[0]
+        columns = np.median(image[height // 3:2 * height // 3], axis=0)
+        levels = np.clip(np.rint(columns / _LEVEL), 0, _LEVELS - 1).astype(int)
+        ids = levels[:, 0] + levels[:, 1] * _LEVELS + levels[:, 2] * _LEVELS ** 2
+        books = []
+        start = 0
+        for end in range(1, len(ids) + 1):
+            if end == len(ids) or ids[end] != ids[start]:
+                if ids[start] and end - start >= self.min_readable:
+                    books.append({'title': f"Libro {ids[start]}", 'author': "Autore di prova"})
+                start = end
+        return books
+
+    def detect_batch(self, images):
+        self.requests += 1
+        time.sleep(self.latency)
+        return [self.read_spines(data) for data, _ in images]
+
+    def detect(self, images):
+        size = settings.GEMINI_BATCH_SIZE
+        batches = [images[i:i + size] for i in range(0, len(images), size)]
+        with ThreadPoolExecutor(max_workers=settings.SHELF_TILE_WORKERS) as executor:
+            return [books for result in executor.map(self.detect_batch, batches) for books in result]
+
+
+class Command(BaseCommand):
+    help = ("Throughput e recall del riconoscimento su scaffali finti con un modello finto: "
+            "foto intere ridotte a GEMINI_IMAGE_MAX_DIMENSION (come prima) contro la divisione in tasselli.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--photos', type=int, default=6, help="Foto finte.")
+        parser.add_argument('--spines', type=int, default=80, help="Libri per foto.")
+        parser.add_argument('--height', type=int, default=600, help="Altezza delle foto in pixel.")
+        parser.add_argument('--spine-width', type=int, nargs=2, default=[40, 90], metavar=('MIN', 'MAX'),
+                            help="Larghezza delle coste in pixel.")
+        parser.add_argument('--latency', type=float, default=0.3, help="Secondi per richiesta al modello finto.")
+        parser.add_argument('--min-readable', type=int, default=32,
+                            help="Larghezza minima (px) di una costa perché il modello finto la legga.")
+
+    def handle(self, *args, **options):
+        min_width, max_width = options['spine_width']
+        fixtures = [
+            fixture_shelf(seed, options['spines'], options['height'], min_width, max_width)
+            for seed in range(options['photos'])
+        ]
+        total_expected = sum(len(expected) for _, expected in fixtures)
+
+        # Senza tasselli: nessuna foto supera il rapporto, come prima della suddivisione
+        for label, max_aspect in (('foto intere', 1e9), ('tasselli', settings.SHELF_TILE_MAX_ASPECT)):
+            backend = StubModelBackend(options['latency'], options['min_readable'])
+            with override_settings(SHELF_TILE_MAX_ASPECT=max_aspect):
+                start = time.perf_counter()
+                images = [image_utils.prepare_image_for_model(data) for data, _ in fixtures]
+                found = book_detector.detect_shelf_images(images, backend=backend, use_cache=False)
+                elapsed = time.perf_counter() - start
+
+            matches = sum(
+                len({book['title'] for book in books} & set(expected))
+                for books, (_, expected) in zip(found, fixtures)
+            )
+            total_found = sum(len(books) for books in found)
+            self.stdout.write(
+                f"{label}: {len(fixtures)} foto in {backend.requests} richieste, "
+                f"{elapsed * 1000 / len(fixtures):.0f} ms/foto ({len(fixtures) / elapsed:.1f} foto/s), "
+                f"recall {matches / total_expected:.0%} ({matches}/{total_expected}), "
+                f"precisione {matches / total_found if total_found else 0:.0%}"
+            )
@@ -0,0 +1,71 @@
+import json
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+from library import book_detector, image_utils
+from library.book_matcher import dice, trigrams
+
+
+def count_matches(expected, found):
+    """Libri attesi ritrovati (titolo abbastanza simile, ogni libro trovato vale una volta sola)."""
+    unused = [trigrams(book['title']) for book in found]
+    matches = 0
+    for book in expected:
+        grams = trigrams(book['title'])
+        scores = [dice(grams, candidate) for candidate in unused]
+        if scores and max(scores) >= settings.BOOK_MATCH_MIN_TITLE_SCORE:
+            unused.pop(scores.index(max(scores)))
+            matches += 1
+    return matches
+
+
+class Command(BaseCommand):
+    help = ("Confronta i backend di riconoscimento (VISION_BACKEND) sulle stesse foto: "
+            "tempo per foto e, con --expected, recall e precisione sui titoli.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('photos', nargs='+', help="Foto degli scaffali.")
+        parser.add_argument('--backend', action='append', dest='backends',
+                            help="Classe del backend (ripetibile). Default: VISION_BACKEND.")
+        parser.add_argument('--expected',
+                            help='JSON {"nome del file": [{"title": ..., "author": ...}, ...]} con i libri presenti in ogni foto.')
+        parser.add_argument('--repeat', type=int, default=1, help="Ripetizioni (vale il tempo migliore).")
+
+    def handle(self, *args, **options):
+        photos = options['photos']
+        images = []
+        for path in photos:
+            with open(path, 'rb') as photo:
+                images.append(image_utils.prepare_image_for_model(photo.read()))
+
+        expected = None
+        if options['expected']:
+            with open(options['expected'], encoding='utf-8') as f:
+                by_name = json.load(f)
+            try:
+                expected = [by_name[os.path.basename(path)] for path in photos]
+            except KeyError as e:
+                raise CommandError(f"Nessun libro atteso per {e}")
+
+        for path in options['backends'] or [settings.VISION_BACKEND]:
+            # Il backend viene creato fuori dal tempo misurato (es. caricamento dei modelli ONNX)
+            backend = import_string(path)()
+            best = None
+            for _ in range(max(1, options['repeat'])):
+                start = time.perf_counter()
+                found = book_detector.detect_shelf_images(images, backend=backend, use_cache=False)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+
+            total_found = sum(len(books) for books in found)
+            line = f"{backend.name}: {len(images)} foto, {total_found} libri, {best * 1000 / len(images):.0f} ms/foto"
+            if expected is not None:
+                matches = sum(count_matches(books, result) for books, result in zip(expected, found))
+                total_expected = sum(len(books) for books in expected)
+                line += (f", recall {matches / total_expected:.0%} ({matches}/{total_expected})"
+                         f", precisione {matches / total_found if total_found else 0:.0%}")
+            self.stdout.write(line)
@@ -0,0 +1,31 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from library import catalog
+
+
+class Command(BaseCommand):
+    help = "Esporta tutto il catalogo (stanze, librerie, libri) in JSONL o CSV, in streaming."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default='-', help="File di destinazione (- o niente per lo standard output).")
+        parser.add_argument('--format', choices=['jsonl', 'csv'], help="Formato (di default dedotto dall'estensione, altrimenti jsonl).")
+        parser.add_argument('--chunk-size', type=int, help="Righe lette dal database alla volta (default CATALOG_CHUNK_SIZE).")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or ('csv' if path.endswith('.csv') else 'jsonl')
+        export = catalog.export_csv if fmt == 'csv' else catalog.export_jsonl
+
+        output = sys.stdout if path == '-' else open(path, 'w', encoding='utf-8', newline='')
+        try:
+            lines = 0
+            for line in export(options['chunk_size']):
+                output.write(line)
+                lines += 1
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        if path != '-':
+            self.stderr.write(self.style.SUCCESS(f"Esportate {lines} righe in {path}."))
@@ -0,0 +1,43 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from library import cover_fallback, covers, instrumentation
+
+
+class Command(BaseCommand):
+    help = ("Cerca su Google Immagini le copertine che Google Books non ha, poi scarica "
+            "le copertine in coda e ne crea le miniature (cache locale).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help="Scarica le copertine in coda e poi termina.")
+        parser.add_argument('--sleep', type=float, default=settings.INGESTION_POLL_INTERVAL,
+                            help="Secondi di attesa tra un controllo della coda e il successivo.")
+        parser.add_argument('--backfill', action='store_true',
+                            help="Prima di iniziare mette in coda le copertine (e le ricerche) di tutti i libri già salvati.")
+        parser.add_argument('--metrics-port', type=int,
+                            help="Espone le metriche del worker (formato Prometheus) su http://0.0.0.0:<porta>/metrics.")
+
+    def handle(self, *args, **options):
+        if options['metrics_port']:
+            instrumentation.serve_metrics(options['metrics_port'])
+        if options['backfill']:
+            cover_fallback.enqueue_missing()
+            covers.enqueue_missing()
+        self.stdout.write("Worker delle copertine avviato.")
+        try:
+            while True:
+                searched = cover_fallback.run_pending_searches()
+                if searched:
+                    self.stdout.write(f"Cercate {searched} copertine su Google Immagini.")
+                processed = covers.fetch_pending_covers()
+                if processed:
+                    self.stdout.write(f"Elaborate {processed} copertine.")
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
+        except KeyboardInterrupt:
+            # Le copertine prenotate tornano disponibili dopo COVER_FETCH_LEASE secondi
+            self.stdout.write("Worker interrotto.")
@@ -0,0 +1,50 @@
+import json
+import sys
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from library import bulk_import
+from library.models import Bookshelf
+
+
+class Command(BaseCommand):
+    help = "Importa in una libreria una lista di ISBN e/o URL (Amazon, Google Books) da un file CSV o JSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument('bookshelf_id', type=int, help="ID della libreria di destinazione.")
+        parser.add_argument('path', help="File CSV o JSON con la lista (- per leggerla dallo standard input).")
+        parser.add_argument('--shelf', type=int, default=1, help="Ripiano su cui mettere i libri (default 1).")
+        parser.add_argument('--format', choices=['csv', 'json'], help="Formato del file (di default dedotto dal contenuto).")
+        parser.add_argument('--workers', type=int, help="Ricerche in parallelo (default BOOK_LOOKUP_WORKERS).")
+        parser.add_argument('--jsonl', action='store_true', help="Scrive l'esito di ogni riga in JSON, una per riga.")
+
+    def handle(self, *args, **options):
+        try:
+            bookshelf = Bookshelf.objects.get(pk=options['bookshelf_id'])
+        except Bookshelf.DoesNotExist:
+            raise CommandError(f"La libreria {options['bookshelf_id']} non esiste.")
+
+        if options['path'] == '-':
+            data = sys.stdin.read()
+        else:
+            data = Path(options['path']).read_bytes()
+        try:
+            entries = bulk_import.parse_entries(data, options['format'])
+        except bulk_import.ImportFormatError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(f"Importo {len(entries)} righe in '{bookshelf.name}' (ripiano {options['shelf']})...")
+        for result in bulk_import.import_entries(bookshelf, options['shelf'], entries, max_workers=options['workers']):
+            if options['jsonl']:
+                self.stdout.write(json.dumps(result, ensure_ascii=False))
+            elif result.get('done'):
+                summary = ", ".join(f"{status}: {count}" for status, count in sorted(result['counts'].items()))
+                self.stdout.write(self.style.SUCCESS(f"Fatto. {summary}"))
+            else:
+                line = f"[{result['row']}] {result['input']} -> {result['status']}"
+                if result.get('title'):
+                    line += f" ({result['title']})"
+                if result.get('error'):
+                    line += f": {result['error']}"
+                self.stdout.write(line)
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from library import catalog
+
+
+class Command(BaseCommand):
+    help = "Importa un catalogo esportato con export_catalog (crea nuove stanze, librerie e libri)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File JSONL o CSV da importare.")
+        parser.add_argument('--format', choices=['jsonl', 'csv'], help="Formato (di default dedotto dall'estensione, altrimenti jsonl).")
+        parser.add_argument('--batch-size', type=int, help="Libri salvati per ogni INSERT (default CATALOG_CHUNK_SIZE).")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or ('csv' if path.endswith('.csv') else 'jsonl')
+        read = catalog.read_csv if fmt == 'csv' else catalog.read_jsonl
+
+        # newline='' come richiesto dal modulo csv (i riassunti possono contenere a capo)
+        with open(path, encoding='utf-8-sig', newline='') as lines:
+            try:
+                counts = catalog.import_records(read(lines), batch_size=options['batch_size'])
+            except catalog.CatalogFormatError as e:
+                raise CommandError(str(e))
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Importate {counts['rooms']} stanze, {counts['bookshelves']} librerie, "
+            f"{counts['books']} libri ({counts['skipped']} righe saltate)."
+        ))
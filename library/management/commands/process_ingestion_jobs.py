@@ -0,0 +1,36 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from library import ingestion, instrumentation
+
+
+class Command(BaseCommand):
+    help = "Elabora in background le foto degli scaffali in coda (Gemini + Google Books)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help="Elabora le immagini in coda e poi termina.")
+        parser.add_argument('--sleep', type=float, default=settings.INGESTION_POLL_INTERVAL,
+                            help="Secondi di attesa tra un controllo della coda e il successivo.")
+        parser.add_argument('--async', dest='use_async', action='store_true',
+                            help="Analizza le foto con coroutine (client HTTP async) invece che con un pool di thread.")
+        parser.add_argument('--metrics-port', type=int,
+                            help="Espone le metriche del worker (formato Prometheus) su http://0.0.0.0:<porta>/metrics.")
+
+    def handle(self, *args, **options):
+        if options['metrics_port']:
+            instrumentation.serve_metrics(options['metrics_port'])
+        self.stdout.write("Worker di acquisizione avviato.")
+        try:
+            while True:
+                processed = ingestion.process_pending_images(use_async=options['use_async'])
+                if processed:
+                    self.stdout.write(f"Elaborate {processed} immagini.")
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
+        except KeyboardInterrupt:
+            # Le immagini rimaste "in elaborazione" verranno riprese al prossimo avvio
+            self.stdout.write("Worker interrotto.")
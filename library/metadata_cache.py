@@ -0,0 +1,204 @@
+# In library/metadata_cache.py
+"""
+Cache a due livelli per i metadati dei libri (Google Books).
+
+1. Livello locale: una TTLCache (cachetools) in memoria, per ogni processo.
+2. Livello condiviso: la cache Django indicata da BOOK_METADATA_CACHE_ALIAS
+   (di default una DatabaseCache), che sopravvive ai riavvii ed è condivisa
+   tra i worker.
+
+Anche i risultati "nessun libro trovato" vengono salvati (con un TTL più breve),
+così non rifacciamo la stessa ricerca a vuoto ad ogni nuova scansione.
+"""
+import functools
+import hashlib
+import inspect
+import re
+import threading
+import unicodedata
+
+from cachetools import TTLCache
+from django.conf import settings
+from django.core.cache import caches
+
+# Valore salvato nella cache condivisa per rappresentare un risultato negativo
+# (None non è utilizzabile: cache.get restituisce None anche in caso di miss).
+_NEGATIVE = '__not_found__'
+_MISSING = object()
+
+KEY_PREFIX = 'bookmeta'
+
+
+def normalize_text(value):
+    """
+    Normalizza una stringa di ricerca: minuscole, senza accenti,
+    spazi e punteggiatura compattati.
+    """
+    value = unicodedata.normalize('NFKD', str(value or ''))
+    value = ''.join(c for c in value if not unicodedata.combining(c))
+    value = re.sub(r'[^\w:+]+', ' ', value.lower())
+    return re.sub(r'\s+', ' ', value).strip()
+
+
+def make_key(kind, value):
+    """
+    Costruisce la chiave di cache, es. 'bookmeta:isbn:9788804668237'.
+    I valori con spazi o troppo lunghi vengono sostituiti dal loro hash,
+    così la chiave resta valida per qualsiasi backend di cache.
+    """
+    if len(value) > 100 or not re.fullmatch(r'[\w.:+-]*', value):
+        value = hashlib.sha1(value.encode('utf-8')).hexdigest()
+    return f"{KEY_PREFIX}:{kind}:{value}"
+
+
+def key_for_google_lookup(book_id=None, query=None, **kwargs):
+    """Chiave per get_book_details_from_google_api: volume id, ISBN o query normalizzata."""
+    if book_id:
+        return make_key('volume', book_id.strip())
+    normalized = normalize_text(query)
+    if normalized.startswith('isbn:'):
+        isbn = re.sub(r'[^0-9x]', '', normalized[5:])
+        return make_key('isbn', isbn)
+    return make_key('query', normalized)
+
+
+class MetadataCache:
+    """Cache a due livelli, thread-safe, con contatori di hit/miss."""
+
+    def __init__(self, maxsize, ttl, negative_ttl, alias):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.alias = alias
+        self._local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self._stats = {'local_hits': 0, 'shared_hits': 0, 'misses': 0, 'negative_hits': 0}
+
+    @property
+    def shared(self):
+        return caches[self.alias]
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _get_local(self, key):
+        with self._lock:
+            value = self._local.get(key, _MISSING)
+        if value is not _MISSING:
+            self._count('local_hits')
+        return value
+
+    def _got_shared(self, key, value):
+        if value is _MISSING:
+            self._count('misses')
+            return _MISSING
+        self._count('shared_hits')
+        with self._lock:
+            self._local[key] = value
+        return value
+
+    def _unwrap(self, value):
+        if value == _NEGATIVE:
+            self._count('negative_hits')
+            return None
+        return value
+
+    def _set_local(self, key, value):
+        stored = _NEGATIVE if value is None else value
+        with self._lock:
+            self._local[key] = stored
+        return stored, self.negative_ttl if value is None else self.ttl
+
+    def get(self, key):
+        """Restituisce il valore in cache (anche None per i negativi) oppure _MISSING."""
+        value = self._get_local(key)
+        if value is _MISSING:
+            value = self._got_shared(key, self.shared.get(key, _MISSING))
+            if value is _MISSING:
+                return _MISSING
+        return self._unwrap(value)
+
+    def set(self, key, value):
+        stored, timeout = self._set_local(key, value)
+        self.shared.set(key, stored, timeout=timeout)
+
+    async def aget(self, key):
+        """Come get(), per il codice async (la cache condivisa usa l'API async di Django)."""
+        value = self._get_local(key)
+        if value is _MISSING:
+            value = self._got_shared(key, await self.shared.aget(key, _MISSING))
+            if value is _MISSING:
+                return _MISSING
+        return self._unwrap(value)
+
+    async def aset(self, key, value):
+        stored, timeout = self._set_local(key, value)
+        await self.shared.aset(key, stored, timeout=timeout)
+
+    def delete(self, key):
+        with self._lock:
+            self._local.pop(key, None)
+        self.shared.delete(key)
+
+    def local_values(self):
+        """I risultati positivi (dizionari) della cache in memoria: li usa library/book_matcher.py."""
+        with self._lock:
+            return [value for value in self._local.values() if isinstance(value, dict)]
+
+    def clear_local(self):
+        with self._lock:
+            self._local.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['local_size'] = len(self._local)
+        lookups = stats['local_hits'] + stats['shared_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['local_hits'] + stats['shared_hits']) / lookups if lookups else 0.0
+        return stats
+
+    def reset_stats(self):
+        with self._lock:
+            for name in self._stats:
+                self._stats[name] = 0
+
+
+metadata_cache = MetadataCache(
+    maxsize=settings.BOOK_METADATA_CACHE_SIZE,
+    ttl=settings.BOOK_METADATA_CACHE_TTL,
+    negative_ttl=settings.BOOK_METADATA_NEGATIVE_TTL,
+    alias=settings.BOOK_METADATA_CACHE_ALIAS,
+)
+
+
+def cached_lookup(key_func):
+    """
+    Decoratore: memorizza il risultato della funzione nella metadata_cache.
+    `key_func` riceve gli stessi argomenti della funzione e restituisce la chiave.
+    Le eccezioni non vengono mai salvate in cache. Funziona anche con le
+    funzioni async (usa aget/aset).
+    """
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                key = key_func(*args, **kwargs)
+                value = await metadata_cache.aget(key)
+                if value is not _MISSING:
+                    return value
+                value = await func(*args, **kwargs)
+                await metadata_cache.aset(key, value)
+                return value
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = key_func(*args, **kwargs)
+            value = metadata_cache.get(key)
+            if value is not _MISSING:
+                return value
+            value = func(*args, **kwargs)
+            metadata_cache.set(key, value)
+            return value
+        return wrapper
+    return decorator
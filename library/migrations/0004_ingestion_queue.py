@@ -0,0 +1,44 @@
+# Generated by Django 5.2.5 on 2026-10-18 12:48
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0003_bookshelf_rotation_bookshelf_shape_type_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestionJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shelf_number', models.IntegerField(default=1)),
+                ('status', models.CharField(choices=[('pending', 'In attesa'), ('running', 'In corso'), ('done', 'Completato'), ('failed', 'Fallito')], default='pending', max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('bookshelf', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ingestion_jobs', to='library.bookshelf')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='IngestionImage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('filename', models.CharField(max_length=255)),
+                ('image_data', models.BinaryField(blank=True)),
+                ('status', models.CharField(choices=[('pending', 'In attesa'), ('processing', 'In elaborazione'), ('done', 'Completata'), ('failed', 'Fallita')], default='pending', max_length=20)),
+                ('attempts', models.IntegerField(default=0)),
+                ('books_found', models.IntegerField(default=0)),
+                ('books_added', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('locked_at', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='images', to='library.ingestionjob')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'locked_at'], name='library_ing_status_76ed97_idx')],
+            },
+        ),
+    ]
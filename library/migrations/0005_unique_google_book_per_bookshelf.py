@@ -0,0 +1,35 @@
+# Generated by Django 5.2.5 on 2026-10-18 12:50
+
+from django.db import migrations, models
+
+
+def remove_duplicate_books(apps, schema_editor):
+    """Prima di aggiungere il vincolo, teniamo solo la copia più vecchia di ogni doppione."""
+    Book = apps.get_model('library', 'Book')
+    seen = set()
+    duplicate_ids = []
+    books = (
+        Book.objects.exclude(google_books_id__isnull=True).exclude(google_books_id='')
+        .order_by('id').values_list('id', 'bookshelf_id', 'google_books_id')
+    )
+    for book_id, bookshelf_id, google_id in books.iterator():
+        if (bookshelf_id, google_id) in seen:
+            duplicate_ids.append(book_id)
+        else:
+            seen.add((bookshelf_id, google_id))
+    Book.objects.filter(id__in=duplicate_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0004_ingestion_queue'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_books, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='book',
+            constraint=models.UniqueConstraint(condition=models.Q(('google_books_id', ''), _negated=True), fields=('bookshelf', 'google_books_id'), name='unique_google_book_per_bookshelf'),
+        ),
+    ]
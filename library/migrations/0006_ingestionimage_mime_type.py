@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-18 12:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0005_unique_google_book_per_bookshelf'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingestionimage',
+            name='mime_type',
+            field=models.CharField(default='image/jpeg', max_length=50),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.5 on 2026-10-18 12:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0006_ingestionimage_mime_type'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShelfImageFingerprint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dhash', models.CharField(db_index=True, max_length=64)),
+                ('detections', models.JSONField(default=list)),
+                ('hits', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,89 @@
+from django.db import migrations
+
+# SQL copiato da library/search.py così com'era quando è stata scritta questa
+# migrazione: una migrazione storica non deve cambiare se cambia il codice dell'app.
+FTS_TABLE = 'library_book_fts'
+
+SQLITE_SETUP_SQL = [
+    f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        title, author, summary,
+        content='library_book', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON library_book BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, title, author, summary)
+        VALUES (new.id, new.title, new.author, new.summary);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON library_book BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, author, summary)
+        VALUES ('delete', old.id, old.title, old.author, old.summary);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE ON library_book BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, author, summary)
+        VALUES ('delete', old.id, old.title, old.author, old.summary);
+        INSERT INTO {FTS_TABLE}(rowid, title, author, summary)
+        VALUES (new.id, new.title, new.author, new.summary);
+    END
+    """,
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')",
+]
+
+SQLITE_TEARDOWN_SQL = [
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_ai",
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_ad",
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_au",
+    f"DROP TABLE IF EXISTS {FTS_TABLE}",
+]
+
+POSTGRES_VECTOR = (
+    "setweight(to_tsvector('simple', library_unaccent(coalesce(library_book.title, ''))), 'A') || "
+    "setweight(to_tsvector('simple', library_unaccent(coalesce(library_book.author, ''))), 'B') || "
+    "setweight(to_tsvector('simple', library_unaccent(coalesce(library_book.summary, ''))), 'C')"
+)
+
+POSTGRES_SETUP_SQL = [
+    "CREATE EXTENSION IF NOT EXISTS unaccent",
+    """
+    CREATE OR REPLACE FUNCTION library_unaccent(text) RETURNS text AS
+    $$ SELECT public.unaccent('public.unaccent', $1) $$
+    LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT
+    """,
+    f"CREATE INDEX IF NOT EXISTS library_book_search_idx ON library_book USING gin (({POSTGRES_VECTOR}))",
+]
+
+POSTGRES_TEARDOWN_SQL = [
+    "DROP INDEX IF EXISTS library_book_search_idx",
+    "DROP FUNCTION IF EXISTS library_unaccent(text)",
+]
+
+
+def _run(schema_editor, statements):
+    vendor = schema_editor.connection.vendor
+    for sql in statements.get(vendor, []):
+        schema_editor.execute(sql)
+
+
+def forwards(apps, schema_editor):
+    _run(schema_editor, {'sqlite': SQLITE_SETUP_SQL, 'postgresql': POSTGRES_SETUP_SQL})
+
+
+def backwards(apps, schema_editor):
+    _run(schema_editor, {'sqlite': SQLITE_TEARDOWN_SQL, 'postgresql': POSTGRES_TEARDOWN_SQL})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0007_shelfimagefingerprint'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, backwards),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-18 13:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0009_book_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bookshelf',
+            name='version',
+            field=models.IntegerField(default=1),
+        ),
+    ]
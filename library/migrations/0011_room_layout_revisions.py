@@ -0,0 +1,46 @@
+# Generated by Django 5.2.5 on 2026-10-18 13:06
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0010_bookshelf_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeletedBookshelf',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bookshelf_id', models.IntegerField()),
+                ('revision', models.IntegerField()),
+                ('deleted_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='bookshelf',
+            name='revision',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='revision',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='bookshelf',
+            index=models.Index(fields=['room', 'revision'], name='bookshelf_room_revision_idx'),
+        ),
+        migrations.AddField(
+            model_name='deletedbookshelf',
+            name='room',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deleted_bookshelves', to='library.room'),
+        ),
+        migrations.AddIndex(
+            model_name='deletedbookshelf',
+            index=models.Index(fields=['room', 'revision'], name='deleted_shelf_room_rev_idx'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.5 on 2026-10-18 13:48
+
+import hashlib
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def enqueue_existing_covers(apps, schema_editor):
+    """Mette in coda le copertine dei libri già presenti (le scaricherà fetch_covers)."""
+    Book = apps.get_model('library', 'Book')
+    CoverImage = apps.get_model('library', 'CoverImage')
+    urls = Book.objects.exclude(cover_url__isnull=True).exclude(cover_url='').values_list('cover_url', flat=True).distinct()
+    CoverImage.objects.bulk_create(
+        [CoverImage(url_hash=hashlib.sha256(url.encode('utf-8')).hexdigest(), source_url=url) for url in urls.iterator()],
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0011_room_layout_revisions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CoverImage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url_hash', models.CharField(max_length=64, unique=True)),
+                ('source_url', models.TextField()),
+                ('status', models.CharField(choices=[('pending', 'Da scaricare'), ('done', 'Scaricata'), ('failed', 'Non disponibile')], default='pending', max_length=20)),
+                ('content_hash', models.CharField(blank=True, max_length=64)),
+                ('mime_type', models.CharField(blank=True, max_length=50)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('error', models.TextField(blank=True)),
+                ('fetched_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'next_attempt_at'], name='cover_status_next_idx')],
+            },
+        ),
+        migrations.RunPython(enqueue_existing_covers, migrations.RunPython.noop),
+    ]
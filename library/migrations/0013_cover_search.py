@@ -0,0 +1,31 @@
+# Generated by Django 5.2.5 on 2026-10-18 13:52
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0012_cover_cache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CoverSearch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('google_books_id', models.CharField(max_length=50, unique=True)),
+                ('title', models.CharField(max_length=200)),
+                ('status', models.CharField(choices=[('pending', 'Da cercare'), ('found', 'Trovata'), ('not_found', 'Nessuna copertina')], default='pending', max_length=20)),
+                ('cover_url', models.URLField(blank=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('error', models.TextField(blank=True)),
+                ('searched_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'next_attempt_at'], name='cover_search_status_next_idx')],
+            },
+        ),
+    ]
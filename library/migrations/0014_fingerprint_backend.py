@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-18 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0013_cover_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shelfimagefingerprint',
+            name='backend',
+            field=models.CharField(default='gemini', max_length=50),
+        ),
+    ]
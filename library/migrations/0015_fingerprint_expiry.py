@@ -0,0 +1,26 @@
+# Generated by Django 5.2.5 on 2026-10-18 14:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0014_fingerprint_backend'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='shelfimagefingerprint',
+            name='dhash',
+            field=models.CharField(max_length=64),
+        ),
+        migrations.AddIndex(
+            model_name='shelfimagefingerprint',
+            index=models.Index(fields=['backend', '-last_used_at'], name='fingerprint_recent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='shelfimagefingerprint',
+            index=models.Index(fields=['created_at'], name='fingerprint_created_idx'),
+        ),
+    ]
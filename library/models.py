@@ -1,7 +1,11 @@
 from django.db import models
+from django.utils import timezone
 
 class Room(models.Model):
     name = models.CharField(max_length=100)
+    # Numero di revisione del layout: cresce di 1 ad ogni salvataggio che
+    # modifica le librerie della stanza (vedi library/layout.py)
+    revision = models.IntegerField(default=0)
 
     def __str__(self):
         return self.name
@@ -27,9 +31,35 @@ class Bookshelf(models.Model):
     shape_type = models.CharField(max_length=20, choices=SHAPE_CHOICES, default='rectangle')
     rotation = models.IntegerField(default=0) # Gradi: 0, 90, 180, 270
 
+    # Incrementata ad ogni modifica del layout: l'editor la rimanda indietro
+    # per accorgersi se qualcun altro ha salvato nel frattempo
+    version = models.IntegerField(default=1)
+    # Revisione della stanza in cui la libreria è stata modificata l'ultima volta
+    revision = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [models.Index(fields=['room', 'revision'], name='bookshelf_room_revision_idx')]
+
     def __str__(self):
         return f"{self.name} in {self.room.name}"
 
+
+class DeletedBookshelf(models.Model):
+    """
+    Traccia di una libreria cancellata, così gli editor aperti in altre
+    schede possono toglierla dal disegno quando chiedono le modifiche.
+    """
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='deleted_bookshelves')
+    bookshelf_id = models.IntegerField()
+    revision = models.IntegerField()
+    deleted_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['room', 'revision'], name='deleted_shelf_room_rev_idx')]
+
+    def __str__(self):
+        return f"Libreria {self.bookshelf_id} (revisione {self.revision})"
+
 class Book(models.Model):
     title = models.CharField(max_length=200)
     author = models.CharField(max_length=100, blank=True)
@@ -43,5 +73,173 @@ class Book(models.Model):
     shelf_number = models.IntegerField()
     user_rating = models.IntegerField(null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            # Ordinamento stabile (titolo, id) per la paginazione a cursore
+            models.Index(fields=['title', 'id'], name='book_title_id_idx'),
+            models.Index(fields=['bookshelf', 'title', 'id'], name='book_bookshelf_title_id_idx'),
+        ]
+        constraints = [
+            # Lo stesso libro (stesso google_books_id) una sola volta per libreria
+            models.UniqueConstraint(
+                fields=['bookshelf', 'google_books_id'],
+                condition=~models.Q(google_books_id=''),
+                name='unique_google_book_per_bookshelf',
+            ),
+        ]
+
+    def __str__(self):
+        return self.title
+
+# --- CODA DI ACQUISIZIONE DELLE FOTO DEGLI SCAFFALI ---
+class IngestionJob(models.Model):
+    """Un caricamento di una o più foto, elaborato in background."""
+    STATUS_CHOICES = [
+        ('pending', 'In attesa'),
+        ('running', 'In corso'),
+        ('done', 'Completato'),
+        ('failed', 'Fallito'),
+    ]
+
+    bookshelf = models.ForeignKey(Bookshelf, on_delete=models.CASCADE, related_name='ingestion_jobs')
+    shelf_number = models.IntegerField(default=1)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Job {self.pk} ({self.get_status_display()})"
+
+    def refresh_status(self):
+        """Ricalcola lo stato del job a partire dallo stato delle sue immagini."""
+        statuses = set(self.images.values_list('status', flat=True))
+        if not statuses or statuses == {'pending'}:
+            status = 'pending'
+        elif statuses & {'pending', 'processing'}:
+            status = 'running'
+        elif statuses == {'failed'}:
+            status = 'failed'
+        else:
+            status = 'done'
+        if status != self.status:
+            self.status = status
+            self.save(update_fields=['status', 'updated_at'])
+        return status
+
+
+class IngestionImage(models.Model):
+    """Una singola foto di un IngestionJob; viene elaborata (e ritentata) da sola."""
+    STATUS_CHOICES = [
+        ('pending', 'In attesa'),
+        ('processing', 'In elaborazione'),
+        ('done', 'Completata'),
+        ('failed', 'Fallita'),
+    ]
+
+    job = models.ForeignKey(IngestionJob, on_delete=models.CASCADE, related_name='images')
+    filename = models.CharField(max_length=255)
+    # I byte della foto restano nel database finché l'elaborazione non va a buon fine:
+    # così la coda sopravvive ai riavvii del worker senza dipendere dal filesystem.
+    image_data = models.BinaryField(blank=True)
+    mime_type = models.CharField(max_length=50, default='image/jpeg')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.IntegerField(default=0)
+    books_found = models.IntegerField(default=0)
+    books_added = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'locked_at'])]
+
+    def __str__(self):
+        return f"{self.filename} ({self.get_status_display()})"
+
+
+
+# --- CACHE DEI RISULTATI DI GEMINI PER FOTO GIÀ VISTE ---
+class ShelfImageFingerprint(models.Model):
+    """
+    Impronta percettiva (dHash) di una foto già analizzata, con i libri che
+    Gemini (o un altro backend) vi ha riconosciuto. Una nuova foto quasi
+    identica riusa questi risultati senza chiamare di nuovo il modello.
+    """
+    dhash = models.CharField(max_length=64)  # esadecimale (confrontato in Python, non cercato)
+    # VisionBackend.name di chi ha letto i libri: backend diversi non condividono i risultati
+    backend = models.CharField(max_length=50, default='gemini')
+    detections = models.JSONField(default=list)
+    hits = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # Candidati da confrontare: le impronte usate più di recente, per backend
+            models.Index(fields=['backend', '-last_used_at'], name='fingerprint_recent_idx'),
+            # Pulizia di quelle scadute (IMAGE_FINGERPRINT_TTL)
+            models.Index(fields=['created_at'], name='fingerprint_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.dhash[:12]}... ({len(self.detections)} libri)"
+
+
+# --- CACHE LOCALE DELLE COPERTINE ---
+class CoverImage(models.Model):
+    """
+    Una copertina remota (cover_url dei libri) da scaricare una volta sola.
+    I file stanno in COVER_CACHE_DIR, con il nome dato dallo SHA-256 del
+    contenuto: URL diversi con la stessa immagine condividono i file.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Da scaricare'),
+        ('done', 'Scaricata'),
+        ('failed', 'Non disponibile'),
+    ]
+
+    # SHA-256 dell'URL: è la chiave usata negli indirizzi /covers/<url_hash>/
+    url_hash = models.CharField(max_length=64, unique=True)
+    source_url = models.TextField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    content_hash = models.CharField(max_length=64, blank=True)
+    mime_type = models.CharField(max_length=50, blank=True)
+    attempts = models.IntegerField(default=0)
+    # Dopo un errore il prossimo tentativo viene rimandato sempre più in là (backoff)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    error = models.TextField(blank=True)
+    fetched_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'next_attempt_at'], name='cover_status_next_idx')]
+
+    def __str__(self):
+        return f"{self.source_url[:60]} ({self.get_status_display()})"
+
+
+class CoverSearch(models.Model):
+    """
+    Ricerca su Google Immagini della copertina di un libro che Google Books
+    non ha, fatta in background una volta sola per google_books_id. Anche
+    l'esito "nessuna copertina" resta salvato, così non la ripetiamo.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Da cercare'),
+        ('found', 'Trovata'),
+        ('not_found', 'Nessuna copertina'),
+    ]
+
+    google_books_id = models.CharField(max_length=50, unique=True)
+    title = models.CharField(max_length=200)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    cover_url = models.URLField(blank=True)
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    error = models.TextField(blank=True)
+    searched_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'next_attempt_at'], name='cover_search_status_next_idx')]
+
     def __str__(self):
-        return self.title
\ No newline at end of file
+        return f"{self.title} ({self.get_status_display()})"
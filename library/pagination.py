@@ -0,0 +1,92 @@
+# In library/pagination.py
+"""
+Paginazione "a cursore" (keyset) per gli elenchi di libri.
+
+Invece di OFFSET (che costringe il database a scorrere tutte le righe
+precedenti) ricordiamo i valori dell'ultimo elemento della pagina, es.
+(titolo, id), e chiediamo le righe che vengono dopo: il costo di ogni
+pagina resta costante anche con cataloghi enormi, purché l'ordinamento
+sia coperto da un indice (vedi Book.Meta.indexes).
+"""
+import base64
+import binascii
+import json
+
+from django.conf import settings
+from django.db.models import Q
+
+
+def encode_cursor(values):
+    """Trasforma i valori dell'ultimo elemento in un token opaco da mettere nell'URL."""
+    raw = json.dumps(list(values), separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, size):
+    """Decodifica un cursore; restituisce None se è assente o non valido."""
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (ValueError, binascii.Error, UnicodeError):
+        return None
+    if not isinstance(values, list) or len(values) != size:
+        return None
+    # Solo valori semplici, e l'ultimo è sempre la chiave univoca (es. 'id'): un cursore
+    # modificato a mano non deve far fallire la query né saltare dei risultati
+    if not all(isinstance(value, (str, int, float)) for value in values) or type(values[-1]) is not int:
+        return None
+    return values
+
+
+def keyset_after(queryset, fields, values):
+    """
+    Righe che vengono dopo `values` nell'ordinamento (crescente) `fields`:
+    (a > x) OR (a = x AND b > y) OR ...
+    """
+    condition = Q()
+    for i, field in enumerate(fields):
+        step = Q(**{f"{field}__gt": values[i]})
+        for previous_field, previous_value in zip(fields[:i], values[:i]):
+            step &= Q(**{previous_field: previous_value})
+        condition |= step
+    return queryset.filter(condition)
+
+
+class KeysetPage:
+    """Una pagina di risultati con il cursore per la pagina successiva."""
+
+    def __init__(self, items, next_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def paginate(queryset, fields, cursor=None, page_size=None, after=keyset_after):
+    """
+    Restituisce la KeysetPage che segue `cursor` ordinando per `fields`
+    (tutti crescenti; l'ultimo campo deve essere una chiave intera univoca, es. 'id').
+    `after` permette di personalizzare il filtro (es. per il rank della ricerca).
+    """
+    page_size = page_size or settings.LIBRARY_PAGE_SIZE
+    values = decode_cursor(cursor, len(fields))
+    if values is not None:
+        queryset = after(queryset, fields, values)
+
+    # Chiediamo un elemento in più solo per sapere se esiste una pagina successiva
+    items = list(queryset.order_by(*fields)[:page_size + 1])
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        next_cursor = encode_cursor(getattr(items[-1], field) for field in fields)
+    return KeysetPage(items, next_cursor)
@@ -0,0 +1,209 @@
+# In library/search.py
+"""
+Ricerca full-text sui libri (titolo, autore e riassunto).
+
+- SQLite: tabella virtuale FTS5 `library_book_fts` (external content su
+  library_book), aggiornata da trigger, ordinata con bm25.
+- PostgreSQL: indice GIN su un tsvector pesato (titolo > autore > riassunto),
+  ordinato con ts_rank.
+- Altri database: ripiego su icontains, come la vecchia ricerca.
+
+In tutti i casi la ricerca ignora maiuscole e accenti ("perche" trova
+"Perché") e ogni parola vale anche come prefisso ("manz" trova "Manzoni").
+"""
+import re
+
+from django.db import connections
+from django.db.models import BooleanField, Q
+from django.db.models.expressions import RawSQL
+
+from .metadata_cache import normalize_text
+from .pagination import keyset_after
+
+FTS_TABLE = 'library_book_fts'
+
+# Pesi delle colonne nel ranking: un match nel titolo conta più di uno nel riassunto
+_SQLITE_RANK = f"bm25({FTS_TABLE}, 10.0, 5.0, 1.0)"
+
+SQLITE_SETUP_SQL = [
+    f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        title, author, summary,
+        content='library_book', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON library_book BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, title, author, summary)
+        VALUES (new.id, new.title, new.author, new.summary);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON library_book BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, author, summary)
+        VALUES ('delete', old.id, old.title, old.author, old.summary);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE ON library_book BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, author, summary)
+        VALUES ('delete', old.id, old.title, old.author, old.summary);
+        INSERT INTO {FTS_TABLE}(rowid, title, author, summary)
+        VALUES (new.id, new.title, new.author, new.summary);
+    END
+    """,
+]
+
+SQLITE_TEARDOWN_SQL = [
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_ai",
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_ad",
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_au",
+    f"DROP TABLE IF EXISTS {FTS_TABLE}",
+]
+
+# unaccent() non è IMMUTABLE, quindi non può stare in un indice: lo avvolgiamo
+# in una funzione IMMUTABLE (la soluzione raccomandata dalla documentazione di PostgreSQL)
+_POSTGRES_VECTOR = (
+    "setweight(to_tsvector('simple', library_unaccent(coalesce(library_book.title, ''))), 'A') || "
+    "setweight(to_tsvector('simple', library_unaccent(coalesce(library_book.author, ''))), 'B') || "
+    "setweight(to_tsvector('simple', library_unaccent(coalesce(library_book.summary, ''))), 'C')"
+)
+
+POSTGRES_SETUP_SQL = [
+    "CREATE EXTENSION IF NOT EXISTS unaccent",
+    """
+    CREATE OR REPLACE FUNCTION library_unaccent(text) RETURNS text AS
+    $$ SELECT public.unaccent('public.unaccent', $1) $$
+    LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT
+    """,
+    f"CREATE INDEX IF NOT EXISTS library_book_search_idx ON library_book USING gin (({_POSTGRES_VECTOR}))",
+]
+
+POSTGRES_TEARDOWN_SQL = [
+    "DROP INDEX IF EXISTS library_book_search_idx",
+    "DROP FUNCTION IF EXISTS library_unaccent(text)",
+]
+
+
+def search_terms(text):
+    """Parole della ricerca, in minuscolo e senza accenti."""
+    return re.findall(r'\w+', normalize_text(text))
+
+
+def _sqlite_match_query(terms):
+    # Ogni parola tra virgolette (niente sintassi FTS5 dall'utente) e come prefisso; spazio = AND
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+def _postgres_tsquery(terms):
+    return ' & '.join(f"{term}:*" for term in terms)
+
+
+def search_books(queryset, text):
+    """
+    Filtra `queryset` (di Book) con la ricerca full-text e lo annota con `rank`
+    (più basso = più rilevante), già ordinato per rilevanza.
+    """
+    terms = search_terms(text)
+    if not terms:
+        return queryset.none()
+
+    vendor = connections[queryset.db].vendor
+    if vendor == 'sqlite':
+        # bm25() funziona solo nella query che fa il MATCH: serve una JOIN con la
+        # tabella FTS (una sottoquery correlata rifarebbe il MATCH per ogni riga)
+        return queryset.extra(
+            tables=[FTS_TABLE],
+            where=[f"{FTS_TABLE}.rowid = library_book.id", f"{FTS_TABLE} MATCH %s"],
+            params=[_sqlite_match_query(terms)],
+            select={'rank': _SQLITE_RANK},
+        ).order_by('rank', 'id')
+
+    if vendor == 'postgresql':
+        tsquery = _postgres_tsquery(terms)
+        return queryset.annotate(
+            search_match=RawSQL(
+                f"({_POSTGRES_VECTOR}) @@ to_tsquery('simple', %s)", [tsquery], output_field=BooleanField(),
+            ),
+            # ts_rank: più alto = più rilevante; lo neghiamo per avere lo stesso verso di bm25
+            rank=RawSQL(f"-ts_rank({_POSTGRES_VECTOR}, to_tsquery('simple', %s))", [tsquery]),
+        ).filter(search_match=True).order_by('rank', 'id')
+
+    # Ripiego per gli altri database: nessun indice, ma stessi risultati (senza accenti esclusi)
+    for term in terms:
+        queryset = queryset.filter(
+            Q(title__icontains=term) | Q(author__icontains=term) | Q(summary__icontains=term)
+        )
+    return queryset.order_by('title', 'id')
+
+
+def search_ordering(queryset):
+    """Campi con cui paginare i risultati di search_books (vedi library/pagination.py)."""
+    if connections[queryset.db].vendor in ('sqlite', 'postgresql'):
+        return ('rank', 'id')
+    return ('title', 'id')
+
+
+def search_after(queryset, fields, values):
+    """
+    Filtro keyset per i risultati di search_books. Su SQLite il rank è una
+    colonna "extra" (bm25) e non si può usare in filter(): scriviamo la
+    condizione direttamente in SQL.
+    """
+    if connections[queryset.db].vendor == 'sqlite' and tuple(fields) == ('rank', 'id'):
+        rank, last_id = values
+        return queryset.extra(
+            where=[f"({_SQLITE_RANK} > %s OR ({_SQLITE_RANK} = %s AND library_book.id > %s))"],
+            params=[rank, rank, last_id],
+        )
+    return keyset_after(queryset, fields, values)
+
+
+def create_search_index(schema_editor, rebuild=True):
+    """Crea (se mancano) indice e trigger per il database in uso."""
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        for sql in SQLITE_SETUP_SQL:
+            schema_editor.execute(sql)
+        if rebuild:
+            schema_editor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+    elif vendor == 'postgresql':
+        for sql in POSTGRES_SETUP_SQL:
+            schema_editor.execute(sql)
+
+
+def drop_search_index(schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        statements = SQLITE_TEARDOWN_SQL
+    elif vendor == 'postgresql':
+        statements = POSTGRES_TEARDOWN_SQL
+    else:
+        return
+    for sql in statements:
+        schema_editor.execute(sql)
+
+
+def ensure_sqlite_triggers(sender, using='default', **kwargs):
+    """
+    Handler di post_migrate. Su SQLite, quando una migrazione modifica la
+    tabella library_book, Django la ricrea da zero e i trigger FTS spariscono:
+    qui li ricreiamo e ricostruiamo l'indice.
+    """
+    db = connections[using]
+    if db.vendor != 'sqlite':
+        return
+    with db.cursor() as cursor:
+        tables = {row.name for row in db.introspection.get_table_list(cursor)}
+        if 'library_book' not in tables or FTS_TABLE not in tables:
+            return
+        cursor.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'library_book' "
+            "AND name LIKE %s",
+            [f"{FTS_TABLE}_%"],
+        )
+        if cursor.fetchone()[0] == 3:
+            return
+    with db.schema_editor() as schema_editor:
+        create_search_index(schema_editor, rebuild=True)
@@ -0,0 +1,79 @@
+# In library/shelving.py
+"""
+Raggruppamento dei libri per ripiano, in un solo passaggio.
+
+Usato da tutte le viste che disegnano uno scaffale (book_list, book_detail):
+una sola query ordinata per (shelf_number, title) e un dizionario di liste,
+invece di filtrare tutti i libri una volta per ogni ripiano.
+"""
+from django.db.models import Count
+
+
+class ShelfBuckets:
+    """
+    Libri di una libreria divisi per ripiano.
+    `shelves` ha sempre tutte le chiavi da 1 a shelf_count (anche i ripiani vuoti);
+    i libri con un numero di ripiano fuori da questo intervallo (es. dopo aver
+    ridotto il numero di ripiani) finiscono in `overflow` invece di sparire.
+    """
+
+    def __init__(self, shelf_count):
+        self.shelves = {number: [] for number in range(1, shelf_count + 1)}
+        self.overflow = []
+
+    def add(self, shelf_number, item):
+        self.shelves.get(shelf_number, self.overflow).append(item)
+
+    def items(self):
+        return self.shelves.items()
+
+    def counts(self):
+        """Numero di libri per ripiano: {numero_ripiano: quanti}."""
+        return {number: len(items) for number, items in self.shelves.items()}
+
+    def is_overflow(self, shelf_number):
+        return shelf_number not in self.shelves
+
+
+def group_by_shelf(items, shelf_count, shelf_number=lambda item: item.shelf_number):
+    """Distribuisce `items` nei ripiani con un solo passaggio sull'iterabile."""
+    buckets = ShelfBuckets(shelf_count)
+    for item in items:
+        buckets.add(shelf_number(item), item)
+    return buckets
+
+
+def bucket_books(bookshelf, fields=('id', 'title', 'author', 'shelf_number')):
+    """
+    Libri della libreria raggruppati per ripiano, già ordinati per titolo.
+    Carica solo i campi che servono per disegnare lo scaffale.
+    """
+    # 'bookshelf' serve sempre: il related manager lo imposta su ogni libro e,
+    # se fosse differito, farebbe una query in più per ogni riga
+    books = bookshelf.books.only('bookshelf', *fields).order_by('shelf_number', 'title', 'id')
+    return group_by_shelf(books.iterator(), bookshelf.shelf_count)
+
+
+class ShelfCounts:
+    """Come ShelfBuckets, ma con il solo numero di libri per ripiano (e fuori dai ripiani)."""
+
+    def __init__(self, shelf_count, rows):
+        self.shelves = {number: 0 for number in range(1, shelf_count + 1)}
+        self.overflow_count = 0
+        for shelf_number, count in rows:
+            if shelf_number in self.shelves:
+                self.shelves[shelf_number] = count
+            else:
+                self.overflow_count += count
+
+    def counts(self):
+        return dict(self.shelves)
+
+    def is_overflow(self, shelf_number):
+        return shelf_number not in self.shelves
+
+
+def shelf_counts(bookshelf):
+    """Libri per ripiano con una query aggregata (una riga per ripiano, nessun libro caricato)."""
+    rows = bookshelf.books.order_by().values('shelf_number').annotate(count=Count('id')).values_list('shelf_number', 'count')
+    return ShelfCounts(bookshelf.shelf_count, rows)
@@ -0,0 +1,17 @@
+from django import template
+
+from library import covers
+
+register = template.Library()
+
+
+@register.filter
+def cover_thumbnail(cover_url):
+    """{{ book.cover_url|cover_thumbnail }}: miniatura servita dalla cache locale."""
+    return covers.thumbnail_url(cover_url) if cover_url else ''
+
+
+@register.filter
+def cover_image(cover_url):
+    """{{ book.cover_url|cover_image }}: copertina a grandezza originale dalla cache locale."""
+    return covers.image_url(cover_url) if cover_url else ''
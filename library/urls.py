@@ -10,10 +10,21 @@ urlpatterns = [
     path('room/<int:room_id>/editor/', views.room_editor, name='room-editor'),
     path('upload/', views.upload_shelf_image, name='upload-image'),
     path('api/bookshelf/', views.bookshelf_api_dispatcher, name='bookshelf-api-dispatcher'),
+    path('api/room/<int:room_id>/layout/', views.room_layout_api, name='api-room-layout'),
     path('search/', views.book_search, name='book-search'),
+    path('api/search/', views.book_search_api, name='api-book-search'),
     path('add-by-url/', views.add_book_by_url, name='add-book-by-url'),
+    path('api/bookshelf/<int:bookshelf_id>/import/', views.bookshelf_import, name='api-bookshelf-import'),
     path('bookshelf/<int:bookshelf_id>/update-count/', views.update_shelf_count, name='update-shelf-count'),
     path('book/<int:book_id>/edit/', views.book_edit, name='book-edit'),
     path('book/<int:book_id>/delete/', views.book_delete, name='book-delete'),
     path('api/get-bookshelves-for-room/<int:room_id>/', views.get_bookshelves_for_room, name='api-get-bookshelves'),
+    path('api/ingestion-job/<int:job_id>/', views.ingestion_job_status, name='api-ingestion-job'),
+    path('api/ingestion-job/<int:job_id>/retry/', views.ingestion_job_retry, name='api-ingestion-job-retry'),
+    path('api/catalog/export/', views.catalog_export, name='api-catalog-export'),
+    path('api/catalog/import/', views.catalog_import, name='api-catalog-import'),
+    path('covers/<str:url_hash>/', views.cover_file, name='cover-thumbnail'),
+    path('covers/<str:url_hash>/full/', views.cover_file, {'full': True}, name='cover-image'),
+    path('api/cache-stats/', views.cache_stats, name='api-cache-stats'),
+    path('metrics/', views.metrics, name='metrics'),
 ]
@@ -1,28 +1,40 @@
 from django.shortcuts import render
 # Assicurati che tutti e tre i modelli siano importati
-from .models import Room, Bookshelf, Book
-from django.shortcuts import render, redirect, get_object_or_404
+from .models import Room, Bookshelf, Book, CoverImage, IngestionJob
+from django.shortcuts import render, redirect, get_object_or_404, aget_object_or_404
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.urls import reverse
+import logging
 import os
-from django.core.files.storage import FileSystemStorage 
 # Importa la funzione che abbiamo appena creato
 from . import book_detector
-from django.http import JsonResponse, HttpResponseBadRequest
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, JsonResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.utils.cache import patch_cache_control
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
 import json
-from django.db.models import Q
+from django.db.models import Count, Q
 from . import book_scraper # Importa il nostro nuovo modulo
 from .forms import BookForm
+from . import bulk_import, catalog, covers, ingestion, instrumentation, layout
+from .pagination import KeysetPage, paginate
+from .search import search_after, search_books, search_ordering, search_terms
+from .shelving import bucket_books, shelf_counts
+from .book_store import add_books_to_bookshelf
+
+logger = logging.getLogger(__name__)
 
 # ... home e bookshelf_list views restano invariate ...
 def home(request):
-    rooms = Room.objects.all()
+    # Contiamo le librerie direttamente nella query (niente COUNT per ogni stanza)
+    rooms = Room.objects.annotate(bookshelf_count=Count('bookshelves'))
     context = {'rooms': rooms}
     return render(request, 'library/home.html', context)
 
 def bookshelf_list(request, room_id):
-    room = Room.objects.get(pk=room_id)
-    bookshelves = room.bookshelves.all()
+    room = get_object_or_404(Room, pk=room_id)
+    bookshelves = room.bookshelves.annotate(book_count=Count('books'))
     context = {
         'room': room,
         'bookshelves': bookshelves
@@ -32,36 +44,33 @@ def bookshelf_list(request, room_id):
 # In library/views.py
 
 def book_list(request, bookshelf_id):
-    bookshelf = get_object_or_404(Bookshelf, pk=bookshelf_id)
-    
-    # --- NUOVA LOGICA DI RAGGRUPPAMENTO ---
-    # Prendiamo tutti i libri di questa libreria, ordinati per titolo
-    all_books_on_shelf = bookshelf.books.all().order_by('title')
-    
-    # Creiamo un dizionario per contenere i nostri ripiani
-    # La chiave sarà il numero del ripiano, il valore sarà la lista dei libri su quel ripiano
-    shelves_with_books = {}
+    bookshelf = get_object_or_404(Bookshelf.objects.select_related('room'), pk=bookshelf_id)
     
-    # Iteriamo per ogni ripiano che la libreria dovrebbe avere (da 1 fino a shelf_count)
-    for i in range(1, bookshelf.shelf_count + 1):
-        # Filtriamo i libri che appartengono a questo specifico ripiano
-        books_on_this_shelf = [book for book in all_books_on_shelf if book.shelf_number == i]
-        # Aggiungiamo la lista (anche se vuota) al nostro dizionario
-        shelves_with_books[i] = books_on_this_shelf
-        
+    # Raggruppiamo i libri per ripiano con una sola query e un solo passaggio
+    # (vedi library/shelving.py); i libri con un ripiano inesistente finiscono
+    # nel gruppo "overflow" invece di sparire
+    shelves_with_books = bucket_books(bookshelf)
+
+    # Le card a sinistra sono paginate con un cursore (titolo, id): il costo
+    # della pagina non dipende dal numero di libri nella libreria
+    page = paginate(bookshelf.books.all(), ('title', 'id'), request.GET.get('cursor'))
+
     context = {
         'bookshelf': bookshelf,
         # Passiamo al template la nostra nuova struttura dati raggruppata
-        'shelves_with_books': shelves_with_books, 
-        # Passiamo anche la lista completa per le card a sinistra
-        'all_books': all_books_on_shelf 
+        'shelves_with_books': shelves_with_books,
+        'overflow_books': shelves_with_books.overflow,
+        # Passiamo anche la pagina corrente per le card a sinistra
+        'all_books': page,
+        'next_cursor': page.next_cursor,
     }
     return render(request, 'library/book_list.html', context)
 
 # In library/views.py
 
 def upload_shelf_image(request):
-    bookshelves = Bookshelf.objects.all()
+    # select_related: il menu a tendina mostra anche il nome della stanza
+    bookshelves = Bookshelf.objects.select_related('room')
 
     if request.method == 'POST' and request.FILES.getlist('image'):
         image_files = request.FILES.getlist('image')
@@ -78,47 +87,75 @@ def upload_shelf_image(request):
             target_bookshelf.shelf_count = shelf_number
             target_bookshelf.save()
         
-        # Inizia il ciclo per ogni file caricato
-        for image_file in image_files:
-            # --- INIZIA IL BLOCCO DI SICUREZZA ---
-            try: 
-                # Questo è il tuo codice corretto, ora protetto
-                print(f"DEBUG: Processo l'immagine: {image_file.name}")
-                
-                fs = FileSystemStorage()
-                filename = fs.save(image_file.name, image_file)
-                uploaded_file_path = fs.path(filename)
-
-                found_books_data = book_detector.process_shelf_image(uploaded_file_path)
-                
-                fs.delete(filename)
-
-                for book_data in found_books_data:
-                    google_id = book_data.get('google_books_id')
-                    if google_id and not Book.objects.filter(google_books_id=google_id, bookshelf=target_bookshelf).exists():
-                        Book.objects.create(
-                            title=book_data.get('title', 'No Title Provided'),
-                            author=book_data.get('author', 'Unknown Author'),
-                            bookshelf=target_bookshelf,
-                            shelf_number=shelf_number,
-                            summary=book_data.get('summary', ''),
-                            google_books_id=google_id,
-                            cover_url=book_data.get('cover_url', ''),
-                            published_date=book_data.get('published_date', '')
-                        )
-            
-            except Exception as e:
-                # Se qualcosa va storto con questa immagine, lo registriamo e andiamo avanti
-                print(f"ERRORE: Impossibile processare il file {image_file.name}. Causa: {e}")
-                continue # Salta alla prossima immagine
-            # --- FINISCE IL BLOCCO DI SICUREZZA ---
-        
-        # Questa riga viene eseguita solo dopo che il ciclo è finito (o tutte le immagini sono state processate)
-        return redirect('book-list', bookshelf_id=target_bookshelf.id)
+        # Non elaboriamo più le immagini qui: le mettiamo in coda e il worker
+        # (python manage.py process_ingestion_jobs) se ne occupa in background.
+        job = ingestion.enqueue_upload(target_bookshelf, shelf_number, image_files)
+        logger.info("Creato il job di acquisizione %d con %d immagini", job.pk, len(image_files))
+
+        if 'application/json' in request.headers.get('Accept', ''):
+            return JsonResponse({
+                'job_id': job.pk,
+                'status_url': reverse('api-ingestion-job', args=[job.pk]),
+            }, status=202)
+        return redirect(f"{reverse('upload-image')}?job={job.pk}")
 
-    context = { 'bookshelves': bookshelves }
+    context = {
+        'bookshelves': bookshelves,
+        'job_id': request.GET.get('job'),
+    }
     return render(request, 'library/upload_form.html', context)
 
+
+# --- API PER SEGUIRE L'AVANZAMENTO DI UN JOB DI ACQUISIZIONE ---
+def ingestion_job_status(request, job_id):
+    job = get_object_or_404(IngestionJob, pk=job_id)
+    data = ingestion.job_status(job)
+    data['bookshelf_url'] = reverse('book-list', args=[job.bookshelf_id])
+    return JsonResponse(data)
+
+
+# --- API CON LE STATISTICHE DELLE CACHE (metadati e foto già viste) ---
+def cache_stats(request):
+    return JsonResponse(instrumentation.collect_stats())
+
+
+# --- METRICHE IN FORMATO PROMETHEUS (library/instrumentation.py) ---
+def metrics(request):
+    if not settings.METRICS_ENABLED:
+        raise Http404("Metriche disattivate (METRICS_ENABLED)")
+    return HttpResponse(instrumentation.render(instrumentation.collect_stats()), content_type=instrumentation.CONTENT_TYPE)
+
+
+# --- COPERTINE DALLA CACHE LOCALE (library/covers.py) ---
+def cover_file(request, url_hash, full=False):
+    """
+    Serve la miniatura (o l'originale con full=True) di una copertina già
+    scaricata, con ETag e Cache-Control di lunga durata. Se non è ancora
+    pronta reindirizza all'URL originale, con una cache breve.
+    """
+    cover = get_object_or_404(CoverImage, url_hash=url_hash)
+    path = covers.cached_file(cover, full) if cover.status == 'done' else None
+    if path is None:
+        response = redirect(cover.source_url)
+        patch_cache_control(response, public=True, max_age=settings.COVER_PENDING_MAX_AGE)
+        return response
+
+    etag = f'"{cover.content_hash}"' if full else f'"{cover.content_hash}-thumb"'
+    if etag in request.headers.get('If-None-Match', ''):
+        response = HttpResponseNotModified()
+    else:
+        response = FileResponse(open(path, 'rb'), content_type=cover.mime_type if full else 'image/jpeg')
+    response['ETag'] = etag
+    patch_cache_control(response, public=True, max_age=settings.COVER_CACHE_MAX_AGE, immutable=True)
+    return response
+
+
+@require_http_methods(["POST"])
+def ingestion_job_retry(request, job_id):
+    job = get_object_or_404(IngestionJob, pk=job_id)
+    retried = ingestion.retry_failed_images(job)
+    return JsonResponse({'status': 'success', 'retried': retried})
+
 # In library/views.py
 
 # In library/views.py
@@ -126,7 +163,7 @@ def upload_shelf_image(request):
 # In library/views.py
 
 def book_detail(request, book_id):
-    book = get_object_or_404(Book, pk=book_id)
+    book = get_object_or_404(Book.objects.select_related('bookshelf__room'), pk=book_id)
 
     if request.method == 'POST':
         rating = request.POST.get('user_rating')
@@ -137,16 +174,18 @@ def book_detail(request, book_id):
 
     # Prendiamo la stanza e tutte le librerie al suo interno
     room = book.bookshelf.room
-    bookshelves_in_room = room.bookshelves.all()
+    bookshelves_in_room = Bookshelf.objects.filter(room_id=room.id)
     
-    # --- RI-AGGIUNGIAMO QUESTA LOGICA FONDAMENTALE ---
-    # Creiamo una lista di numeri per i ripiani della libreria specifica del libro
-    shelf_range = range(1, book.bookshelf.shelf_count + 1)
+    # Numero di libri per ogni ripiano della libreria del libro (stesso
+    # raggruppamento usato da book_list)
+    shelves = shelf_counts(book.bookshelf)
     
     context = {
         'book': book,
         'bookshelves_in_room': bookshelves_in_room,
-        'shelf_range': shelf_range, # Passiamo di nuovo la lista dei ripiani al template
+        'shelf_counts': shelves.counts(),
+        'overflow_count': shelves.overflow_count,
+        'book_in_overflow': shelves.is_overflow(book.shelf_number),
     }
     return render(request, 'library/book_detail.html', context)
 
@@ -159,6 +198,36 @@ def room_editor(request, room_id):
     }
     return render(request, 'library/room_editor.html', context)
 
+# Esiti del salvataggio del layout che lasciano la libreria com'era, con il messaggio per l'utente
+_LAYOUT_PROBLEMS = {
+    'conflict': "modificate da qualcun altro o non esistono più: mostrata la versione più recente",
+    'invalid': "con valori non validi: modifiche non salvate",
+}
+
+
+def _layout_outcome(results):
+    """
+    Stato, messaggio e codice HTTP di un salvataggio del layout. Ogni libreria
+    ha il suo esito: se almeno una è stata salvata la risposta è 200
+    ('partial' se altre no); 409 (o 400 se erano solo valori non validi)
+    soltanto quando non è stato applicato niente.
+    """
+    problems = {}
+    for r in results:
+        if r['result'] not in ('updated', 'unchanged'):
+            kind = 'invalid' if r['result'] == 'invalid' else 'conflict'
+            problems.setdefault(kind, []).append(r['id'])
+    if not problems:
+        return 'success', 'Tutte le modifiche sono salvate', 200
+
+    message = '; '.join(f"Librerie {ids} {_LAYOUT_PROBLEMS[kind]}" for kind, ids in problems.items())
+    if len(results) > sum(len(ids) for ids in problems.values()):
+        return 'partial', message, 200
+    if 'conflict' in problems:
+        return 'conflict', message, 409
+    return 'invalid', message, 400
+
+
 # --- LA NUOVA SUPER-VIEW PER L'API ---
 
 # In library/views.py
@@ -173,11 +242,7 @@ def bookshelf_api_dispatcher(request):
             # Trova la stanza a cui appartiene la nuova libreria
             room = get_object_or_404(Room, pk=data['room_id'])
             # Crea la nuova libreria nel database
-            new_shelf = Bookshelf.objects.create(
-                name=data['name'],
-                shape_type=data['shape_type'],
-                room=room
-            )
+            new_shelf = layout.create_shelf(room, data['name'], data['shape_type'])
             # Restituisce i dati del nuovo oggetto a JavaScript, incluso il nuovo ID!
             return JsonResponse({
                 'id': new_shelf.id, 
@@ -187,45 +252,62 @@ def bookshelf_api_dispatcher(request):
                 'y': new_shelf.pos_y, 
                 'width': new_shelf.width,
                 'height': new_shelf.height, 
-                'rotation': new_shelf.rotation
+                'rotation': new_shelf.rotation,
+                'version': new_shelf.version,
+                'revision': new_shelf.revision
             })
 
         # --- BLOCCO PUT (AGGIORNAMENTO) ---
         elif request.method == 'PUT':
             data = json.loads(request.body)
-            updated_ids = []
-            for shelf_data in data:
-                shelf = get_object_or_404(Bookshelf, pk=shelf_data['id'])
-                
-                # --- AGGIUNGIAMO LA MODIFICA DEL NOME QUI ---
-                shelf.name = shelf_data.get('name', shelf.name)
-                
-                shelf.pos_x = shelf_data.get('x', shelf.pos_x)
-                shelf.pos_y = shelf_data.get('y', shelf.pos_y)
-                shelf.width = shelf_data.get('width', shelf.width)
-                shelf.height = shelf_data.get('height', shelf.height)
-                shelf.shape_type = shelf_data.get('shape_type', shelf.shape_type)
-                shelf.rotation = shelf_data.get('rotation', shelf.rotation)
-                
-                shelf.save()
-                updated_ids.append(shelf.id)
-            return JsonResponse({'status': 'success', 'message': f'Librerie {updated_ids} aggiornate'})
+            # Una query per leggere tutte le librerie, un bulk_update per quelle cambiate
+            results = layout.update_layout(data)
+            status, message, http_status = _layout_outcome(results)
+            if status == 'success':
+                updated_ids = [r['id'] for r in results if r['result'] == 'updated']
+                message = f'Librerie {updated_ids} aggiornate'
+            return JsonResponse({'status': status, 'message': message, 'results': results}, status=http_status)
 
         # --- BLOCCO DELETE (CANCELLAZIONE) ---
         elif request.method == 'DELETE':
             data = json.loads(request.body)
             shelf = get_object_or_404(Bookshelf, pk=data['id'])
-            shelf.delete()
-            return JsonResponse({'status': 'success', 'message': 'Libreria cancellata'})
+            revision = layout.delete_shelf(shelf)
+            return JsonResponse({'status': 'success', 'message': 'Libreria cancellata', 'revision': revision})
 
     except Exception as e:
         return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
     
     return HttpResponseBadRequest()
 
+
+@csrf_exempt
+@require_http_methods(["GET", "PATCH"])
+def room_layout_api(request, room_id):
+    """
+    Salvataggio incrementale del layout di una stanza.
+    - GET ?since=<revisione>: librerie cambiate, create o cancellate dopo quella revisione.
+    - PATCH {revision, changes: [{id, campo: valore, ...}]}: applica solo i campi
+      cambiati e restituisce la nuova revisione con l'esito di ogni libreria.
+    """
+    room = get_object_or_404(Room, pk=room_id)
+    try:
+        if request.method == 'GET':
+            since = int(request.GET.get('since', 0))
+            return JsonResponse(layout.changes_since(room, since))
+
+        data = json.loads(request.body)
+        response = layout.apply_patch(room, int(data['revision']), data.get('changes', []))
+    except (KeyError, TypeError, ValueError) as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+
+    response['status'], response['message'], http_status = _layout_outcome(response['results'])
+    return JsonResponse(response, status=http_status)
+
 # In library/views.py
 
-def book_search(request):
+def _search_page(request):
+    """Esegue la ricerca con i parametri dell'URL e restituisce la pagina richiesta (?cursor=...)."""
     # Iniziamo con una queryset che contiene tutti i libri
     queryset = Book.objects.all()
     
@@ -233,53 +315,84 @@ def book_search(request):
     query = request.GET.get('q')
     rating_filter = request.GET.get('rating')
 
-    # Se è stata fornita una query di testo...
-    if query:
-        # Filtriamo cercando la query sia nel titolo CHE nell'autore.
-        # Q() è uno strumento potente per creare query complesse con OR.
-        # __icontains significa "contiene, ignorando maiuscole/minuscole".
-        queryset = queryset.filter(
-            Q(title__icontains=query) | Q(author__icontains=query)
-        )
-        
     # Se è stato fornito un filtro per il rating...
     if rating_filter:
         # __gte significa "greater than or equal to" (maggiore o uguale a).
         queryset = queryset.filter(user_rating__gte=rating_filter)
 
+    # Se è stata fornita una query di testo...
+    if query and not search_terms(query):
+        # Solo punteggiatura (es. ?q=-): nessuna parola da cercare, nessun risultato
+        page = KeysetPage([], None)
+    elif query:
+        # Ricerca full-text su titolo, autore e riassunto (indice FTS5 / tsvector),
+        # con i risultati più rilevanti per primi. Vedi library/search.py.
+        queryset = search_books(queryset, query)
+        page = paginate(queryset, search_ordering(queryset), request.GET.get('cursor'), after=search_after)
+    else:
+        page = paginate(queryset, ('title', 'id'), request.GET.get('cursor'))
+
+    return page, query, rating_filter
+
+
+def book_search(request):
+    page, query, rating_filter = _search_page(request)
+
+    # Parametri della pagina successiva (stessa ricerca, nuovo cursore)
+    next_params = request.GET.copy()
+    next_params['cursor'] = page.next_cursor or ''
+
     context = {
-        'books': queryset,
+        'books': page,
         'query': query,
         'rating_filter': rating_filter,
+        'next_page_query': next_params.urlencode() if page.has_next else '',
     }
     return render(request, 'library/search_results.html', context)
 
 
-def add_book_by_url(request):
+# --- VERSIONE JSON DELLA RICERCA (per lo scroll infinito) ---
+def book_search_api(request):
+    page, query, rating_filter = _search_page(request)
+    results = [
+        {
+            'id': book.id,
+            'title': book.title,
+            'author': book.author,
+            'cover_url': book.cover_url,
+            'cover_thumbnail': covers.thumbnail_url(book.cover_url) if book.cover_url else '',
+            'user_rating': book.user_rating,
+            'url': reverse('book-detail', args=[book.id]),
+        }
+        for book in page
+    ]
+    return JsonResponse({'results': results, 'next_cursor': page.next_cursor})
+
+
+async def add_book_by_url(request):
+    """
+    View async: mentre aspettiamo Google Books o Amazon il worker (sotto
+    uvicorn) resta libero di servire altre richieste. Sotto WSGI funziona
+    lo stesso, con un event loop per richiesta.
+    """
     found_book = None
     
     # --- FASE 2: GESTIONE DEL SALVATAGGIO ---
     # Questo codice viene eseguito quando l'utente clicca "Aggiungi alla Libreria"
     if request.method == 'POST' and 'confirm_add' in request.POST:
         bookshelf_id = request.POST.get('bookshelf')
-        shelf_number = request.POST.get('shelf_number')
+        try:
+            shelf_number = int(request.POST.get('shelf_number', 1))
+        except (ValueError, TypeError):
+            shelf_number = 1
         
         # Prende i dati del libro salvati nella sessione
-        book_data = request.session.get('found_book_data')
+        book_data = await request.session.aget('found_book_data')
         
         if book_data and bookshelf_id:
-            target_bookshelf = get_object_or_404(Bookshelf, pk=bookshelf_id)
-            if not Book.objects.filter(google_books_id=book_data.get('google_books_id')).exists():
-                Book.objects.create(
-                    title=book_data.get('title'),
-                    author=book_data.get('author'),
-                    summary=book_data.get('summary', ''),
-                    google_books_id=book_data.get('google_books_id', ''),
-                    cover_url=book_data.get('cover_url', ''),
-                    published_date=book_data.get('published_date', ''),
-                    bookshelf=target_bookshelf,
-                    shelf_number=shelf_number
-                )
+            target_bookshelf = await aget_object_or_404(Bookshelf, pk=bookshelf_id)
+            # Stesso percorso di salvataggio usato per le foto degli scaffali
+            await sync_to_async(add_books_to_bookshelf)(target_bookshelf, shelf_number, [book_data])
             # Reindirizza alla libreria dove è stato aggiunto il libro
             return redirect('book-list', bookshelf_id=bookshelf_id)
 
@@ -288,15 +401,83 @@ def add_book_by_url(request):
     if request.method == 'POST' and 'fetch_url' in request.POST:
         url = request.POST.get('url')
         if url:
-            found_book = book_scraper.scrape_book_data_from_url(url)
+            found_book = await book_scraper.ascrape_book_data_from_url(url)
             # Salva il risultato nella sessione per il prossimo passo
-            request.session['found_book_data'] = found_book
+            await request.session.aset('found_book_data', found_book)
 
     context = {
         'found_book': found_book,
-        'bookshelves': Bookshelf.objects.all()
+        # Il template non può fare query da una view async: carichiamo la lista qui
+        'bookshelves': [shelf async for shelf in Bookshelf.objects.select_related('room')]
     }
-    return render(request, 'library/add_by_url.html', context)
+    return await sync_to_async(render)(request, 'library/add_by_url.html', context)
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def bookshelf_import(request, bookshelf_id):
+    """
+    Importa in blocco una lista di ISBN/URL (CSV o JSON) nella libreria.
+    La lista arriva come file ('file') oppure direttamente nel corpo della richiesta;
+    ?shelf_number=N sceglie il ripiano, ?format=csv|json forza il formato.
+    La risposta è in streaming, una riga JSON per ogni voce (application/x-ndjson),
+    più una riga finale di riepilogo.
+    """
+    bookshelf = get_object_or_404(Bookshelf, pk=bookshelf_id)
+    params = request.POST if request.FILES else request.GET
+    upload = request.FILES.get('file')
+    data = upload.read() if upload else request.body
+    fmt = params.get('format') or ('json' if 'json' in request.content_type else None)
+    try:
+        shelf_number = int(params.get('shelf_number', 1))
+        entries = bulk_import.parse_entries(data, fmt)
+    except ValueError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+
+    rows = bulk_import.import_entries(bookshelf, shelf_number, entries)
+    return StreamingHttpResponse(
+        (json.dumps(row, ensure_ascii=False) + "\n" for row in rows),
+        content_type='application/x-ndjson',
+    )
+
+
+_CATALOG_FORMATS = {
+    'jsonl': (catalog.export_jsonl, catalog.read_jsonl, 'application/x-ndjson'),
+    'csv': (catalog.export_csv, catalog.read_csv, 'text/csv'),
+}
+
+
+def catalog_export(request):
+    """Scarica tutto il catalogo (?format=jsonl|csv) in streaming, senza caricarlo in memoria."""
+    fmt = request.GET.get('format', 'jsonl')
+    if fmt not in _CATALOG_FORMATS:
+        return HttpResponseBadRequest("Formato non supportato")
+    export, _, content_type = _CATALOG_FORMATS[fmt]
+    response = StreamingHttpResponse(export(), content_type=f'{content_type}; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="catalogo.{fmt}"'
+    return response
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def catalog_import(request):
+    """
+    Importa un catalogo esportato (file 'file', ?format=jsonl|csv dedotto dal nome se manca).
+    Il file viene letto una riga alla volta (Django salva i file grandi su disco).
+    """
+    upload = request.FILES.get('file')
+    if upload is None:
+        return JsonResponse({'status': 'error', 'message': "Nessun file"}, status=400)
+    fmt = request.POST.get('format') or ('csv' if upload.name.endswith('.csv') else 'jsonl')
+    if fmt not in _CATALOG_FORMATS:
+        return JsonResponse({'status': 'error', 'message': "Formato non supportato"}, status=400)
+    _, read, _ = _CATALOG_FORMATS[fmt]
+    try:
+        counts = catalog.import_records(read(upload))
+    except catalog.CatalogFormatError as e:
+        # L'importazione è una sola transazione: non è rimasto salvato niente
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+    return JsonResponse({'status': 'success', **counts})
 
 
 # --- NUOVA VIEW PER MODIFICARE UN LIBRO ---
@@ -306,6 +487,7 @@ def book_edit(request, book_id):
     if request.method == 'POST':
         form = BookForm(request.POST, instance=book)
         if form.is_valid():
+            # La nuova copertina va in coda da sola (post_save, vedi covers.enqueue_saved_book)
             form.save()
             return redirect('book-detail', book_id=book.id)
     else:
@@ -321,7 +503,7 @@ def book_edit(request, book_id):
 @require_http_methods(["POST"]) # Accetta solo richieste POST per sicurezza
 def book_delete(request, book_id):
     book = get_object_or_404(Book, pk=book_id)
-    bookshelf_id = book.bookshelf.id # Salviamo l'id per il redirect
+    bookshelf_id = book.bookshelf_id # Salviamo l'id per il redirect
     book.delete()
     return redirect('book-list', bookshelf_id=bookshelf_id)
 
@@ -0,0 +1,375 @@
+# In library/vision_backends.py
+"""
+Motori che leggono titoli e autori dalle foto degli scaffali.
+
+book_detector non parla più direttamente con Gemini: chiede al backend
+scelto in settings.VISION_BACKEND (percorso della classe, caricata con
+import_string) i libri visibili in un gruppo di immagini.
+
+- GeminiBackend: il modello remoto, più immagini per richiesta con output
+  strutturato (a pagamento, serve la rete).
+- LocalOCRBackend: tutto in locale, sui nostri core. OpenCV trova lo stacco
+  tra le coste (lo stesso profilo dei bordi verticali usato per i tasselli),
+  RapidOCR (modelli ONNX, `pip install rapidocr_onnxruntime`) legge le
+  scritte e ogni costa diventa un libro. Meno preciso di Gemini, ma gratuito
+  e senza rete: adatto alle ri-scansioni in massa.
+- FakeBackend: deterministico, per i test.
+
+Tutti i backend espongono detect(images) e adetect(images): `images` è una
+lista di (byte, mime_type), il risultato una lista di libri
+({'title', 'author'}) per immagine, nello stesso ordine.
+Il comando `python manage.py benchmark_vision` li confronta su tempi e recall.
+"""
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from . import image_utils, instrumentation
+from .lazy_imports import lazy_import
+
+logger = logging.getLogger(__name__)
+
+# Pesanti da importare (grpc, protobuf...): caricati solo quando un backend li usa davvero
+genai = lazy_import('google.generativeai')
+np = lazy_import('numpy')
+
+
+class VisionBackend:
+    """Interfaccia comune. `name` distingue i risultati in cache (ShelfImageFingerprint.backend)."""
+    name = None
+
+    def detect(self, images):
+        raise NotImplementedError
+
+    async def adetect(self, images):
+        # I backend senza client async girano in un thread, senza bloccare l'event loop
+        return await sync_to_async(self.detect, thread_sensitive=False)(images)
+
+
+# --- GEMINI ---
+# Istruzioni per Gemini: inviate come system instruction del modello, uguali per ogni richiesta
+DETECTION_PROMPT = """
+Sei un assistente bibliotecario virtuale, specializzato nel digitalizzare collezioni di libri da immagini. Il tuo compito è analizzare le immagini fornite con la massima precisione.
+
+Le tue istruzioni sono:
+1.  **IDENTIFICA SOLO LIBRI:** Analizza ogni immagine e identifica solo le coste dei libri. Ignora completamente loghi di case editrici (es. "Feltrinelli", "Mondadori"), numeri di collana (es. "1062", "444"), e qualsiasi altro testo che non sia chiaramente un titolo o un autore.
+2.  **ESTRAI TITOLO E AUTORE:** Per ogni libro identificato, estrai il suo titolo completo e il nome completo dell'autore.
+3.  **GESTISCI CASI INCERTI:**
+    - Se riesci a leggere chiaramente solo il nome di un autore (es. "YOURCENAR") ma non il titolo, usa il titolo "Unknown" e l'autore che hai letto.
+    - Se riesci a leggere chiaramente solo un titolo ma non l'autore, usa il titolo che hai letto e l'autore "Unknown".
+    - Se un libro è illeggibile o non sei sicuro, **non includerlo nell'output**. È meglio omettere un libro che inventarne uno.
+4.  **PIÙ IMMAGINI:** Ogni immagine è preceduta da "Immagine N:". Le immagini sono indipendenti: un libro va riportato solo nell'immagine in cui compare.
+5.  **FORMATO DI OUTPUT:** Restituisci un array JSON con un elemento per ogni immagine: "image" è il numero N dell'immagine, "books" l'elenco dei suoi libri (vuoto se non ce ne sono), ognuno con "title" e "author".
+
+Esempio di output perfetto per due immagini:
+[
+    { "image": 1, "books": [
+        { "title": "Memorie di Adriano", "author": "Marguerite Yourcenar" },
+        { "title": "Il Piccolo Principe", "author": "Antoine de Saint-Exupéry" }
+    ] },
+    { "image": 2, "books": [
+        { "title": "Unknown", "author": "Colette" }
+    ] }
+]
+"""
+
+# Schema della risposta (structured output): Gemini restituisce direttamente JSON valido
+DETECTION_SCHEMA = {
+    'type': 'array',
+    'items': {
+        'type': 'object',
+        'properties': {
+            'image': {'type': 'integer'},
+            'books': {
+                'type': 'array',
+                'items': {
+                    'type': 'object',
+                    'properties': {'title': {'type': 'string'}, 'author': {'type': 'string'}},
+                    'required': ['title', 'author'],
+                },
+            },
+        },
+        'required': ['image', 'books'],
+    },
+}
+
+
+def _batches(images):
+    """Gruppi di al massimo GEMINI_BATCH_SIZE immagini e GEMINI_BATCH_MAX_BYTES byte."""
+    batch, size = [], 0
+    for image in images:
+        if batch and (len(batch) >= settings.GEMINI_BATCH_SIZE or size + len(image[0]) > settings.GEMINI_BATCH_MAX_BYTES):
+            yield batch
+            batch, size = [], 0
+        batch.append(image)
+        size += len(image[0])
+    if batch:
+        yield batch
+
+
+def _batch_contents(images):
+    """Contenuto della richiesta: ogni immagine preceduta dalla sua etichetta "Immagine N:"."""
+    contents = []
+    for number, (image_data, mime_type) in enumerate(images, start=1):
+        contents.append(f"Immagine {number}:")
+        contents.append({'mime_type': mime_type, 'data': image_data})
+    return contents
+
+
+def _parse_detection_response(response, count):
+    """Libri di ciascuna delle `count` immagini della richiesta (una lista per immagine, stesso ordine)."""
+    logger.debug("Risposta JSON di Gemini ->\n%s", response.text)
+    results = [[] for _ in range(count)]
+    for entry in json.loads(response.text):
+        number = entry.get('image')
+        if isinstance(number, int) and 1 <= number <= count:
+            results[number - 1].extend(
+                book for book in entry.get('books') or []
+                if isinstance(book, dict) and book.get('title') and book.get('author')
+            )
+    return results
+
+
+def _record_usage(response, image_count):
+    """Immagini e token di una richiesta a Gemini, per le metriche (library_gemini_*_total)."""
+    instrumentation.increment('gemini_images', image_count)
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is not None:
+        instrumentation.increment('gemini_tokens', getattr(usage, 'prompt_token_count', 0) or 0, kind='prompt')
+        instrumentation.increment('gemini_tokens', getattr(usage, 'candidates_token_count', 0) or 0, kind='output')
+
+
+class GeminiBackend(VisionBackend):
+    """
+    Gemini, con modello, istruzioni e schema costruiti una volta sola (alla
+    creazione del backend). Le immagini vengono raggruppate in richieste da
+    al massimo GEMINI_BATCH_SIZE; i gruppi partono in parallelo
+    (SHELF_TILE_WORKERS alla volta).
+    """
+    name = 'gemini'
+
+    def __init__(self):
+        genai.configure(api_key=settings.GOOGLE_API_KEY)
+        self.model = genai.GenerativeModel(
+            settings.GEMINI_MODEL,
+            system_instruction=DETECTION_PROMPT,
+            generation_config=genai.GenerationConfig(response_mime_type='application/json', response_schema=DETECTION_SCHEMA),
+        )
+
+    def detect_batch(self, images):
+        """Una sola richiesta a Gemini per tutte le immagini (o tasselli) del gruppo."""
+        logger.debug("Avvio analisi di %d immagini con Gemini (una richiesta)...", len(images))
+        with instrumentation.span('vision_request', backend=self.name):
+            response = self.model.generate_content(_batch_contents(images))
+        _record_usage(response, len(images))
+        return _parse_detection_response(response, len(images))
+
+    async def adetect_batch(self, images):
+        logger.debug("Avvio analisi di %d immagini con Gemini (una richiesta, async)...", len(images))
+        with instrumentation.span('vision_request', backend=self.name):
+            response = await self.model.generate_content_async(_batch_contents(images))
+        _record_usage(response, len(images))
+        return _parse_detection_response(response, len(images))
+
+    def detect(self, images):
+        batches = list(_batches(images))
+        if len(batches) == 1:
+            return self.detect_batch(batches[0])
+
+        max_workers = max(1, min(settings.SHELF_TILE_WORKERS, len(batches)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return [books for results in executor.map(self.detect_batch, batches) for books in results]
+
+    async def adetect(self, images):
+        semaphore = asyncio.Semaphore(max(1, settings.SHELF_TILE_WORKERS))
+
+        async def detect(batch):
+            async with semaphore:
+                return await self.adetect_batch(batch)
+
+        results = await asyncio.gather(*(detect(batch) for batch in _batches(images)))
+        return [books for batch_results in results for books in batch_results]
+
+
+# --- OCR LOCALE ---
+def _spaced_text(text, char_boxes):
+    """
+    Rimette gli spazi che il modello di riconoscimento perde ("ILNOMEDELLAROSA",
+    "ItaloCalvino"): c'è uno spazio tra una minuscola e una maiuscola, oppure
+    dove lo stacco tra due caratteri è molto più largo di quello tipico della
+    riga. Le coordinate sono quelle dell'immagine, quindi per una scritta
+    verticale lo stacco si misura lungo l'asse y.
+    Una riga che ha già degli spazi è stata letta bene e resta com'è; uno
+    spazio non va mai prima di una minuscola ("Um berto", "no m e"): le
+    lettere larghe o strette lasciano stacchi irregolari anche dentro le parole.
+    """
+    if not char_boxes or len(char_boxes) != len(text) or ' ' in text:
+        return text
+    boxes = np.array(char_boxes, dtype=np.float32)
+    lows, highs = boxes.min(axis=1), boxes.max(axis=1)
+    # La scritta corre lungo l'asse in cui la riga è più estesa; l'altro dà lo spessore della riga
+    axis = int(np.ptp(lows[:, 1]) > np.ptp(lows[:, 0]))
+    thickness = float(np.median(highs[:, 1 - axis] - lows[:, 1 - axis]))
+    gaps = [max(lows[i, axis] - highs[i - 1, axis], lows[i - 1, axis] - highs[i, axis]) for i in range(1, len(text))]
+    threshold = max(0.3 * thickness, 2 * float(np.median(gaps)) + 1) if gaps else 0.0
+
+    pieces = [text[0]]
+    for i in range(1, len(text)):
+        if not text[i].islower() and (gaps[i - 1] > threshold or (text[i - 1].islower() and text[i].isupper())):
+            pieces.append(' ')
+        pieces.append(text[i])
+    return ''.join(pieces)
+
+
+def _looks_like_name(line):
+    """Un nome d'autore: 2-4 parole alfabetiche con l'iniziale maiuscola ("Italo Calvino", "Tomasi di Lampedusa")."""
+    words = line.split()
+    if not 2 <= len(words) <= 4 or line.isupper():
+        return False
+    capitalized = [word for word in words if word[0].isupper()]
+    return len(capitalized) >= 2 and all(word.replace("'", '').replace('.', '').isalpha() for word in words)
+
+
+def book_from_lines(lines):
+    """
+    Titolo e autore di una costa a partire dalle righe lette (nell'ordine
+    dell'OCR). Scarta numeri di collana e frammenti troppo corti; l'autore è
+    la riga che sembra un nome, il titolo la più lunga delle altre.
+    """
+    lines = [line.strip() for line in lines]
+    lines = [line for line in lines if sum(ch.isalpha() for ch in line) >= 3]
+    if not lines:
+        return None
+
+    author = next((line for line in lines if _looks_like_name(line)), None)
+    others = [line for line in lines if line != author]
+    if not others:
+        return {'title': 'Unknown', 'author': author}
+    return {'title': max(others, key=len), 'author': author or 'Unknown'}
+
+
+class LocalOCRBackend(VisionBackend):
+    """
+    OpenCV + RapidOCR, senza rete. Una sola passata di OCR per immagine: le
+    righe trovate vengono assegnate alla costa in cui cadono (confini trovati
+    con image_utils.find_spine_boundaries) e ogni costa diventa un libro.
+    """
+    name = 'local-ocr'
+
+    def __init__(self):
+        try:
+            from rapidocr_onnxruntime import RapidOCR
+        except ImportError as e:
+            raise ImproperlyConfigured(
+                "LocalOCRBackend richiede RapidOCR: pip install rapidocr_onnxruntime"
+            ) from e
+        self.engine = RapidOCR()
+        # Il motore ONNX usa già tutti i core per ogni immagine: una alla volta
+        self._lock = threading.Lock()
+
+    def read_lines(self, image):
+        """Righe lette nell'immagine: (testo, centro x, confidenza)."""
+        with self._lock:
+            result, _ = self.engine(image, use_cls=True, return_word_box=True)
+        lines = []
+        for entry in result or []:
+            box, text, score = entry[:3]
+            if score < settings.VISION_OCR_MIN_SCORE:
+                continue
+            char_boxes = entry[3] if len(entry) > 3 else None
+            center_x = sum(point[0] for point in box) / len(box)
+            lines.append((_spaced_text(text, char_boxes), center_x, score))
+        return lines
+
+    def detect_image(self, image_data):
+        image = image_utils.decode_image(image_data)
+        if image is None:
+            return []
+
+        boundaries = image_utils.find_spine_boundaries(image)
+        spines = {}
+        with instrumentation.span('vision_request', backend=self.name):
+            lines = self.read_lines(image)
+        for text, center_x, _ in lines:
+            spine = bisect.bisect_right(boundaries, center_x)
+            spines.setdefault(spine, []).append(text)
+
+        books = []
+        for spine in sorted(spines):
+            book = book_from_lines(spines[spine])
+            if book is not None:
+                books.append(book)
+        logger.debug("OCR locale: %d libri in %d coste", len(books), len(boundaries) + 1)
+        return books
+
+    def detect(self, images):
+        return [self.detect_image(image_data) for image_data, _ in images]
+
+
+# --- FINTO, PER I TEST ---
+class FakeBackend(VisionBackend):
+    """
+    Backend deterministico: nessuna rete, nessun modello. I risultati si
+    registrano per contenuto dell'immagine con register(); le immagini non
+    registrate danno un solo libro ricavato dal loro hash.
+    """
+    name = 'fake'
+    detections = {}
+    calls = 0
+
+    @staticmethod
+    def key(image_data):
+        return hashlib.sha256(image_data).hexdigest()
+
+    @classmethod
+    def register(cls, image_data, books):
+        cls.detections[cls.key(image_data)] = list(books)
+
+    @classmethod
+    def reset(cls):
+        cls.detections = {}
+        cls.calls = 0
+
+    def detect(self, images):
+        FakeBackend.calls += 1
+        results = []
+        for image_data, _ in images:
+            key = self.key(image_data)
+            default = [{'title': f"Libro {key[:8]}", 'author': "Autore di prova"}]
+            results.append([dict(book) for book in self.detections.get(key, default)])
+        return results
+
+
+_lock = threading.Lock()
+_backend = None
+_backend_path = None
+
+
+def get_backend():
+    """
+    Il backend di settings.VISION_BACKEND, creato una volta sola per
+    processo. Se l'impostazione cambia (es. override_settings nei test)
+    viene ricreato.
+    """
+    global _backend, _backend_path
+    path = settings.VISION_BACKEND
+    with _lock:
+        if _backend is None or _backend_path != path:
+            _backend = import_string(path)()
+            _backend_path = path
+        return _backend
+
+
+def reset_backend():
+    global _backend
+    with _lock:
+        _backend = None
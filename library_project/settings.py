@@ -42,6 +42,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Per primo: misura tutta la richiesta (solo con METRICS_ENABLED)
+    'library.instrumentation.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -55,8 +57,11 @@ ROOT_URLCONF = 'library_project.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
-        'DIRS': [],
+        # Il backend standard di Django, con il tempo di rendering nelle metriche
+        'BACKEND': 'library.instrumentation.InstrumentedDjangoTemplates',
+        # La cartella dei template dell'app si chiama 'Templates' (maiuscola):
+        # APP_DIRS cerca 'templates' e sui filesystem case-sensitive (Linux) non la troverebbe
+        'DIRS': [BASE_DIR / 'library' / 'Templates'],
         'APP_DIRS': True,
         'OPTIONS': {
             'context_processors': [
@@ -124,3 +129,182 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # Aggiungi questa riga in fondo al file settings.py
 GOOGLE_API_KEY = config('GOOGLE_API_KEY')
+
+# --- CACHE ---
+# 'default' resta in memoria; 'book_metadata' è su database, così i metadati
+# di Google Books sopravvivono ai riavvii e sono condivisi tra i worker.
+# (La tabella si crea con: python manage.py createcachetable)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'book_metadata': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'library_book_metadata_cache',
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+}
+
+# --- CACHE DEI METADATI DI GOOGLE BOOKS ---
+BOOK_METADATA_CACHE_ALIAS = 'book_metadata'
+# Numero massimo di voci nella cache in memoria (LRU) di ogni processo
+BOOK_METADATA_CACHE_SIZE = config('BOOK_METADATA_CACHE_SIZE', default=2048, cast=int)
+# Durata (in secondi) dei risultati trovati: 30 giorni
+BOOK_METADATA_CACHE_TTL = config('BOOK_METADATA_CACHE_TTL', default=60 * 60 * 24 * 30, cast=int)
+# Durata (in secondi) dei risultati "nessun libro trovato": 1 giorno
+BOOK_METADATA_NEGATIVE_TTL = config('BOOK_METADATA_NEGATIVE_TTL', default=60 * 60 * 24, cast=int)
+
+# --- ARRICCHIMENTO DEI LIBRI RILEVATI ---
+# Numero massimo di ricerche su Google Books eseguite in parallelo per ogni foto
+BOOK_LOOKUP_WORKERS = config('BOOK_LOOKUP_WORKERS', default=8, cast=int)
+# Timeout (in secondi) di ogni singola richiesta HTTP verso Google Books / Google Immagini
+BOOK_LOOKUP_TIMEOUT = config('BOOK_LOOKUP_TIMEOUT', default=10, cast=float)
+# Endpoint dell'API di Google Books (modificabile per i test di carico con un finto server)
+GOOGLE_BOOKS_API_URL = config('GOOGLE_BOOKS_API_URL', default='https://www.googleapis.com/books/v1/volumes')
+
+# --- RICONOSCIMENTO LOCALE DEI LIBRI LETTI DA GEMINI (library/book_matcher.py) ---
+# Se attivo, i libri già noti (catalogo e cache) vengono riconosciuti senza chiamare Google Books
+BOOK_MATCH_ENABLED = config('BOOK_MATCH_ENABLED', default=True, cast=bool)
+# Somiglianza minima (0-1) tra i titoli (trigrammi) e tra gli autori perché il volume sia "lo stesso"
+BOOK_MATCH_MIN_TITLE_SCORE = config('BOOK_MATCH_MIN_TITLE_SCORE', default=0.75, cast=float)
+BOOK_MATCH_MIN_AUTHOR_SCORE = config('BOOK_MATCH_MIN_AUTHOR_SCORE', default=0.7, cast=float)
+# Volumi confrontati per ogni libro (quelli con più trigrammi in comune)
+BOOK_MATCH_CANDIDATES = config('BOOK_MATCH_CANDIDATES', default=20, cast=int)
+# Dopo quanti secondi l'indice dei titoli viene comunque ricostruito (es. titoli modificati)
+BOOK_MATCH_INDEX_TTL = config('BOOK_MATCH_INDEX_TTL', default=300, cast=int)
+
+# --- CODA DI ACQUISIZIONE (python manage.py process_ingestion_jobs) ---
+# Tentativi massimi per ogni immagine prima di segnarla come fallita
+INGESTION_MAX_ATTEMPTS = config('INGESTION_MAX_ATTEMPTS', default=3, cast=int)
+# Dopo quanti secondi un'immagine "in elaborazione" viene considerata abbandonata
+# (es. worker riavviato) e rimessa in coda
+INGESTION_LOCK_TIMEOUT = config('INGESTION_LOCK_TIMEOUT', default=600, cast=int)
+# Secondi di attesa del worker quando la coda è vuota
+INGESTION_POLL_INTERVAL = config('INGESTION_POLL_INTERVAL', default=2, cast=float)
+# Numero di foto analizzate in parallelo dal worker (ognuna è una chiamata a Gemini:
+# tenerlo entro i limiti di richieste al minuto del proprio piano)
+INGESTION_IMAGE_WORKERS = config('INGESTION_IMAGE_WORKERS', default=4, cast=int)
+
+# --- RICONOSCIMENTO DEI LIBRI NELLE FOTO (library/vision_backends.py) ---
+# Classe che legge titoli e autori: GeminiBackend (remoto), LocalOCRBackend (OpenCV + RapidOCR,
+# senza rete: pip install rapidocr_onnxruntime) oppure FakeBackend (test)
+VISION_BACKEND = config('VISION_BACKEND', default='library.vision_backends.GeminiBackend')
+# Confidenza minima (0-1) di una riga letta dall'OCR locale
+VISION_OCR_MIN_SCORE = config('VISION_OCR_MIN_SCORE', default=0.6, cast=float)
+
+# --- RICHIESTE A GEMINI ---
+GEMINI_MODEL = config('GEMINI_MODEL', default='gemini-2.5-flash-lite')
+# Più foto (o tasselli) nella stessa richiesta: le istruzioni vengono inviate una volta per gruppo
+GEMINI_BATCH_SIZE = config('GEMINI_BATCH_SIZE', default=4, cast=int)
+# Limite (in byte) delle immagini di una richiesta: quelle in linea non possono superare ~20 MB in tutto
+GEMINI_BATCH_MAX_BYTES = config('GEMINI_BATCH_MAX_BYTES', default=15 * 1024 * 1024, cast=int)
+
+# --- PREPARAZIONE DELLE FOTO PER GEMINI ---
+# Lato più lungo (in pixel) delle foto inviate al modello
+GEMINI_IMAGE_MAX_DIMENSION = config('GEMINI_IMAGE_MAX_DIMENSION', default=2048, cast=int)
+# Qualità JPEG (1-100) usata per ricomprimere le foto
+GEMINI_IMAGE_JPEG_QUALITY = config('GEMINI_IMAGE_JPEG_QUALITY', default=85, cast=int)
+# Le foto caricate fino a questa dimensione restano in memoria invece di passare da un file temporaneo
+FILE_UPLOAD_MAX_MEMORY_SIZE = 20 * 1024 * 1024
+# Le foto più larghe di SHELF_TILE_MAX_ASPECT volte la loro altezza vengono divise in
+# tasselli verticali (tagliati tra una costa e l'altra) analizzati separatamente
+SHELF_TILE_MAX_ASPECT = config('SHELF_TILE_MAX_ASPECT', default=1.5, cast=float)
+# Sovrapposizione tra tasselli vicini, come frazione della larghezza di un tassello
+SHELF_TILE_OVERLAP = config('SHELF_TILE_OVERLAP', default=0.15, cast=float)
+# Qualità JPEG delle foto in coda che verranno divise in tasselli: ogni tassello viene
+# ricompresso una seconda volta, quindi la prima compressione deve perdere poco
+SHELF_TILE_SOURCE_JPEG_QUALITY = config('SHELF_TILE_SOURCE_JPEG_QUALITY', default=95, cast=int)
+# Richieste a Gemini in parallelo (gruppi di foto/tasselli)
+SHELF_TILE_WORKERS = config('SHELF_TILE_WORKERS', default=4, cast=int)
+
+# --- CACHE DELLE FOTO GIÀ ANALIZZATE ---
+# Distanza di Hamming massima (su 256 bit di dHash) perché due foto siano considerate
+# "la stessa foto" e si riusino i risultati di Gemini. -1 disattiva la cache.
+IMAGE_FINGERPRINT_MAX_DISTANCE = config('IMAGE_FINGERPRINT_MAX_DISTANCE', default=10, cast=int)
+# Dopo quanti secondi un risultato viene dimenticato e la foto rianalizzata (30 giorni)
+IMAGE_FINGERPRINT_TTL = config('IMAGE_FINGERPRINT_TTL', default=60 * 60 * 24 * 30, cast=int)
+# Impronte confrontate per ogni foto (le usate più di recente): il confronto è in Python
+IMAGE_FINGERPRINT_SCAN_LIMIT = config('IMAGE_FINGERPRINT_SCAN_LIMIT', default=5000, cast=int)
+
+# --- PAGINAZIONE ---
+# Libri mostrati per pagina nella ricerca e negli elenchi delle librerie
+LIBRARY_PAGE_SIZE = config('LIBRARY_PAGE_SIZE', default=48, cast=int)
+
+# --- CLIENT HTTP CONDIVISO (library/http_client.py) ---
+# Connessioni keep-alive tenute aperte per ogni host
+HTTP_POOL_SIZE = config('HTTP_POOL_SIZE', default=16, cast=int)
+# Timeout (in secondi) usato quando il chiamante non ne indica uno
+HTTP_TIMEOUT = config('HTTP_TIMEOUT', default=10, cast=float)
+# Nuovi tentativi dopo errori di rete, 429 o 5xx, con attesa casuale fino a
+# HTTP_BACKOFF_BASE * 2^tentativo secondi (al massimo HTTP_BACKOFF_MAX)
+HTTP_MAX_RETRIES = config('HTTP_MAX_RETRIES', default=3, cast=int)
+HTTP_BACKOFF_BASE = config('HTTP_BACKOFF_BASE', default=0.5, cast=float)
+HTTP_BACKOFF_MAX = config('HTTP_BACKOFF_MAX', default=8, cast=float)
+# Richieste al secondo per host (0 = nessun limite) e raffica massima consentita
+HTTP_RATE_LIMITS = {
+    'www.googleapis.com': config('GOOGLE_BOOKS_RATE_LIMIT', default=10, cast=float),
+    'www.google.com': config('GOOGLE_IMAGES_RATE_LIMIT', default=1, cast=float),
+}
+HTTP_DEFAULT_RATE_LIMIT = config('HTTP_DEFAULT_RATE_LIMIT', default=2, cast=float)
+HTTP_RATE_BURST = config('HTTP_RATE_BURST', default=5, cast=int)
+# Dopo HTTP_CIRCUIT_FAILURES richieste fallite di fila un host viene saltato
+# per HTTP_CIRCUIT_RESET secondi (0 disattiva il circuit breaker)
+HTTP_CIRCUIT_FAILURES = config('HTTP_CIRCUIT_FAILURES', default=5, cast=int)
+HTTP_CIRCUIT_RESET = config('HTTP_CIRCUIT_RESET', default=30, cast=float)
+
+# --- IMPORTAZIONE IN BLOCCO (ISBN / URL) ---
+# Righe massime per ogni file importato
+BULK_IMPORT_MAX_ROWS = config('BULK_IMPORT_MAX_ROWS', default=5000, cast=int)
+# Libri salvati nel database per ogni blocco
+BULK_IMPORT_BATCH_SIZE = config('BULK_IMPORT_BATCH_SIZE', default=50, cast=int)
+
+# --- ESPORTAZIONE / IMPORTAZIONE DEL CATALOGO ---
+# Righe lette dal database (esportazione) o scritte per transazione (importazione) alla volta
+CATALOG_CHUNK_SIZE = config('CATALOG_CHUNK_SIZE', default=2000, cast=int)
+
+# --- CACHE LOCALE DELLE COPERTINE (python manage.py fetch_covers) ---
+# Cartella dei file scaricati (nomi = SHA-256 del contenuto)
+COVER_CACHE_DIR = config('COVER_CACHE_DIR', default=str(BASE_DIR / 'cover_cache'))
+# Riquadro in cui deve stare la miniatura usata nelle card dei libri
+COVER_THUMBNAIL_WIDTH = config('COVER_THUMBNAIL_WIDTH', default=200, cast=int)
+COVER_THUMBNAIL_HEIGHT = config('COVER_THUMBNAIL_HEIGHT', default=300, cast=int)
+COVER_THUMBNAIL_JPEG_QUALITY = config('COVER_THUMBNAIL_JPEG_QUALITY', default=80, cast=int)
+# Download in parallelo e dimensione massima di una copertina
+COVER_FETCH_WORKERS = config('COVER_FETCH_WORKERS', default=4, cast=int)
+COVER_MAX_BYTES = config('COVER_MAX_BYTES', default=5 * 1024 * 1024, cast=int)
+# Dopo un errore si riprova tra COVER_RETRY_BASE secondi, poi il doppio, ecc. (al massimo
+# COVER_RETRY_MAX); dopo COVER_MAX_ATTEMPTS errori la copertina viene abbandonata
+COVER_RETRY_BASE = config('COVER_RETRY_BASE', default=300, cast=int)
+COVER_RETRY_MAX = config('COVER_RETRY_MAX', default=60 * 60 * 24, cast=int)
+COVER_MAX_ATTEMPTS = config('COVER_MAX_ATTEMPTS', default=6, cast=int)
+# Secondi dopo cui una copertina prenotata da un worker che non risponde torna disponibile
+COVER_FETCH_LEASE = config('COVER_FETCH_LEASE', default=300, cast=int)
+# Durata della cache del browser per le copertine scaricate (1 anno: il contenuto di un
+# indirizzo /covers/ non cambia) e per i redirect verso quelle non ancora pronte
+COVER_CACHE_MAX_AGE = config('COVER_CACHE_MAX_AGE', default=60 * 60 * 24 * 365, cast=int)
+COVER_PENDING_MAX_AGE = config('COVER_PENDING_MAX_AGE', default=60, cast=int)
+
+# --- LOG E METRICHE (library/instrumentation.py) ---
+# Livello dei messaggi dell'app (DEBUG mostra anche i tempi di ogni span) e formato:
+# 'text' (una riga leggibile) o 'json' (una riga JSON per messaggio, per i raccoglitori di log)
+LOG_LEVEL = config('LOG_LEVEL', default='INFO')
+LOG_FORMAT = config('LOG_FORMAT', default='text')
+# Istogrammi dei tempi ed endpoint /metrics/ (formato Prometheus); disattivati non costano nulla
+METRICS_ENABLED = config('METRICS_ENABLED', default=False, cast=bool)
+# Limiti dei bucket degli istogrammi, in secondi
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'text': {'format': '{asctime} {levelname} {name}: {message}', 'style': '{'},
+        'json': {'()': 'library.instrumentation.JsonFormatter'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': LOG_FORMAT},
+    },
+    'loggers': {
+        'library': {'handlers': ['console'], 'level': LOG_LEVEL, 'propagate': False},
+    },
+}